@@ -1,19 +1,50 @@
 import asyncio
 import logging
 import voluptuous as vol
+from collections import deque
 
-from homeassistant.core import callback
+from homeassistant import config as conf_util
+from homeassistant.core import CoreState, callback
 from datetime import (datetime, timedelta)
 from homeassistant.helpers import config_validation as cv
 from homeassistant.helpers.entity import Entity
 from homeassistant.helpers.entity_component import EntityComponent
 from homeassistant.helpers.restore_state import RestoreEntity
 import homeassistant.util.dt as dt_util
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.loader import async_get_integration
 from homeassistant.const import (
     ATTR_ENTITY_ID, ATTR_ICON,
     EVENT_HOMEASSISTANT_START,EVENT_HOMEASSISTANT_STOP,
     SERVICE_TURN_OFF, SERVICE_TURN_ON, STATE_ON, STATE_OFF,MATCH_ALL)
-from homeassistant.helpers.event import async_track_state_change
+from homeassistant.helpers.event import (async_call_later,
+                                         async_track_point_in_time,
+                                         async_track_state_change)
+
+from .diagnostics import PROFILE_FILE, STATS_FILE, Diagnostics, RunProfiler
+from .et import ETCalculator
+from .flow import LEAK_FACTOR, LEAK_FLOW, FlowMonitor
+from .forecast import (ACTION_DEFER, ACTION_SKIP, DEFER_HOURS,
+                       DEFER_PROBABILITY, FORECAST_HOURS, SHORTEN_RAIN,
+                       SKIP_RAIN, WeatherForecast)
+from .history import (EXPORT_FILE, HISTORY_DIR, REASON_FAILED,
+                      REASON_FORECAST, REASON_RAIN,
+                      REASON_STOPPED, REASON_TEMPLATE, REASON_UNAVAILABLE,
+                      REASON_WATERED, WateringHistory)
+from .journal import JOURNAL_FILE, RunJournal
+from .lazy import ScheduleTable, schedule_row
+from .master import POST_STOP, PRE_START, MasterSwitch
+from .planner import (NEXT_RUNS, ZoneRun, eco_cycles, makespan,
+                      next_run_dates, parallel_plan, run_intervals,
+                      run_times, sequential_plan)
+from .reload import ConfigDiff, config_key
+from .report import PERIODS, Rollups
+from .runqueue import POLICIES, POLICY_PREEMPT, RunQueue
+from .switches import (CONFIRM_TIMEOUT, RETRIES, UNAVAILABLE_POLICIES,
+                       UNAVAILABLE_RESCHEDULE, UNAVAILABLE_SKIP, Controller,
+                       SwitchCommander)
+from .template_cache import CachedTemplate, TemplateAnalyser
+from .timer import PhaseTimer
 
 
 # Shortcut for the logger
@@ -23,6 +54,10 @@ DOMAIN                = 'irrigation'
 ENTITY_ID_FORMAT      = DOMAIN + '.{}'
 ZONE_DOMAIN           = 'irrigation_zone'
 ZONE_ENTITY_ID_FORMAT = ZONE_DOMAIN + '.{}'
+CONTROLLER_DOMAIN     = 'irrigation_controller'
+CONTROLLER_ENTITY_ID_FORMAT = CONTROLLER_DOMAIN + '.{}'
+MASTER_DOMAIN         = 'irrigation_master'
+MASTER_ENTITY_ID_FORMAT = MASTER_DOMAIN + '.{}'
 
 PLATFORM_PROGRAM = 'program'
 PLATFORM_ZONE    = 'zone'
@@ -47,7 +82,98 @@ ATTR_ICON_WATER  = 'icon_on'
 ATTR_ICON_WAIT   = 'icon_wait'
 ATTR_ICON_OFF    = 'icon_off'
 ATTR_PROGRAMS    = 'programs'
+ATTR_PUBLISH     = 'publish'
+ATTR_PUBLISH_INTERVAL = 'publish_interval'
+ATTR_END_TIME    = 'end_time'
+ATTR_STATE_WRITES = 'state_writes'
+ATTR_FLOW        = 'flow'
+ATTR_FLOW_LIMIT  = 'flow_limit'
+ATTR_MAX_CONCURRENT = 'max_concurrent'
+ATTR_PLANNED_MAKESPAN = 'planned_makespan'
+ATTR_SEQUENTIAL_MAKESPAN = 'sequential_makespan'
+ATTR_POLICY      = 'policy'
+ATTR_PRIORITY    = 'priority'
+ATTR_QUEUE_DEPTH = 'queue_depth'
+ATTR_QUEUE_WAIT  = 'queue_wait'
+ATTR_QUEUED      = 'queued'
+ATTR_RENDER_COUNT = 'render_count'
+ATTR_RENDER_TIME = 'render_time'
+ATTR_PLAN        = 'plan'
+ATTR_PROJECTED_DURATION = 'projected_duration'
+ATTR_RECHECK     = 'recheck'
+ATTR_MINUTES_WEEK = 'minutes_last_7_days'
+ATTR_LITRES_WEEK = 'litres_last_7_days'
+ATTR_TEMPERATURE_SENSOR = 'temperature_sensor'
+ATTR_HUMIDITY_SENSOR = 'humidity_sensor'
+ATTR_PRESSURE_SENSOR = 'pressure_sensor'
+ATTR_RAIN_SENSOR = 'rain_sensor'
+ATTR_ET_WINDOW   = 'et_window'
+ATTR_CROP_COEFFICIENT = 'crop_coefficient'
+ATTR_PRECIPITATION_RATE = 'precipitation_rate'
+ATTR_INFILTRATION_RATE = 'infiltration_rate'
+ATTR_REFERENCE_ET = 'reference_et'
+ATTR_INTERLEAVE  = 'interleave'
+ATTR_PROJECTED_TIME = 'projected_time'
+ATTR_ACTUAL_TIME = 'actual_time'
+ATTR_CONFIRM_TIMEOUT = 'confirm_timeout'
+ATTR_COMMAND_RETRIES = 'command_retries'
+ATTR_SWITCH_COMMANDS = 'switch_commands'
+ATTR_SWITCH_LATENCY = 'switch_latency'
+ATTR_CONTROLLERS = 'controllers'
+ATTR_CONTROLLER  = 'controller'
+ATTR_AVAILABILITY_ENTITY = 'availability_entity'
+ATTR_MAX_COMMANDS = 'max_commands'
+ATTR_UNAVAILABLE = 'unavailable'
+ATTR_IN_FLIGHT   = 'in_flight'
+ATTR_SWITCHES    = 'switches'
+ATTR_UNAVAILABLE_COUNT = 'unavailable_count'
+ATTR_LAST_UNAVAILABLE = 'last_unavailable'
+ATTR_TRANSITION  = 'transition'
+ATTR_TRANSITION_TIME = 'transition_time'
+ATTR_TRANSITIONS = 'transitions'
+ATTR_FILENAME    = 'filename'
+ATTR_PERIOD      = 'period'
+ATTR_START       = 'start'
+ATTR_END         = 'end'
+ATTR_FORECAST    = 'forecast'
+ATTR_FORECAST_ENTITY = 'forecast_entity'
+ATTR_FORECAST_HOURS = 'forecast_hours'
+ATTR_FORECAST_SKIP = 'forecast_skip'
+ATTR_FORECAST_SHORTEN = 'forecast_shorten'
+ATTR_DEFER_PROBABILITY = 'forecast_defer_probability'
+ATTR_DEFER_HOURS = 'forecast_defer_hours'
+ATTR_FORECAST_DECISIONS = 'forecast_decisions'
+ATTR_SCALE       = 'scale'
+ATTR_NEXT_RUNS   = 'next_runs'
+ATTR_TIMELINE    = 'timeline'
+ATTR_FLOW_SENSOR = 'flow_sensor'
+ATTR_PULSES_PER_LITRE = 'pulses_per_litre'
+ATTR_VOLUME      = 'volume'
+ATTR_LEAK_FLOW   = 'leak_flow'
+ATTR_LEAK_FACTOR = 'leak_factor'
+ATTR_FLOW_RATE   = 'flow_rate'
+ATTR_METERED     = 'metered_litres'
+ATTR_FLOW_BASELINE = 'flow_baseline'
+ATTR_LAZY        = 'lazy'
+ATTR_PINNED      = 'pinned'
+ATTR_MASTER_SWITCH = 'master_switch'
+ATTR_PRE_START   = 'master_pre_start'
+ATTR_POST_STOP   = 'master_post_stop'
+ATTR_STARTS      = 'starts'
+ATTR_ZONE_RUNS   = 'zone_runs'
+ATTR_CYCLES      = 'cycles'
+ATTR_DUTY_TIME   = 'duty_time'
+ATTR_ACTIVE_ZONES = 'active_zones'
 CONST_ENTITY     = 'entity_id'
+DATA_JOURNAL     = 'journal'
+DATA_HISTORY     = 'history'
+DATA_ET          = 'et'
+DATA_SWITCHES    = 'switches'
+DATA_DIAGNOSTICS = 'diagnostics'
+DATA_FORECAST    = 'forecast'
+DATA_FLOW        = 'flow'
+DATA_MASTER      = 'master'
+HISTORY_WINDOW   = timedelta(days=7)
 CONST_SWITCH     = 'switch'
 
 DFLT_ICON_WATER  = 'mdi:water'
@@ -55,6 +181,18 @@ DFLT_ICON_WAIT   = 'mdi:timer-sand'
 DFLT_ICON_OFF    = 'mdi:water-off'
 DFLT_ICON        = 'mdi:fountain'
 
+PUBLISH_INTERVAL = 'interval'
+PUBLISH_PHASE    = 'phase'
+PUBLISH_ADAPTIVE = 'adaptive'
+PUBLISH_POLICIES = [PUBLISH_INTERVAL,PUBLISH_PHASE,PUBLISH_ADAPTIVE]
+
+TRANSITION_GAP     = 'gap'
+TRANSITION_OVERLAP = 'overlap'
+TRANSITIONS = [TRANSITION_GAP,TRANSITION_OVERLAP]
+TRANSITIONS_KEPT = 10
+DECISIONS_KEPT   = 10
+DFLT_PUBLISH_INTERVAL = 60
+
 CONFIG_SCHEMA = vol.Schema(
     {
     DOMAIN: vol.Schema({
@@ -68,11 +206,34 @@ CONFIG_SCHEMA = vol.Schema(
             vol.Optional(ATTR_ICON_WATER,default=DFLT_ICON_WATER): cv.icon,
             vol.Optional(ATTR_ICON_WAIT,default=DFLT_ICON_WAIT): cv.icon,
             vol.Optional(ATTR_ICON_OFF,default=DFLT_ICON_OFF): cv.icon,
+            vol.Optional(ATTR_FLOW): vol.Range(min=0),
+            vol.Optional(ATTR_CROP_COEFFICIENT,default=1.0):
+                vol.All(vol.Coerce(float), vol.Range(min=0, max=2)),
+            vol.Optional(ATTR_PRECIPITATION_RATE):
+                vol.All(vol.Coerce(float), vol.Range(min=0.1)),
+            vol.Optional(ATTR_INFILTRATION_RATE):
+                vol.All(vol.Coerce(float), vol.Range(min=0.1)),
+            vol.Optional(ATTR_CONTROLLER): cv.string,
+            vol.Optional(ATTR_FLOW_SENSOR): cv.entity_id,
+            vol.Optional(ATTR_PULSES_PER_LITRE): vol.Range(min=0.001),
+            vol.Optional(ATTR_VOLUME): vol.Range(min=0),
+            vol.Optional(ATTR_PINNED,default=False): cv.boolean,
         }],
         vol.Required(ATTR_PROGRAMS):[{
             vol.Required(ATTR_IRRIG_ID): cv.string,
             vol.Required(ATTR_TEMPLATE): cv.template,
             vol.Optional(ATTR_ICON,default=DFLT_ICON): cv.icon,
+            vol.Optional(ATTR_MAX_CONCURRENT): vol.Range(min=1),
+            vol.Optional(ATTR_FLOW_LIMIT): vol.Range(min=0),
+            vol.Optional(ATTR_PRIORITY,default=0): vol.Coerce(int),
+            vol.Optional(ATTR_RECHECK,default=False): cv.boolean,
+            vol.Optional(ATTR_INTERLEAVE,default=False): cv.boolean,
+            vol.Optional(ATTR_TRANSITION,default=TRANSITION_GAP):
+                vol.In(TRANSITIONS),
+            vol.Optional(ATTR_TRANSITION_TIME,default=0):
+                vol.Range(min=0, max=10000),
+            vol.Optional(ATTR_FORECAST,default=True): cv.boolean,
+            vol.Optional(ATTR_PINNED,default=False): cv.boolean,
             vol.Required(ATTR_ZONES): [{
                 vol.Required(ATTR_ZONE): cv.entity_domain('irrigation_zone'),
                 vol.Optional(ATTR_WATER): vol.Range(min=1, max=30),
@@ -80,6 +241,48 @@ CONFIG_SCHEMA = vol.Schema(
                 vol.Optional(ATTR_REPEAT): vol.Range(min=1, max=30),
             }],
         }],
+        vol.Optional(ATTR_PUBLISH,default=PUBLISH_INTERVAL):
+            vol.In(PUBLISH_POLICIES),
+        vol.Optional(ATTR_PUBLISH_INTERVAL,default=DFLT_PUBLISH_INTERVAL):
+            vol.Range(min=1, max=3600),
+        vol.Optional(ATTR_POLICY,default=POLICY_PREEMPT): vol.In(POLICIES),
+        vol.Optional(ATTR_TEMPERATURE_SENSOR): cv.entity_id,
+        vol.Optional(ATTR_HUMIDITY_SENSOR): cv.entity_id,
+        vol.Optional(ATTR_PRESSURE_SENSOR): cv.entity_id,
+        vol.Optional(ATTR_RAIN_SENSOR): cv.entity_id,
+        vol.Optional(ATTR_ET_WINDOW,default=24): vol.Range(min=1, max=168),
+        vol.Optional(ATTR_FORECAST_ENTITY): cv.entity_domain('weather'),
+        vol.Optional(ATTR_FORECAST_HOURS,default=FORECAST_HOURS):
+            vol.Range(min=1, max=168),
+        vol.Optional(ATTR_FORECAST_SKIP,default=SKIP_RAIN):
+            vol.All(vol.Coerce(float), vol.Range(min=0.1)),
+        vol.Optional(ATTR_FORECAST_SHORTEN,default=SHORTEN_RAIN):
+            vol.All(vol.Coerce(float), vol.Range(min=0)),
+        vol.Optional(ATTR_DEFER_PROBABILITY,default=DEFER_PROBABILITY):
+            vol.Range(min=0, max=100),
+        vol.Optional(ATTR_DEFER_HOURS,default=DEFER_HOURS):
+            vol.Range(min=0, max=24),
+        vol.Optional(ATTR_LAZY,default=False): cv.boolean,
+        vol.Optional(ATTR_FLOW_SENSOR): cv.entity_id,
+        vol.Optional(ATTR_PULSES_PER_LITRE): vol.Range(min=0.001),
+        vol.Optional(ATTR_LEAK_FLOW,default=LEAK_FLOW): vol.Range(min=0),
+        vol.Optional(ATTR_LEAK_FACTOR,default=LEAK_FACTOR): vol.Range(min=1),
+        vol.Optional(ATTR_MASTER_SWITCH): cv.entity_domain('switch'),
+        vol.Optional(ATTR_PRE_START,default=PRE_START):
+            vol.Range(min=0, max=300),
+        vol.Optional(ATTR_POST_STOP,default=POST_STOP):
+            vol.Range(min=0, max=3600),
+        vol.Optional(ATTR_CONFIRM_TIMEOUT,default=CONFIRM_TIMEOUT):
+            vol.Range(min=1, max=60),
+        vol.Optional(ATTR_COMMAND_RETRIES,default=RETRIES):
+            vol.Range(min=0, max=10),
+        vol.Optional(ATTR_CONTROLLERS,default=[]):[{
+            vol.Required(ATTR_IRRIG_ID): cv.string,
+            vol.Optional(ATTR_AVAILABILITY_ENTITY): cv.entity_id,
+            vol.Optional(ATTR_MAX_COMMANDS,default=1): vol.Range(min=1, max=16),
+            vol.Optional(ATTR_UNAVAILABLE,default=UNAVAILABLE_SKIP):
+                vol.In(UNAVAILABLE_POLICIES),
+        }],
     }),
     },
     extra=vol.ALLOW_EXTRA,
@@ -96,12 +299,8 @@ async def async_setup(hass, config):
             perform_eval = call.get(ATTR_EVAL,False)
             entity_id = call.get(CONST_ENTITY)
 
-        """ stop any running zones  before starting a new program"""
-        hass.services.async_call(DOMAIN,
-                                 'stop_programs',
-                                 {ATTR_EVAL:True})
-
-        entity = component.get_entity(entity_id)
+        yield from async_materialise([entity_id])
+        entity = programs.get(entity_id)
         if entity:
             target_irrigation = [ entity ]
             tasks = [irrigation.async_run_program(perform_eval)
@@ -128,119 +327,485 @@ async def async_setup(hass, config):
                 ATTR_REPEAT:y_repeat,
                 ATTR_EVAL:y_ignore}
 
-        entity = component.get_entity(entity_id)
+        yield from async_materialise([entity_id])
+        entity = zones.get(entity_id)
         if entity:
             target_irrigation = [ entity ]
             tasks = [irrigation_zone.async_run_zone(DATA)
                      for irrigation_zone in target_irrigation]
             if tasks:
                 yield from asyncio.wait(tasks, loop=hass.loop)
+            yield from async_release_idle()
         else:
             _LOGGER.error('irrigation_zone not found: %s', entity_id)
     """ END async_run_zone_service """
 
 
-    @asyncio.coroutine
-    def async_stop_program_service(call):
-
-        for program in conf.get(ATTR_PROGRAMS):
-            y_irrigation_id = cv.slugify(program.get(ATTR_IRRIG_ID))
-            entity_id = ENTITY_ID_FORMAT.format(y_irrigation_id)
-            entity = component.get_entity(entity_id)
-            if entity:
-                target_irrigation = [ entity ]
-                tasks = [irrigation.async_stop_program()
-                         for irrigation in target_irrigation]
-                if tasks:
-                    yield from asyncio.wait(tasks, loop=hass.loop)
-            else:
-                _LOGGER.error('irrigation program not found: %s',
-                              entity_id)
-
-        for zone in conf.get(ATTR_ZONES):
-            y_irrigation_id = cv.slugify(zone.get(ATTR_IRRIG_ID))
-            entity_id = ZONE_ENTITY_ID_FORMAT.format(y_irrigation_id)
-            entity = component.get_entity(entity_id)
-            if entity:
-                target_irrigation = [ entity ]
-                tasks = [irrigation_zone.async_stop_zone()
-                         for irrigation_zone in target_irrigation]
-                if tasks:
-                    yield from asyncio.wait(tasks, loop=hass.loop)
-            else:
-                _LOGGER.error('irrigation_zone not found: %s',
-                              entity_id)
+    async def async_stop_program_service(call):
+        """ stop every program and zone, the switches are turned off
+            together in a single service call """
+        start = hass.loop.time()
+        queue.async_clear()
+        for entity in programs.values():
+            await entity.async_stop_program()
+        for entity in zones.values():
+            entity.async_halt()
+        if master is not None:
+            master.halt()
+
+        await async_stop_switches(call)
+
+        _LOGGER.info('stopped %s switches in %.3f seconds',
+                     len(zone_switches()), hass.loop.time() - start)
     """ END async_stop_program_service """
 
 
-    @asyncio.coroutine
-    def async_stop_switches(call):
-        for zone in conf.get(ATTR_ZONES):
-            y_irrigation_id = cv.slugify(zone.get(ATTR_IRRIG_ID))
-
-            entity_id = ZONE_ENTITY_ID_FORMAT.format(y_irrigation_id)
-            entity = component.get_entity(entity_id)
-            if entity:
-                target_irrigation = [ entity ]
-                tasks = [irrigation_zone.async_stop_switch()
-                         for irrigation_zone in target_irrigation]
-                if tasks:
-                    yield from asyncio.wait(tasks, loop=hass.loop)
-            else:
-                _LOGGER.error('irrigation_zone not found: %s', entity_id)
+    async def async_dump_stats_service(call):
+        """ write the runtime counters to a file and the log """
+        filename = call.data.get(ATTR_FILENAME, STATS_FILE)
+        await diagnostics.async_dump(hass.config.path(filename))
+    """ END async_dump_stats_service """
+
+
+    async def async_export_service(call):
+        """ write the run records, or the totals of each day, week or
+            month, to a CSV file """
+        filename   = call.data.get(ATTR_FILENAME, EXPORT_FILE)
+        period     = call.data.get(ATTR_PERIOD)
+        entity_ids = call.data.get(CONST_ENTITY)
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        try:
+            start = service_date(call.data, ATTR_START)
+            end   = service_date(call.data, ATTR_END)
+        except ValueError as err:
+            _LOGGER.error('irrigation export, not a date: %s', err)
+            return
+        if period is not None and period not in PERIODS:
+            _LOGGER.error('irrigation export, period must be one of %s',
+                          PERIODS)
+            return
+
+        begun = hass.loop.time()
+        path = hass.config.path(filename)
+        if period is not None:
+            rows = await rollups.async_export(path, period, entity_ids,
+                                              start, end)
+        else:
+            """ the records that started from the start of the first day
+                to the end of the last """
+            if start is not None:
+                start = dt_util.start_of_local_day(
+                    datetime.combine(start, datetime.min.time())).timestamp()
+            if end is not None:
+                end = dt_util.start_of_local_day(
+                    datetime.combine(end + timedelta(days=1),
+                                     datetime.min.time())).timestamp()
+            rows = await history.async_export(path, entity_ids, start, end)
+        _LOGGER.info('irrigation export wrote %s rows to %s in %.3f seconds',
+                     rows, path, hass.loop.time() - begun)
+    """ END async_export_service """
+
+
+    async def async_profile_program_service(call):
+        """ run a program once under the profiler """
+        entity_id = call.data.get(CONST_ENTITY)
+        filename  = call.data.get(ATTR_FILENAME, PROFILE_FILE)
+        await async_materialise([entity_id])
+        entity = programs.get(entity_id)
+        if entity:
+            await entity.async_profile(hass.config.path(filename))
+        else:
+            _LOGGER.error('irrigation program not found: %s', entity_id)
+    """ END async_profile_program_service """
+
+
+    async def async_stop_switches(call):
+        return await commander.async_turn_all(zone_switches(), False)
     """ END async_stop_switches """
 
 
+    def zone_switches():
+        """ the switches of every zone and the master switch, a zone
+            running when it was reloaded keeps its switch until the run
+            ends """
+        switches = {zone.get(ATTR_SWITCH) for zone in zone_configs.values()}
+        if master is not None:
+            switches.add(master.switch)
+        return list(switches | {zone.switch for zone in zones.values()})
+
+
+    def schedule_lazily(entity_id, program):
+        """ keep the program in the schedule table, False when it has
+            to be created as an entity """
+        if table is None or program.get(ATTR_PINNED):
+            return False
+        row = schedule_row(entity_id, analyser.get(
+            entity_id, program.get(ATTR_TEMPLATE).template))
+        if row is None:
+            return False
+        table.add(row)
+        return True
+
+
+    async def async_materialise(entity_ids):
+        """ create the entities of the programs and zones that are not
+            entities yet, a program brings the zones it runs """
+        wanted = set(entity_ids)
+        for entity_id in entity_ids:
+            if entity_id in program_configs:
+                wanted.update(zone.get(ATTR_ZONE) for zone in
+                              program_configs[entity_id].get(ATTR_ZONES))
+        zoneentities = [IrrigationZone(entity_id, zone, conf)
+                        for entity_id, zone in zone_configs.items()
+                        if entity_id in wanted and entity_id not in zones]
+        entities = [Irrigation(entity_id,
+                               program,
+                               program_template(hass, program, analyser),
+                               component,
+                               queue,
+                               table)
+                    for entity_id, program in program_configs.items()
+                    if entity_id in wanted and entity_id not in programs]
+        if zoneentities:
+            await component.async_add_entities(zoneentities)
+            zones.update({entity.entity_id:entity
+                          for entity in zoneentities})
+        if entities:
+            await component.async_add_entities(entities)
+            programs.update({entity.entity_id:entity
+                             for entity in entities})
+
+
+    async def async_release_idle():
+        """ remove the entities of lazy programs and zones once nothing
+            is running, pinned zones and the zones of programs that stay
+            are kept """
+        if table is None:
+            return
+        for entity_id in [entity_id for entity_id in programs
+                          if entity_id in table]:
+            if queue.running is not None or queue.depth:
+                return
+            if programs[entity_id].idle:
+                await programs.pop(entity_id).async_remove()
+        kept = set()
+        for entity in programs.values():
+            kept.update(zone.get(ATTR_ZONE) for zone in entity.zones)
+        for entity_id in list(zones):
+            if (entity_id in kept or entity_id not in zone_configs
+                    or zone_configs[entity_id].get(ATTR_PINNED)):
+                continue
+            if queue.running is not None or queue.depth:
+                return
+            if not zones[entity_id].running:
+                await zones.pop(entity_id).async_remove()
+
+
+    async def async_run_scheduled(entity_id):
+        """ a program in the schedule table came due with the rest of
+            its template true """
+        await async_materialise([entity_id])
+        try:
+            await programs[entity_id].async_triggered()
+        finally:
+            """ a run skipped for rain, or whose zones were all queued
+                already, does not reach the worker that releases it """
+            queue.async_check_idle()
+
+
+    async def async_find_program(entity_id):
+        """ the program entity, created again when lazy mode released
+            it, or None when it was removed from the configuration """
+        if entity_id not in program_configs:
+            return None
+        await async_materialise([entity_id])
+        return programs.get(entity_id)
+
+
+    def assign_controller(zone):
+        """ add the zone switch to the controller that drives it """
+        if zone.get(ATTR_CONTROLLER) is None:
+            return
+        controller = controllers.get(cv.slugify(zone.get(ATTR_CONTROLLER)))
+        if controller is None:
+            _LOGGER.error('irrigation controller not found: %s',
+                          zone.get(ATTR_CONTROLLER))
+        elif zone.get(ATTR_SWITCH) not in controller.switches:
+            controller.switches.append(zone.get(ATTR_SWITCH))
+            commander.add_controller(controller)
+
+
+    async def async_reload_service(call):
+        """ apply the differences between the configuration file and
+            the running programs and zones, entities that did not change
+            are left alone """
+        start = hass.loop.time()
+        try:
+            yaml_config = await conf_util.async_hass_config_yaml(hass)
+        except HomeAssistantError as err:
+            _LOGGER.error('irrigation not reloaded: %s', err)
+            return
+        integration = await async_get_integration(hass, DOMAIN)
+        new_config = await conf_util.async_process_component_config(
+            hass, yaml_config, integration)
+        if new_config is None or DOMAIN not in new_config:
+            _LOGGER.error('irrigation not reloaded, invalid configuration')
+            return
+        new_conf = new_config[DOMAIN]
+        if options_key(new_conf) != options_key(conf):
+            _LOGGER.warning('irrigation options other than the programs '
+                            'and zones change on restart')
+
+        zone_diff = ConfigDiff(zone_keys, {
+            ZONE_ENTITY_ID_FORMAT.format(cv.slugify(zone.get(ATTR_IRRIG_ID))):
+            zone for zone in new_conf.get(ATTR_ZONES)})
+        program_diff = ConfigDiff(program_keys, {
+            ENTITY_ID_FORMAT.format(cv.slugify(program.get(ATTR_IRRIG_ID))):
+            program for program in new_conf.get(ATTR_PROGRAMS)
+            if program.get(ATTR_TEMPLATE) is not None})
+
+        for entity_id in program_diff.removed:
+            del program_keys[entity_id]
+            del program_configs[entity_id]
+            if table is not None:
+                table.remove(entity_id)
+            entity = programs.pop(entity_id, None)
+            if entity is not None:
+                await queue.async_remove(entity)
+                await entity.async_remove()
+
+        for entity_id in zone_diff.removed:
+            del zone_keys[entity_id]
+            del zone_configs[entity_id]
+            entity = zones.pop(entity_id, None)
+            if entity is None:
+                continue
+            if entity.running:
+                await entity.async_stop_and_wait()
+            await entity.async_remove()
+
+        """ lazy programs and zones become entities when they are due """
+        resident = []
+        for entity_id, zone in zone_diff.changed.items():
+            if entity_id in zones:
+                zones[entity_id].async_update_config(zone, conf)
+            elif table is None or zone.get(ATTR_PINNED):
+                resident.append(entity_id)
+            zone_configs[entity_id] = zone
+            zone_keys[entity_id] = zone_diff.keys[entity_id]
+            assign_controller(zone)
+
+        for entity_id, program in program_diff.changed.items():
+            program_configs[entity_id] = program
+            program_keys[entity_id] = program_diff.keys[entity_id]
+            if table is not None:
+                table.remove(entity_id)
+            lazy = schedule_lazily(entity_id, program)
+            entity = programs.get(entity_id)
+            if entity is None:
+                if not lazy:
+                    resident.append(entity_id)
+                continue
+            template = None
+            if program.get(ATTR_TEMPLATE).template != \
+                    entity.template.template:
+                template = program_template(hass, program, analyser)
+            entity.async_update_config(program, template)
+
+        for entity_id, zone in zone_diff.added.items():
+            zone_configs[entity_id] = zone
+            zone_keys[entity_id] = zone_diff.keys[entity_id]
+            assign_controller(zone)
+            if table is None or zone.get(ATTR_PINNED):
+                resident.append(entity_id)
+        for entity_id, program in program_diff.added.items():
+            program_configs[entity_id] = program
+            program_keys[entity_id] = program_diff.keys[entity_id]
+            if not schedule_lazily(entity_id, program):
+                resident.append(entity_id)
+        await async_materialise(resident)
+
+        _LOGGER.info('irrigation reloaded, %s programs and %s zones '
+                     'changed in %.3f seconds', len(program_diff),
+                     len(zone_diff), hass.loop.time() - start)
+    """ END async_reload_service """
+
+
+    async def async_resume_runs(event):
+        """ turn every switch off then resume the runs that were
+            in progress when Home Assistant stopped, the switches are
+            turned off together in a single service call """
+        confirmed = await async_stop_switches(None)
+        diagnostics.switches_off = hass.loop.time() - started
+        _LOGGER.info('%s switches off %s %.3f seconds after setup started',
+                     len(zone_switches()),
+                     'and confirmed' if confirmed else 'but not confirmed',
+                     diagnostics.switches_off)
+        await async_materialise(list(interrupted))
+        for owner, run in interrupted.items():
+            """ convert the journal's wall clock to the loop clock, the
+                schedules carry on from where they were when Home
+                Assistant stopped """
+            resume = {zone:(hass.loop.time() - (stopped - origin), intervals)
+                      for zone, (origin, intervals) in run.schedules.items()}
+            if owner in programs:
+                program = programs[owner]
+                remaining = [zone for zone in program.zones
+                             if zone.get(ATTR_ZONE) in run.remaining]
+                _LOGGER.info('resuming %s from %s', owner, run.remaining)
+                await queue.async_submit(program, False, remaining, resume)
+            elif owner in zones and owner in resume:
+                _LOGGER.info('resuming %s', owner)
+                origin, intervals = resume[owner]
+                hass.async_create_task(
+                    zones[owner].async_run_schedule(origin, intervals))
+            else:
+                """ removed from the configuration while stopped """
+                journal.program_end(owner)
+    """ END async_resume_runs """
+
+
+    async def async_flush_journal(event):
+        journal.stop()
+        await journal.async_flush()
+
+
     """ create the entities and time tracking on setup of the component """
+    started = hass.loop.time()
     conf = config[DOMAIN]
     component = EntityComponent(_LOGGER, DOMAIN, hass)
-    entities = []
-    zoneentities = []
+    queue = RunQueue(hass, conf.get(ATTR_POLICY))
+    journal = RunJournal(hass, hass.config.path('.storage', JOURNAL_FILE))
+    interrupted = await journal.async_load()
+    stopped = journal.stopped
+    history = WateringHistory(hass, hass.config.path('.storage', HISTORY_DIR))
+    """ the water budget totals are brought up to date before any run
+        is recorded """
+    rollups = Rollups(hass, history)
+    await rollups.async_load()
+    history.rollups = rollups
+    et = ETCalculator(hass, {'temperature':conf.get(ATTR_TEMPERATURE_SENSOR),
+                             'humidity':conf.get(ATTR_HUMIDITY_SENSOR),
+                             'pressure':conf.get(ATTR_PRESSURE_SENSOR),
+                             'rain':conf.get(ATTR_RAIN_SENSOR)},
+                      conf.get(ATTR_ET_WINDOW))
+    et.async_start()
+    commander = SwitchCommander(hass, conf.get(ATTR_CONFIRM_TIMEOUT),
+                                conf.get(ATTR_COMMAND_RETRIES))
+    diagnostics = Diagnostics(hass, [DOMAIN, ZONE_DOMAIN, CONTROLLER_DOMAIN,
+                                     MASTER_DOMAIN])
+    diagnostics.async_start()
+    diagnostics.commander = commander
+    forecast = None
+    if conf.get(ATTR_FORECAST_ENTITY) is not None:
+        forecast = WeatherForecast(hass, conf.get(ATTR_FORECAST_ENTITY),
+                                   conf.get(ATTR_FORECAST_HOURS),
+                                   conf.get(ATTR_FORECAST_SKIP),
+                                   conf.get(ATTR_FORECAST_SHORTEN),
+                                   conf.get(ATTR_DEFER_PROBABILITY),
+                                   conf.get(ATTR_DEFER_HOURS))
+        forecast.async_start()
+    flow = FlowMonitor(hass, conf.get(ATTR_FLOW_SENSOR),
+                       conf.get(ATTR_PULSES_PER_LITRE),
+                       conf.get(ATTR_LEAK_FLOW), conf.get(ATTR_LEAK_FACTOR))
+    await flow.async_start()
+    """ a master valve or pump held on while any zone runs """
+    master = None
+    if conf.get(ATTR_MASTER_SWITCH) is not None:
+        master = MasterSwitch(hass, conf.get(ATTR_MASTER_SWITCH),
+                              commander.async_turn,
+                              conf.get(ATTR_PRE_START),
+                              conf.get(ATTR_POST_STOP))
+    hass.data[DOMAIN] = {DATA_JOURNAL:journal, DATA_HISTORY:history,
+                         DATA_ET:et, DATA_SWITCHES:commander,
+                         DATA_DIAGNOSTICS:diagnostics,
+                         DATA_FORECAST:forecast, DATA_FLOW:flow,
+                         DATA_MASTER:master}
+    """ in lazy mode programs triggered at a time of day are kept in the
+        schedule table and become entities only while they run """
+    table = None
+    if conf.get(ATTR_LAZY):
+        table = ScheduleTable(hass, async_run_scheduled)
+        await table.async_load()
+    queue.on_idle = async_release_idle
+    queue.on_cancel = lambda program: journal.program_end(program.entity_id)
+
+    """ every program template is analysed in one pass, or read back when
+        the templates are unchanged since the last start up """
+    analyser = TemplateAnalyser(hass)
+    await analyser.async_analyse({
+        ENTITY_ID_FORMAT.format(cv.slugify(program.get(ATTR_IRRIG_ID))):
+        program.get(ATTR_TEMPLATE).template
+        for program in conf.get(ATTR_PROGRAMS)
+        if program.get(ATTR_TEMPLATE) is not None})
+    diagnostics.analyser = analyser
+
+    program_keys    = {}
+    zone_keys       = {}
+    program_configs = {}
+    zone_configs    = {}
+    resident        = []
 
     for program in conf.get(ATTR_PROGRAMS):
         y_irrigation_id = cv.slugify(program.get(ATTR_IRRIG_ID))
 
-        """ Used same model as Template Sensor """
-        entity_ids = set()
-        invalid_templates = []
-
-        template = program.get(ATTR_TEMPLATE)
-
-        if template is None:
+        if program.get(ATTR_TEMPLATE) is None:
           continue
-        template.hass = hass
-
-        template_entity_ids = template.extract_entities()
-        if template_entity_ids == MATCH_ALL:
-          entity_ids = MATCH_ALL
-          # Cut off _template from name
-          invalid_templates.append(tpl_name[:-9])
-        elif entity_ids != MATCH_ALL:
-          entity_ids |= set(template_entity_ids)
-
-        if invalid_templates:
-            _LOGGER.warning(
-                'Irrigation %s has no entity ids configured to track nor'
-                ' were we able to extract the entities to track from the %s '
-                'template.'
-                'manually.', device, ', '.join(invalid_templates))
-
-        entity_ids = list(entity_ids)
 
         p_entity = ENTITY_ID_FORMAT.format(y_irrigation_id)
-        entities.append(Irrigation(p_entity,
-                                   program,
-                                   entity_ids,
-                                   component))
+        program_configs[p_entity] = program
+        program_keys[p_entity] = config_key(program)
+        if not schedule_lazily(p_entity, program):
+            resident.append(p_entity)
 
     for zone in conf.get(ATTR_ZONES):
         y_irrigation_id = cv.slugify(zone.get(ATTR_IRRIG_ID))
         p_entity = ZONE_ENTITY_ID_FORMAT.format(y_irrigation_id)
-        zoneentities.append(IrrigationZone(p_entity,
-                                           zone))
-
-    await component.async_add_entities(entities)
-    await component.async_add_entities(zoneentities)
+        zone_configs[p_entity] = zone
+        zone_keys[p_entity] = config_key(zone)
+        if table is None or zone.get(ATTR_PINNED):
+            resident.append(p_entity)
+
+    """ group the zone switches by the controller that drives them """
+    controllers = {}
+    for controller in conf.get(ATTR_CONTROLLERS):
+        y_irrigation_id = cv.slugify(controller.get(ATTR_IRRIG_ID))
+        controllers[y_irrigation_id] = Controller(
+            hass, controller.get(ATTR_IRRIG_ID),
+            controller.get(ATTR_AVAILABILITY_ENTITY),
+            controller.get(ATTR_MAX_COMMANDS),
+            controller.get(ATTR_UNAVAILABLE))
+    for y_irrigation_id, controller in controllers.items():
+        commander.add_controller(controller)
+    for zone in conf.get(ATTR_ZONES):
+        assign_controller(zone)
+    controllerentities = []
+    for y_irrigation_id, controller in controllers.items():
+        controllerentities.append(IrrigationController(
+            CONTROLLER_ENTITY_ID_FORMAT.format(y_irrigation_id),
+            controller, commander, queue, async_find_program))
+    if master is not None:
+        controllerentities.append(IrrigationMaster(
+            MASTER_ENTITY_ID_FORMAT.format(
+                master.switch.split('.', 1)[1]), master))
+
+    """ index the entities once for the service handlers """
+    programs = {}
+    zones    = {}
+    await async_materialise(resident)
+    await component.async_add_entities(controllerentities)
+    diagnostics.programs = programs
+    diagnostics.zones    = zones
+    flow.zones = zones
+    flow.on_anomaly = lambda: async_stop_program_service(None)
+
+    if hass.state == CoreState.running:
+        hass.async_create_task(async_resume_runs(None))
+    else:
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_START,
+                                   async_resume_runs)
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_flush_journal)
 
     """ define services """
     hass.services.async_register(DOMAIN,
@@ -252,69 +817,216 @@ async def async_setup(hass, config):
     hass.services.async_register(DOMAIN,
                                  'stop_programs',
                                  async_stop_program_service)
+    hass.services.async_register(DOMAIN,
+                                 'dump_stats',
+                                 async_dump_stats_service)
+    hass.services.async_register(DOMAIN,
+                                 'profile_program',
+                                 async_profile_program_service)
+    hass.services.async_register(DOMAIN,
+                                 'reload',
+                                 async_reload_service)
+    hass.services.async_register(DOMAIN,
+                                 'export',
+                                 async_export_service)
 
     return True
 
 
+def program_template(hass, program, analyser):
+    """ the cached program template and the entities it tracks, None
+        when the program has no template """
+    y_irrigation_id = cv.slugify(program.get(ATTR_IRRIG_ID))
+
+    template = program.get(ATTR_TEMPLATE)
+
+    if template is None:
+      return None
+    template.hass = hass
+
+    """ the entities were extracted with every other template """
+    analysis = analyser.get(ENTITY_ID_FORMAT.format(y_irrigation_id),
+                            template.template)
+    if analysis.entities == MATCH_ALL:
+        _LOGGER.warning(
+            'Irrigation %s has no entity ids configured to track nor'
+            ' were we able to extract the entities to track from the '
+            'template.', y_irrigation_id)
+
+    return CachedTemplate(hass, template, analysis)
+
+
+def service_date(data, field):
+    """ a date given to a service, None when it was not given """
+    value = data.get(field)
+    if value is None:
+        return None
+    day = dt_util.parse_date(str(value))
+    if day is None:
+        raise ValueError(value)
+    return day
+
+
+def options_key(conf):
+    """ the configuration other than the programs and zones """
+    return config_key({key:value for key, value in conf.items()
+                       if key not in (ATTR_PROGRAMS, ATTR_ZONES)})
+
+
+def history_attributes(history, entity_id):
+    """ the minutes and litres delivered over the last seven days """
+    if history is None:
+        return {}
+    now = dt_util.utcnow()
+    minutes, litres = history.totals(entity_id,
+                                     (now - HISTORY_WINDOW).timestamp(),
+                                     now.timestamp() + 1)
+    return {ATTR_MINUTES_WEEK:round(minutes, 1),
+            ATTR_LITRES_WEEK:round(litres, 1)}
+
+
 class Irrigation(RestoreEntity):
     """Representation of an Irrigation program."""
 
-    def __init__(self, irrigation_id, attributes, entity_ids, component):
+    def __init__(self, irrigation_id, attributes, template, component,
+                 queue, table=None):
         """Initialize a Irrigation program."""
         self.entity_id   = irrigation_id
-        self._attributes = attributes
         self._component  = component
-        self._name       = attributes.get(ATTR_NAME)
-        self._zones      = attributes.get(ATTR_ZONES)
-        self._entities   = entity_ids
+        self._queue      = queue
+        self._table      = table
+        self._entities   = template.entities
         self._stop = False
         """ default to today for new programs """
         now            = dt_util.utcnow()
         time_date      = dt_util.start_of_local_day(dt_util.as_local(now))
-        self._last_run = dt_util.as_local(time_date).date().isoformat()
-        self._template = attributes.get(ATTR_TEMPLATE)
+        self._set_last_run(dt_util.as_local(time_date).date())
+        self._template = template
         self._running  = False
         self._running_zone = None
         self._state_attributes = {'days_since':self._last_run}
-        self._eval_zones = True
-        self._run_program = None
+        self._configure(attributes)
+        self._tracking = None
+        self._deferral = None
+        self._decisions = deque(maxlen=DECISIONS_KEPT)
+        self._next_runs = []
+        self._timeline  = []
+        self._transitions = deque(maxlen=TRANSITIONS_KEPT)
+        self._profile_path = None
+        self._active_zones = []
+        self._run_attributes = {}
+        self._journal  = None
+        self._history  = None
+        self._et       = None
+        self._forecast = None
+        self._delivered = [0.0, 0.0]
+
+
+    def _configure(self, attributes):
+        """ the settings taken from the program configuration """
+        self._attributes = attributes
+        self._name       = attributes.get(ATTR_NAME)
+        self._zones      = attributes.get(ATTR_ZONES)
+        self._max_concurrent = attributes.get(ATTR_MAX_CONCURRENT)
+        self._flow_limit = attributes.get(ATTR_FLOW_LIMIT)
+        self._priority = attributes.get(ATTR_PRIORITY,0)
+        self._recheck  = attributes.get(ATTR_RECHECK,False)
+        self._interleave = attributes.get(ATTR_INTERLEAVE,False)
+        self._transition = attributes.get(ATTR_TRANSITION,TRANSITION_GAP)
+        self._transition_time = attributes.get(ATTR_TRANSITION_TIME,0) / 1000
+        self._use_forecast = attributes.get(ATTR_FORECAST,True)
+
+
+    @callback
+    def async_update_config(self, attributes, template=None):
+        """ apply a reloaded configuration, the template is given only
+            when it changed and its tracking is then replaced. A running
+            program finishes the zones it was started with """
+        self._configure(attributes)
+        if template is not None:
+            self._async_stop_tracking()
+            self._template = template
+            self._entities = template.entities
+            self._async_start_tracking()
+        elif self._template.time_trigger is not None:
+            """ the trigger may have moved to or from the schedule table """
+            self._async_stop_tracking()
+            self._async_schedule_trigger()
+        self.async_schedule_update_ha_state(True)
 
 
     async def async_added_to_hass(self):
 
         """ Run when entity about to be added."""
         await super().async_added_to_hass()
+        self._journal = self.hass.data.get(DOMAIN, {}).get(DATA_JOURNAL)
+        self._history = self.hass.data.get(DOMAIN, {}).get(DATA_HISTORY)
+        self._et = self.hass.data.get(DOMAIN, {}).get(DATA_ET)
+        self._forecast = self.hass.data.get(DOMAIN, {}).get(DATA_FORECAST)
+        if self._history:
+            await self._history.async_load(self.entity_id)
         state = await self.async_get_last_state()
 
         if state:
             """ handle bad data or new entity"""
-            if not cv.date(state.state):
+            try:
+                self._set_last_run(cv.date(state.state))
+            except vol.Invalid:
                 now = dt_util.utcnow()
                 time_date = dt_util.start_of_local_day(dt_util.as_local(now))
-                self._last_run = dt_util.as_local(time_date).date().isoformat()
-            else:
-                self._last_run = state.state
+                self._set_last_run(dt_util.as_local(time_date).date())
+        if self.scheduled and self._table.last_run(self.entity_id):
+            self._set_last_run(self._table.last_run(self.entity_id))
 
         self.async_schedule_update_ha_state(True)
 
         """Register callbacks. From Template same model as template sensor"""
-        @callback
-        def template_sensor_state_listener(entity, old_state, new_state):
-            """Handle device state changes."""
-            self.async_schedule_update_ha_state(True)
-
         @callback
         def template_sensor_startup(event):
             """Update template on startup."""
-            if self._entities != MATCH_ALL:
-                # Track state change only for valid templates
-                async_track_state_change(
-                    self.hass, self._entities, template_sensor_state_listener)
+            self._async_start_tracking()
+
+        if self.hass.state == CoreState.running:
+            """ added by a reload """
+            self._async_start_tracking()
+        else:
+            self.hass.bus.async_listen_once(
+                EVENT_HOMEASSISTANT_START, template_sensor_startup)
 
-            self.async_schedule_update_ha_state(True)
 
-        self.hass.bus.async_listen_once(
-            EVENT_HOMEASSISTANT_START, template_sensor_startup)
+    async def async_will_remove_from_hass(self):
+        """ removed by a reload """
+        self._async_stop_tracking()
+        if self._deferral is not None:
+            self._deferral()
+            self._deferral = None
+
+
+    @callback
+    def _async_start_tracking(self):
+        if self._template.time_trigger is not None:
+            """ a single callback at the trigger time replaces
+                rendering the template whenever sensor.time changes """
+            self._async_schedule_trigger()
+        elif self._entities != MATCH_ALL:
+            # Track state change only for valid templates
+            self._tracking = async_track_state_change(
+                self.hass, self._entities, self._template_state_listener)
+
+        self.async_schedule_update_ha_state(True)
+
+
+    @callback
+    def _async_stop_tracking(self):
+        if self._tracking is not None:
+            self._tracking()
+            self._tracking = None
+
+
+    @callback
+    def _template_state_listener(self, entity, old_state, new_state):
+        """Handle device state changes."""
+        self.async_schedule_update_ha_state(True)
 
 
     @property
@@ -356,77 +1068,524 @@ class Irrigation(RestoreEntity):
         """Return the state attributes.
         Implemented by component base class.
         """
-        return self._state_attributes
+        attrs = dict(self._state_attributes)
+        attrs.update(self._run_attributes)
+        attrs[ATTR_QUEUE_DEPTH] = self._queue.depth
+        attrs[ATTR_QUEUED] = self._queue.waiting(self)
+        attrs[ATTR_RENDER_COUNT] = self._template.renders
+        attrs[ATTR_RENDER_TIME] = round(self._template.render_time * 1000, 3)
+        if self._transitions:
+            attrs[ATTR_TRANSITIONS] = list(self._transitions)
+        if self._decisions:
+            attrs[ATTR_FORECAST_DECISIONS] = list(self._decisions)
+        if self._template.time_trigger is not None:
+            attrs[ATTR_NEXT_RUNS] = [when.isoformat()
+                                     for when in self._next_runs]
+            attrs[ATTR_TIMELINE] = self._timeline
+        return attrs
+
+
+    @property
+    def zones(self):
+        """Return the zones run by the program."""
+        return self._zones
+
+
+    @property
+    def scheduled(self):
+        """True when the schedule table triggers the program."""
+        return self._table is not None and self.entity_id in self._table
+
+
+    @property
+    def idle(self):
+        """True when the program is not running, queued or deferred."""
+        return (not self._running and self._deferral is None
+                and self._queue.waiting(self) is None)
+
+
+    @property
+    def template(self):
+        """Return the cached program template."""
+        return self._template
+
+
+    @property
+    def priority(self):
+        """Return the priority of the program in the run queue."""
+        return self._priority
+
+
+    @property
+    def can_merge(self):
+        """Zones can be added to a running sequential program."""
+        return not self._packed
+
+
+    @property
+    def _packed(self):
+        """ zones are packed into a schedule rather than run in turn """
+        return bool(self._max_concurrent or self._flow_limit
+                    or self._interleave)
+
+
+    def _set_last_run(self, date):
+        """ keep the parsed date so days_since is not parsed each update """
+        self._last_run_date = date
+        self._last_run = date.isoformat()
 
 
     @asyncio.coroutine
     async def async_update(self):
         """ update the days since attribute """
-        a = datetime.now()
-        b = datetime.fromisoformat(self._last_run + " 00:00:00")
-        d = a - b
+        d = datetime.now().date() - self._last_run_date
         ATTRS = {'days_since':d.days}
+        ATTRS.update(history_attributes(self._history, self.entity_id))
         setattr(self, '_state_attributes', ATTRS)
 
-        """ assess the template """
-        if self._template is not None:
-            self._template.hass = self.hass
-            try:
-                evaluated = self._template.async_render()
-                """ if evaluates to true """
-            except:
-                _LOGGER.error('Program template %s, invalid: %s',
-                              self._name,
-                              self._template)
-                return
+        """ programs with a trigger time are assessed when it fires """
+        if self._template.time_trigger is not None:
+            return
 
-        if evaluated == 'False' and self._run_program == None:
+        """ assess the template """
+        try:
+            evaluated = self._template.async_render()
+            """ if evaluates to true """
+        except:
+            _LOGGER.error('Program template %s, invalid: %s',
+                          self._name,
+                          self._template.template)
             return
 
         if evaluated == 'True':
-            _LOGGER.error('%s evaluated true',self.name)
-            now            = dt_util.utcnow()
-            time_date      = dt_util.start_of_local_day(dt_util.as_local(now))
-            self._last_run = dt_util.as_local(time_date).date().isoformat()
+            await self.async_triggered()
+
+
+    @callback
+    def _async_schedule_trigger(self):
+        """ a timer for the next predicted run, the prediction meets the
+            weekday and days_since terms so they are not rendered """
+        self._update_predictions()
+        if self._next_runs and not self.scheduled:
+            self._tracking = async_track_point_in_time(
+                self.hass, self._async_time_trigger, self._next_runs[0])
+
+
+    def _update_predictions(self):
+        """ the next run times and the zone phases of the first """
+        hour, minute = self._template.time_trigger
+        now = dt_util.now()
+        first = now.date()
+        if (hour, minute) <= (now.hour, now.minute):
+            first += timedelta(days=1)
+        dates = next_run_dates(first, self._template.weekdays,
+                               self._template.days_since,
+                               self._last_run_date, NEXT_RUNS)
+        self._next_runs = run_times(dates, hour, minute,
+                                    dt_util.DEFAULT_TIME_ZONE)
+        self._timeline = []
+        if self._next_runs:
+            self._timeline = self._timeline_from(self._next_runs[0])
+
+
+    def _timeline_from(self, start):
+        """ the water phases of a run starting at start, from the zones'
+            settings today without assessing their templates """
+        runs = []
+        for zone in self._zones:
+            entity, DATA = self._zone_run_data(zone, False)
+            if entity is None:
+                continue
+            run = entity.async_resolve(DATA)
+            if run.water:
+                runs.append(run)
+        timeline = []
+        for zone, intervals in self._plan(runs).items():
+            for begin, end in intervals:
+                timeline.append({
+                    ATTR_ZONE:zone,
+                    'start':(start + timedelta(seconds=begin)).isoformat(),
+                    'end':(start + timedelta(seconds=end)).isoformat()})
+        timeline.sort(key=lambda phase: phase['start'])
+        return timeline
+
+
+    async def _async_time_trigger(self, now):
+        """ the trigger time has arrived, assess the rest of the
+            template and schedule the next predicted run """
+        self._tracking = None
+        if self.scheduled:
+            return
+        try:
+            evaluated = self._template.async_render_trigger()
+        except:
+            _LOGGER.error('Program template %s, invalid: %s',
+                          self._name,
+                          self._template.template)
+            evaluated = None
+
+        try:
+            if evaluated == 'True':
+                await self.async_triggered()
+        finally:
+            """ the run has set the last run the next one counts from """
+            self._async_schedule_trigger()
+            self.async_schedule_update_ha_state(True)
+
+
+    async def async_triggered(self):
+        """ the template evaluated true, start the program """
+        _LOGGER.error('%s evaluated true',self.name)
+        now            = dt_util.utcnow()
+        time_date      = dt_util.start_of_local_day(dt_util.as_local(now))
+        self._set_last_run(dt_util.as_local(time_date).date())
+        if self._table is not None:
+            self._table.set_last_run(self.entity_id, self._last_run_date)
+
+        if self._deferral is not None:
+            _LOGGER.info('%s is deferred for rain', self.entity_id)
+            return
+        await self._async_submit_triggered(True)
+
+
+    async def _async_submit_triggered(self, allow_defer):
+        """ one forecast decision covers every zone of the run, then
+            the run queue starts the zones in its own task so the entity
+            update is not held for the length of the program """
+        scale = 1.0
+        if self._forecast is not None and self._use_forecast:
+            decision = self._forecast.decide(allow_defer)
+            self._record_decision(decision)
+            if decision.action == ACTION_SKIP:
+                if self._history:
+                    now = dt_util.utcnow().timestamp()
+                    self._history.async_record(self.entity_id, now, now,
+                                               reason=REASON_FORECAST)
+                return
+            if decision.action == ACTION_DEFER:
+                self._deferral = async_call_later(
+                    self.hass,
+                    max(0, decision.until - dt_util.utcnow().timestamp()),
+                    self._async_deferred_run)
+                return
+            scale = decision.scale
+        await self._queue.async_submit(self, True, scale=scale)
+
+
+    async def _async_deferred_run(self, now):
+        """ the rain the run was deferred for has passed, decide again
+            without deferring a second time """
+        self._deferral = None
+        await self._async_submit_triggered(False)
+        self._queue.async_check_idle()
+
+
+    @callback
+    def _record_decision(self, decision):
+        record = {'time':dt_util.utcnow().isoformat(),
+                  'action':decision.action,
+                  'rain':decision.rain,
+                  ATTR_SCALE:decision.scale}
+        if decision.until is not None:
+            record['until'] = dt_util.utc_from_timestamp(
+                decision.until).isoformat()
+        self._decisions.append(record)
+        _LOGGER.info('%s forecast %s, %s mm of rain expected',
+                     self.entity_id, decision.action, decision.rain)
+        self.async_schedule_update_ha_state()
+
+
+    async def async_run_sequence(self, request):
+        """ run the program, under the profiler when one was asked for """
+        if self._profile_path is None:
+            return await self._async_run_sequence(request)
+        path, self._profile_path = self._profile_path, None
+        with RunProfiler(self.hass, path):
+            await self._async_run_sequence(request)
 
+
+    async def _async_run_sequence(self, request):
+        """ run each zone in turn, starting the next zone as soon as
+            the previous run returns rather than polling its state """
         self._stop = False
         self._running = True
+        self._delivered = [0.0, 0.0]
+        started = dt_util.utcnow().timestamp()
 
-        """ Iterate through all the defined zones """
-        for zone in self._zones:
-            if self._stop == True:
-                break
+        entities, runs, plan = await self._async_plan(request)
+        if self._journal:
+            self._journal.program_start(self.entity_id, list(entities))
+
+        if self._packed:
+            await self.async_run_parallel(request, entities, runs, plan)
+        else:
+            """ Iterate through the zones, zones merged from another
+                program are appended while the sequence runs """
+            overlap = (self._transition == TRANSITION_OVERLAP)
+            previous = None
+            while request.zones:
+                if self._stop == True:
+                    break
+
+                y_zone = request.zones[0].get(ATTR_ZONE)
+                perform_eval = request.perform_eval and (
+                    self._recheck or y_zone not in entities)
+                entity, DATA = self._zone_run_data(request.zones[0],
+                                                   perform_eval,
+                                                   request.scale)
+                if entity is not None and not entity.controller_available:
+                    """ the controller dropped out during the program,
+                        carry on with the other zones """
+                    self._async_unavailable(entity, request.zones[0])
+                elif entity is not None:
+                    self._running_zone = entity.name
+                    self._active_zones = [entity]
+                    if previous is not None and previous.holding:
+                        self._active_zones.append(previous)
+                    self.async_schedule_update_ha_state()
+                    if previous is not None and not overlap:
+                        await self._async_gap(previous)
+                    on_open = self._handover(previous, entity)
+
+                    """ the zone run completes when watering finishes or
+                        the zone is stopped """
+                    if y_zone in request.resume:
+                        origin, intervals = request.resume.pop(y_zone)
+                        completed = await entity.async_run_schedule(
+                            origin, intervals, self.entity_id,
+                            overlap, on_open)
+                    else:
+                        completed = await entity.async_run_zone(
+                            DATA, self.entity_id, overlap, on_open)
+                    self._add_delivered(entity)
+                    if entity.interrupted:
+                        self._async_unavailable(entity, request.zones[0],
+                                                False)
+                    if entity.opened_at is not None:
+                        previous = entity
 
-            y_water    = int(zone.get(ATTR_WATER,0))
-            y_wait     = int(zone.get(ATTR_WAIT,0))
-            y_repeat   = int(zone.get(ATTR_REPEAT,1))
-            y_zone     = zone.get(ATTR_ZONE)
-
-            DATA = {CONST_ENTITY:y_zone,
-                    ATTR_WATER:y_water,
-                    ATTR_WAIT:y_wait,
-                    ATTR_REPEAT:y_repeat,
-                    ATTR_EVAL:self._eval_zones}
-            await self.hass.services.async_call(DOMAIN,
-                                                'run_zone',
-                                                DATA)
-
-            entity = self._component.get_entity(y_zone)
-            self._running_zone = entity.name
-            self.async_schedule_update_ha_state()
-
-            """ wait for the state to take """
-            step = 1
-            await asyncio.sleep(step)
-            """ monitor the zone state """
-            while entity.state != STATE_OFF:
-                await asyncio.sleep(step)
                 if self._stop == True:
                     break
+                request.zones.pop(0)
+
+            """ zones merged from now on would not run, they are queued """
+            request.accepting = False
+            if previous is not None and previous.holding:
+                """ no zone followed the last one held open """
+                await previous.async_release()
+
+        if self._journal and not request.preempted:
+            self._journal.program_end(self.entity_id)
+        if self._history:
+            if not entities:
+                reason = REASON_TEMPLATE
+            elif self._stop:
+                reason = REASON_STOPPED
+            else:
+                reason = REASON_WATERED
+            self._history.async_record(self.entity_id, started,
+                                       dt_util.utcnow().timestamp(),
+                                       *self._delivered, reason)
+            self._state_attributes.update(
+                history_attributes(self._history, self.entity_id))
+
+        self._running      = False
+        self._active_zones = []
+        self.async_schedule_update_ha_state()
+
+
+    async def _async_plan(self, request):
+        """ assess every zone template at the start of the run, zones
+            that will not water are removed from the request """
+        zones    = []
+        runs     = []
+        entities = {}
+        planned  = list(request.zones)
+        for zone in planned:
+            entity, DATA = self._zone_run_data(zone, request.perform_eval,
+                                               request.scale)
+            if entity is None or entity.entity_id in entities:
+                continue
+            if not entity.controller_available:
+                self._async_unavailable(entity, zone)
+                continue
+            if request.perform_eval and not await entity.async_evaluate():
+                entity.async_record_skip(REASON_TEMPLATE)
+                continue
+            run = entity.async_resolve(DATA)
+            if not run.water:
+                entity.async_record_skip(REASON_RAIN)
+                continue
+            zones.append(zone)
+            runs.append(run)
+            entities[entity.entity_id] = entity
+        """ zones merged while the plan was made are assessed as they
+            start """
+        request.zones[:] = zones + request.zones[len(planned):]
+        if self._et is not None and self._et.available:
+            et0 = self._et.et0()
+            self._run_attributes[ATTR_REFERENCE_ET] = (
+                round(et0, 2) if et0 is not None else None)
+
+        plan = self._plan(runs)
+        self._run_attributes[ATTR_PLAN] = [
+            {ATTR_ZONE:zone, 'start':intervals[0][0], 'end':intervals[-1][1]}
+            for zone, intervals in plan.items()]
+        self._run_attributes[ATTR_PROJECTED_DURATION] = makespan(plan)
+        self.async_schedule_update_ha_state()
+        return entities, runs, plan
+
+
+    def _plan(self, runs):
+        if self._packed:
+            """ an interleaved program still opens one valve at a time,
+                other zones water during a zone's Eco wait """
+            max_concurrent = self._max_concurrent
+            if not (max_concurrent or self._flow_limit):
+                max_concurrent = 1
+            return parallel_plan(runs, max_concurrent, self._flow_limit)
+        return sequential_plan(runs)
+
+
+    async def async_run_parallel(self, request, entities, runs, plan):
+        """ run the zones packed within the supply limits together """
+        self._run_attributes[ATTR_PLANNED_MAKESPAN] = makespan(plan)
+        self._run_attributes[ATTR_SEQUENTIAL_MAKESPAN] = makespan(
+            sequential_plan(runs))
+        self._running_zone = ', '.join(
+            entity.name for entity in entities.values())
+        self._active_zones = list(entities.values())
+        self.async_schedule_update_ha_state()
+
+        if self._stop == True:
+            return
+        origin = self.hass.loop.time()
+        schedules = {zone:(origin, intervals)
+                     for zone, intervals in plan.items()}
+        if request.resume:
+            """ a resumed run keeps the schedules it started with """
+            schedules = {zone:request.resume[zone] for zone in plan
+                         if zone in request.resume}
+            request.resume = {}
+        completed = await asyncio.gather(*[
+            entities[zone].async_run_schedule(origin, intervals,
+                                              self.entity_id)
+            for zone, (origin, intervals) in schedules.items()])
+        finished = set()
+        for zone, done in zip(schedules, completed):
+            entity = entities[zone]
+            self._add_delivered(entity)
+            if entity.interrupted:
+                """ a deferred zone is not kept for a preempted run """
+                self._async_unavailable(entity, next(
+                    (run for run in request.zones
+                     if run.get(ATTR_ZONE) == zone), {ATTR_ZONE:zone}), False)
+                finished.add(zone)
+            elif done:
+                finished.add(zone)
+
+        """ keep the zones that did not finish for a preempted run """
+        request.zones[:] = [zone for zone in request.zones
+                            if zone.get(ATTR_ZONE) not in finished]
+
+
+    async def _async_gap(self, previous):
+        """ hold the next valve closed until the gap has passed since
+            the previous valve closed, timed on the loop clock """
+        if previous.closed_at is None or not self._transition_time:
+            return
+        delay = previous.closed_at + self._transition_time \
+            - self.hass.loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+    def _handover(self, previous, entity):
+        """ the callback run when the next zone's valve opens, it
+            closes a valve held open and records the transition """
+        if previous is None:
+            return None
+
+        async def async_close_previous():
+            await previous.async_release()
+            self._record_transition(previous, entity)
+
+        @callback
+        def on_open():
+            if previous.holding:
+                self.hass.loop.call_later(
+                    self._transition_time,
+                    lambda: self.hass.async_create_task(
+                        async_close_previous()))
+            else:
+                self._record_transition(previous, entity)
+        return on_open
+
+
+    @callback
+    def _record_transition(self, previous, entity):
+        """ milliseconds from the previous valve closing to the next
+            opening, negative when the valves overlapped """
+        if previous.closed_at is None or entity.opened_at is None:
+            return
+        self._transitions.append(
+            round((entity.opened_at - previous.closed_at) * 1000))
+        self.async_schedule_update_ha_state()
+
+
+    @callback
+    def _async_unavailable(self, entity, zone, record=True):
+        """ skip a zone whose controller is unavailable, holding it to
+            run later when the controller reschedules. A zone that was
+            running has recorded its run already """
+        controller = entity.controller
+        if controller.unavailable == UNAVAILABLE_RESCHEDULE:
+            _LOGGER.warning('%s deferred, controller %s is unavailable',
+                            entity.entity_id, controller.name)
+            controller.defer(self.entity_id, zone)
+        else:
+            _LOGGER.warning('%s skipped, controller %s is unavailable',
+                            entity.entity_id, controller.name)
+        if record:
+            entity.async_record_skip(REASON_UNAVAILABLE)
+
+
+    def _add_delivered(self, entity):
+        minutes, litres = entity.delivered
+        self._delivered[0] += minutes
+        self._delivered[1] += litres
+
+
+    @callback
+    def async_queue_wait(self, seconds):
+        """ record how long the run waited in the queue """
+        self._run_attributes[ATTR_QUEUE_WAIT] = round(seconds)
+
+
+    async def async_preempt(self):
+        """ stop the program and the zones it is running """
+        await self.async_stop_program()
+        await asyncio.gather(*[zone.async_stop_zone()
+                               for zone in self._active_zones])
+
+
+    def _zone_run_data(self, zone, perform_eval, scale=1.0):
+        y_water    = int(zone.get(ATTR_WATER,0))
+        y_wait     = int(zone.get(ATTR_WAIT,0))
+        y_repeat   = int(zone.get(ATTR_REPEAT,1))
+        y_zone     = zone.get(ATTR_ZONE)
 
-        self._running     = False
-        self._run_program = None
-        self._eval_zones  = True
+        entity = self._component.get_entity(y_zone)
+        if entity is None:
+            _LOGGER.error('irrigation_zone not found: %s', y_zone)
+            return None, None
+
+        DATA = {ATTR_WATER:y_water,
+                ATTR_WAIT:y_wait,
+                ATTR_REPEAT:y_repeat,
+                ATTR_EVAL:perform_eval,
+                ATTR_SCALE:scale}
+        return entity, DATA
 
     @asyncio.coroutine
     async def async_stop_program(self):
@@ -435,47 +1594,127 @@ class Irrigation(RestoreEntity):
         self.async_schedule_update_ha_state()
 
 
+    async def async_profile(self, path):
+        """ profile the next run of the program from start to end """
+        self._profile_path = path
+        await self.async_run_program(False)
+
+
     @asyncio.coroutine
     async def async_run_program(self, perform_eval):
-        self._run_program = True
-        self._eval_zones = perform_eval
+        await self._queue.async_submit(self, perform_eval)
         self.async_schedule_update_ha_state(True)
 
 
 class IrrigationZone(Entity):
     """Representation of an Irrigation zone."""
 
-    def __init__(self, irrigation_id, attributes):
+    def __init__(self, irrigation_id, attributes, options):
 
         """Initialize a Irrigation program."""
         self.entity_id   = irrigation_id
+        self._configure(attributes, options)
+        self._state      = STATE_OFF
+        self._icon       = self._icon_off
+        self._new_state  = STATE_OFF
+        self._stop       = False
+        self._et         = None
+        self._run_end    = None
+        self._end_time   = None
+        self._timer      = None
+        self._pending_config = None
+        self._publish_handle = None
+        self._state_writes = 0
+        self._projected_time = None
+        self._actual_time = None
+        self._opened_at  = None
+        self._closed_at  = None
+        self._holding    = False
+        self._publish_wakeups = 0
+        self._phase_lag  = [0, 0.0, 0.0]
+        self._commander  = None
+        self._journal    = None
+        self._history    = None
+        self._history_attributes = {}
+        self._delivered  = (0.0, 0.0)
+        self._flow_monitor = None
+        self._flow_rate  = None
+        self._metered    = None
+        self._volume_target = None
+        self._water_started = None
+        self._master     = None
+        self._supplied   = False
+        self._interrupted = False
+
+    def _configure(self, attributes, options):
+        """ the settings taken from the zone configuration """
         self._name       = attributes.get(ATTR_NAME)
         self._switch     = attributes.get(ATTR_SWITCH)
         self._water      = int(attributes.get(ATTR_WATER))
         self._wait       = int(attributes.get(ATTR_WAIT,0))
         self._repeat     = int(attributes.get(ATTR_REPEAT,1))
-        self._state      = STATE_OFF
         self._icon_water = attributes.get(ATTR_ICON_WATER,
                                           DFLT_ICON_WATER)
         self._icon_wait  = attributes.get(ATTR_ICON_WAIT,
                                           DFLT_ICON_WAIT)
         self._icon_off   = attributes.get(ATTR_ICON_OFF,
                                           DFLT_ICON_OFF)
-        self._icon       = self._icon_off
-        self._new_state  = STATE_OFF
-        self._stop       = False
         self._template   = attributes.get(ATTR_TEMPLATE)
-        self._runtime    = 0
-        self._state_attributes = {ATTR_REMAINING:self._runtime}
+        self._flow       = attributes.get(ATTR_FLOW)
+        self._crop_coefficient = attributes.get(ATTR_CROP_COEFFICIENT,1.0)
+        self._precipitation_rate = attributes.get(ATTR_PRECIPITATION_RATE)
+        self._infiltration_rate = attributes.get(ATTR_INFILTRATION_RATE)
+        self._flow_sensor = attributes.get(ATTR_FLOW_SENSOR)
+        self._pulses_per_litre = attributes.get(ATTR_PULSES_PER_LITRE)
+        self._volume     = attributes.get(ATTR_VOLUME)
+        self._publish    = options.get(ATTR_PUBLISH,PUBLISH_INTERVAL)
+        self._publish_interval = options.get(ATTR_PUBLISH_INTERVAL,
+                                             DFLT_PUBLISH_INTERVAL)
+
+    @callback
+    def async_update_config(self, attributes, options):
+        """ apply a reloaded configuration, a running zone finishes its
+            run, and keeps its switch, before the new settings apply """
+        self._pending_config = (attributes, options)
+        if not self.running:
+            self._apply_pending_config()
+
+    @callback
+    def _apply_pending_config(self):
+        if self._pending_config is None:
+            return
+        self._configure(*self._pending_config)
+        self._pending_config = None
+        if self._flow_monitor is not None:
+            self._flow_monitor.add_zone(self)
+        self.async_publish(True)
 
     async def async_added_to_hass(self):
         await super().async_added_to_hass()
 
-        """ house keeping to help ensure solenoids are in a safe state """
-        self.hass.bus.async_listen_once(
-            EVENT_HOMEASSISTANT_START, self.async_stop_switch())
+        self._timer = PhaseTimer(self.hass.loop)
+        self._idle  = asyncio.Event()
+        self._idle.set()
+        self._journal = self.hass.data.get(DOMAIN, {}).get(DATA_JOURNAL)
+        self._history = self.hass.data.get(DOMAIN, {}).get(DATA_HISTORY)
+        self._et = self.hass.data.get(DOMAIN, {}).get(DATA_ET)
+        self._commander = self.hass.data.get(DOMAIN, {}).get(DATA_SWITCHES)
+        self._flow_monitor = self.hass.data.get(DOMAIN, {}).get(DATA_FLOW)
+        self._master = self.hass.data.get(DOMAIN, {}).get(DATA_MASTER)
+        if self._flow_monitor is not None:
+            self._flow_monitor.add_zone(self)
+        if self._history:
+            await self._history.async_load(self.entity_id)
+            self._history_attributes = history_attributes(self._history,
+                                                          self.entity_id)
         return True
-    
+
+    async def async_will_remove_from_hass(self):
+        """ removed by a reload """
+        if self._flow_monitor is not None:
+            self._flow_monitor.remove_zone(self)
+        self._release_master()
+
     @property
     def should_poll(self):
         """If entity should be polled."""
@@ -500,12 +1739,34 @@ class IrrigationZone(Entity):
         return self._state
 
 
+    @property
+    def remaining(self):
+        """Seconds left in the run, taken from the run deadline."""
+        if self._run_end is None:
+            return 0
+        return max(0, int(round(self._run_end - self._timer.now())))
+
+
     @property
     def state_attributes(self):
         """Return the state attributes.
         Implemented by component base class.
         """
-        return self._state_attributes
+        attrs = {ATTR_REMAINING:self.remaining,
+                 ATTR_END_TIME:self._end_time,
+                 ATTR_STATE_WRITES:self._state_writes,
+                 ATTR_PROJECTED_TIME:self._projected_time,
+                 ATTR_ACTUAL_TIME:self._actual_time}
+        attrs.update(self._history_attributes)
+        if self._commander is not None:
+            stats = self._commander.stats_for(self._switch)
+            attrs[ATTR_SWITCH_COMMANDS] = stats.as_dict()
+            attrs[ATTR_SWITCH_LATENCY] = stats.histogram
+        if self.metered:
+            attrs[ATTR_FLOW_RATE] = self._flow_rate
+            attrs[ATTR_METERED] = round(self._metered or 0, 1)
+            attrs[ATTR_FLOW_BASELINE] = self._flow_monitor.baseline(self)
+        return attrs
 
 
     async def async_update(self):
@@ -522,110 +1783,618 @@ class IrrigationZone(Entity):
         setattr(self, '_icon', icon)
 
 
-    @asyncio.coroutine
-    async def async_stop_zone(self):
+    @callback
+    def async_publish(self, force_refresh=False):
+        """ write the zone state, restarting the countdown publisher so
+            a phase change and a periodic update are never both sent """
+        self._state_writes += 1
+        self.async_schedule_update_ha_state(force_refresh)
+        self._schedule_publish()
+
+
+    @callback
+    def _schedule_publish(self):
+        if self._publish_handle is not None:
+            self._publish_handle.cancel()
+            self._publish_handle = None
+
+        if self._run_end is None or self._publish == PUBLISH_PHASE:
+            return
+
+        delay = self._publish_interval
+        if self._publish == PUBLISH_ADAPTIVE:
+            """ publish faster as the run nears its end """
+            delay = min(delay, max(1, self.remaining / 10))
+
+        self._publish_handle = self.hass.loop.call_later(
+            delay, self._async_publish_tick)
+
+
+    @callback
+    def _async_publish_tick(self):
+        self._publish_wakeups += 1
+        self.async_publish()
+
+
+    @property
+    def wakeups(self):
+        """Return the number of times the zone's timers have fired."""
+        timer = self._timer.wakeups if self._timer is not None else 0
+        return timer + self._publish_wakeups
+
+
+    @property
+    def phase_lag(self):
+        """Return the count, total and largest seconds between a
+        planned water phase start and its valve confirming open."""
+        return tuple(self._phase_lag)
+
+
+    @callback
+    def async_halt(self):
+        """ end the run without operating the switch """
         self._stop = True
-        DATA = {ATTR_ENTITY_ID: self._switch}
-        await self.hass.services.async_call(CONST_SWITCH,
-                                            SERVICE_TURN_OFF,
-                                            DATA)
-        self.async_schedule_update_ha_state()
+        if self._timer is not None:
+            self._timer.cancel()
 
 
     @asyncio.coroutine
-    async def async_stop_switch(self):
-        _LOGGER.error('stop switch')
+    async def async_stop_zone(self):
+        self.async_halt()
+        self._holding = False
+        await self._async_switch(False, force=True)
+        self._release_master()
+        self.async_publish()
+
+
+    async def _async_switch(self, on, force=False):
+        """ operate the switch, confirmed and retried when the switch
+            command pipeline is available """
+        if self._commander is not None:
+            return await self._commander.async_turn(self._switch, on, force)
         DATA = {ATTR_ENTITY_ID: self._switch}
-        await self.hass.services.async_call(CONST_SWITCH,
-                                            SERVICE_TURN_OFF,
-                                            DATA)
+        await self.hass.services.async_call(
+            CONST_SWITCH, SERVICE_TURN_ON if on else SERVICE_TURN_OFF, DATA)
+        return True
 
 
-    @asyncio.coroutine
-    async def async_run_zone(self,DATA):
-        step = 1
-        self._stop = False
-        perform_eval = DATA.get(ATTR_EVAL,True)
+    async def _async_acquire_master(self):
+        """ hold the master switch on for the run, returning the seconds
+            waited for it to be ready """
+        if self._master is None or self._supplied:
+            return 0
+        self._supplied = True
+        return await self._master.async_acquire()
+
+
+    @callback
+    def _release_master(self):
+        if self._supplied:
+            self._supplied = False
+            self._master.release()
+
+
+    @property
+    def flow(self):
+        """Return the flow rate of the zone in L/min."""
+        return self._flow
+
+
+    @property
+    def flow_sensor(self):
+        """Return the zone's own flow meter entity, or None."""
+        return self._flow_sensor
+
+
+    @property
+    def pulses_per_litre(self):
+        """Return the pulses per litre of a pulse counting meter."""
+        return self._pulses_per_litre
+
+
+    @property
+    def metered(self):
+        """True when a flow meter can measure the zone."""
+        return (self._flow_monitor is not None
+                and self._flow_monitor.meter_for(self) is not None)
+
+
+    @property
+    def valve_open(self):
+        """True while the zone's valve is open."""
+        return self._new_state == STATE_ON
+
+
+    @property
+    def water_started(self):
+        """Return the loop time the valve last opened, None when closed."""
+        return self._water_started
+
+
+    @callback
+    def async_add_litres(self, litres, rate):
+        """ water measured by the flow meter, the water phase ends once
+            it has delivered its share of the zone volume """
+        self._flow_rate = round(rate, 2)
+        self._metered = (self._metered or 0) + litres
+        if self._volume_reached():
+            self._timer.finish()
+
+
+    def _volume_reached(self):
+        return (self._volume_target is not None
+                and self._metered is not None
+                and self._metered >= self._volume_target)
+
+
+    @property
+    def switch(self):
+        """Return the switch entity operated by the zone."""
+        return self._switch
+
+
+    @property
+    def controller(self):
+        """Return the controller driving the zone switch, or None."""
+        if self._commander is None:
+            return None
+        return self._commander.controller_for(self._switch)
+
+
+    @property
+    def interrupted(self):
+        """True when the last run ended because the controller became
+        unavailable."""
+        return self._interrupted
+
+
+    @property
+    def controller_available(self):
+        """False when the zone's controller is unavailable."""
+        controller = self.controller
+        return controller is None or controller.available
+
+
+    @property
+    def opened_at(self):
+        """Return the loop time the last run first opened the valve."""
+        return self._opened_at
+
+
+    @property
+    def closed_at(self):
+        """Return the loop time the last run closed the valve."""
+        return self._closed_at
+
+
+    @property
+    def holding(self):
+        """Return True while the valve is held open for the next zone."""
+        return self._holding
+
+
+    async def async_release(self):
+        """ close a valve held open after the run finished """
+        if not self._holding:
+            return
+        self._holding = False
+        await self._async_switch(False)
+        self._release_master()
+        self._closed_at = self.hass.loop.time()
+        self._water_started = None
+        self._new_state = STATE_OFF
+        self.async_publish(True)
+        self._apply_pending_config()
+
+
+    @property
+    def running(self):
+        """True while the zone runs or holds its valve open."""
+        return self._run_end is not None or self._holding
+
+
+    async def async_stop_and_wait(self):
+        """ stop the zone and wait for its run to finish """
+        await self.async_stop_zone()
+        await self._idle.wait()
+
+
+    @property
+    def delivered(self):
+        """Return the minutes and litres delivered by the last run."""
+        return self._delivered
+
+
+    @callback
+    def async_record_history(self, start, minutes, reason):
+        """ add the run to the zone history, the metered litres when a
+            meter measured the run """
+        litres = minutes * (self._flow or 0)
+        if self._metered is not None:
+            litres = self._metered
+        self._delivered = (minutes, litres)
+        if self._history is None:
+            return
+        self._history.async_record(self.entity_id, start,
+                                   dt_util.utcnow().timestamp(),
+                                   minutes, litres, reason)
+        self._history_attributes = history_attributes(self._history,
+                                                      self.entity_id)
+
+
+    @callback
+    def async_record_skip(self, reason):
+        """ record a run that did not water """
+        self.async_record_history(dt_util.utcnow().timestamp(), 0.0, reason)
+
+
+    def async_resolve(self, DATA):
+        """ the water/wait/repeat a run will use, in seconds """
         y_water  = int(DATA.get(ATTR_WATER,self._water))
         y_wait   = int(DATA.get(ATTR_WAIT,self._wait))
         y_repeat = int(DATA.get(ATTR_REPEAT,self._repeat))
+        scale    = DATA.get(ATTR_SCALE,1.0)
         if y_water == 0:
             y_water  = self._water
             y_wait   = self._wait
             y_repeat = self._repeat
+            depth = self._depth(y_water * y_repeat)
+            if depth is not None:
+                """ the fewest cycles that apply the depth without
+                    runoff, in seconds """
+                water, wait, repeat = eco_cycles(depth * scale,
+                                                 self._precipitation_rate,
+                                                 self._infiltration_rate)
+                return ZoneRun(self.entity_id, water, wait, max(1, repeat),
+                               self._flow)
+        return ZoneRun(self.entity_id, int(round(y_water * 60 * scale)),
+                       y_wait * 60, y_repeat, self._flow)
+
+
+    def _depth(self, minutes):
+        """ the mm to apply, from today's evapotranspiration or the
+            configured minutes when the soil is described """
+        if not self._precipitation_rate:
+            return None
+        if self._et is not None:
+            depth = self._et.zone_depth(self.entity_id,
+                                        self._crop_coefficient)
+            if depth is not None:
+                return depth
+        if self._infiltration_rate:
+            return minutes / 60 * self._precipitation_rate
+        return None
+
+
+    async def async_evaluate(self):
+        """ assess the zone template, False skips the zone """
+        evaluated = 'True'
+        if self._template is not None:
+            self._template.hass = self.hass
+            try:
+                evaluated = self._template.async_render()
+            except:
+                _LOGGER.error('zone template %s, invalid: %s',
+                                self._name,
+                                self._template)
+                return False
+
+        return evaluated != 'False'
+
+
+    @asyncio.coroutine
+    async def async_run_zone(self,DATA,program=None,keep_open=False,
+                             on_open=None):
+        self._opened_at = None
+        self._closed_at = None
+        run = self.async_resolve(DATA)
+        if not run.water:
+            self.async_record_skip(REASON_RAIN)
+            return
 
         """ assess the template program internally triggered"""
-        if perform_eval:
-            evaluated = 'True'
-            if self._template is not None:
-                self._template.hass = self.hass
-                try:
-                    evaluated = self._template.async_render()
-                except:
-                    _LOGGER.error('zone template %s, invalid: %s',
-                                    self._name,
-                                    self._template)
-                    return
-
-            if evaluated == 'False':
+        if DATA.get(ATTR_EVAL,True):
+            if not await self.async_evaluate():
+                self.async_record_skip(REASON_TEMPLATE)
                 return
 
-        self._runtime = (((y_water + y_wait) * y_repeat) - y_wait) * 60
+        return await self.async_run_schedule(self._timer.now(),
+                                             run_intervals(run),
+                                             program, keep_open, on_open)
+
+
+    async def async_run_schedule(self, origin, intervals, program=None,
+                                 keep_open=False, on_open=None):
+        """ run the water intervals, seconds from origin, the gaps
+            between the intervals are Eco waits. keep_open leaves the
+            valve open at the end for the next zone to close, on_open
+            is called once the valve first opens """
+        self._stop = False
+        self._interrupted = False
+        self._delivered = (0.0, 0.0)
+        self._opened_at = None
+        self._closed_at = None
+
+        """ a resumed schedule skips the intervals already watered """
+        elapsed = self._timer.now() - origin
+        intervals = [(start, end) for start, end in intervals
+                     if end > elapsed]
+        if not intervals:
+            return True
+
+        """ the schedule starts once the master switch is ready """
+        origin += await self._async_acquire_master()
+
+        owner = program or self.entity_id
+        if self._journal:
+            self._journal.zone_start(
+                owner, self.entity_id,
+                dt_util.utcnow().timestamp() - elapsed, intervals)
+
+        """ phase deadlines are fixed from the start of the run so
+            switch latency does not accumulate over the cycles """
+        self._run_end = origin + intervals[-1][1]
+        self._idle.clear()
+        self._end_time = (dt_util.utcnow() +
+                          timedelta(seconds=self.remaining)).isoformat()
+        self._state_writes = 0
+        self._projected_time = round(intervals[-1][1] - intervals[0][0])
+        self._actual_time = None
+        self._metered = None
+        self._flow_rate = None
+        """ a volume is shared between the water phases """
+        share = None
+        if self._volume and self.metered:
+            share = self._volume / len(intervals)
 
         """ run the watering cycle, water/wait/repeat """
-        DATA = {ATTR_ENTITY_ID: self._switch}
-        for i in range(y_repeat, 0, -1):
+        watering = False
+        failed   = False
+        unavailable = False
+        opened   = None
+        first    = None
+        watered  = 0.0
+        started  = dt_util.utcnow().timestamp()
+        last_end = self._timer.now() - origin
+        begun    = last_end
+        for index, (start, end) in enumerate(intervals):
             if self._stop == True:
                 break
 
-            self._new_state = STATE_ON
-            self.async_schedule_update_ha_state(True)
-            DATA = {ATTR_ENTITY_ID: self._switch}
-            await self.hass.services.async_call(CONST_SWITCH,
-                                                SERVICE_TURN_ON,
-                                                DATA)
-
-            water = y_water * 60
-            for w in range(0,water, step):
-                self._runtime = self._runtime - step
-                ATTRS = {ATTR_REMAINING:self._runtime}
-                setattr(self, '_state_attributes', ATTRS)
-                self.async_schedule_update_ha_state()
-                await asyncio.sleep(step)
+            if start > last_end:
+                """ Eco mode is enabled """
+                self._new_state = STATE_ECO
+                self.async_publish(True)
+                if self._journal:
+                    self._journal.phase(owner, self.entity_id, index,
+                                        STATE_ECO)
+                if watering:
+                    watering = False
+                    watered += self._timer.now() - opened
+                    self._water_started = None
+                    await self._async_switch(False)
                 if self._stop == True:
                     break
+                if not await self._timer.async_wait_until(origin + start):
+                    break
 
-            """ turn the switch entity off """
-            if y_wait > 0 and i > 1:
-                if self._stop == True:
+            if not watering:
+                watering = True
+                self._new_state = STATE_ON
+                self.async_publish(True)
+                if self._journal:
+                    self._journal.phase(owner, self.entity_id, index,
+                                        STATE_ON)
+                opened = self._timer.now()
+                if first is None:
+                    first = opened
+                if not await self._async_switch(True):
+                    """ the valve did not confirm open after its retries,
+                        the run fails rather than counting water that
+                        may not have flowed """
+                    watering = False
+                    if self._stop == False:
+                        failed = True
+                        unavailable = not self.controller_available
                     break
-                """ Eco mode is enabled """
-                self._new_state = STATE_ECO
-                self.async_schedule_update_ha_state(True)
-                await self.hass.services.async_call(CONST_SWITCH,
-                                                    SERVICE_TURN_OFF,
-                                                    DATA)
-
-                wait = y_wait * 60
-                for w in range(0,wait, step):
-                    self._runtime = self._runtime - step
-                    ATTRS = {ATTR_REMAINING:self._runtime}
-                    setattr(self, '_state_attributes', ATTRS)
-                    self.async_schedule_update_ha_state()
-                    await asyncio.sleep(step)
-                    if self._stop == True:
-                        break
-
-            if i <= 1:
-                """ last/only cycle """
-                self._new_state = STATE_OFF
-                await self.hass.services.async_call(CONST_SWITCH,
-                                                    SERVICE_TURN_OFF,
-                                                    DATA)
-
-        self._runtime = 0
-        self._new_state = STATE_OFF
-        ATTRS = {ATTR_REMAINING:self._runtime}
-        setattr(self, '_state_attributes', ATTRS)
-        self.async_schedule_update_ha_state(True)
-        return True
\ No newline at end of file
+                self._water_started = self._timer.now()
+                if self._supplied:
+                    self._master.cycle()
+                lag = self._timer.now() - origin - max(start, begun)
+                self._phase_lag[0] += 1
+                self._phase_lag[1] += lag
+                self._phase_lag[2] = max(self._phase_lag[2], lag)
+                if self._opened_at is None:
+                    self._opened_at = self.hass.loop.time()
+                    if on_open is not None:
+                        on_open()
+
+            if self._stop == True:
+                break
+            if share is not None:
+                self._volume_target = (self._metered or 0) + share
+            if not self._volume_reached() and \
+                    not await self._timer.async_wait_until(origin + end):
+                break
+            last_end = end
+
+        self._volume_target = None
+        completed = self._stop == False and not failed
+        if watering:
+            watered += self._timer.now() - opened
+        if first is not None:
+            self._actual_time = round(self._timer.now() - first)
+        self._interrupted = unavailable
+        if unavailable:
+            reason = REASON_UNAVAILABLE
+        elif failed:
+            reason = REASON_FAILED
+        elif completed:
+            reason = REASON_WATERED
+        else:
+            reason = REASON_STOPPED
+        self.async_record_history(started, watered / 60, reason)
+        if watering and completed and keep_open:
+            """ the next zone closes the valve once it has opened """
+            self._holding = True
+        elif watering and completed:
+            """ last/only cycle """
+            await self._async_switch(False)
+            self._closed_at = self.hass.loop.time()
+        elif failed:
+            """ in case the valve opened without confirming it """
+            await self._async_switch(False, force=True)
+            self._closed_at = self.hass.loop.time()
+        if not self._holding:
+            self._water_started = None
+            self._release_master()
+        if self._journal:
+            if completed:
+                self._journal.zone_end(owner, self.entity_id)
+            if program is None:
+                self._journal.program_end(owner)
+
+        self._run_end = None
+        self._end_time = None
+        self._new_state = STATE_ON if self._holding else STATE_OFF
+        self.async_publish(True)
+        self._idle.set()
+        if not self._holding:
+            self._apply_pending_config()
+        return completed
+
+
+class IrrigationController(Entity):
+    """Representation of a controller board driving zone switches."""
+
+    def __init__(self, irrigation_id, controller, commander, queue,
+                 find_program):
+        """Initialize an Irrigation controller."""
+        self.entity_id   = irrigation_id
+        self._controller = controller
+        self._commander  = commander
+        self._queue      = queue
+        self._find_program = find_program
+        self._available  = True
+        self._unavailable_count = 0
+        self._last_unavailable = None
+
+    async def async_added_to_hass(self):
+        await super().async_added_to_hass()
+        self._available = self._controller.available
+
+        @callback
+        def controller_state_listener(entity, old_state, new_state):
+            """ a switch or the availability entity changed """
+            self.hass.async_create_task(self.async_check_available())
+
+        entity_ids = list(self._controller.switches)
+        if self._controller.availability_entity is not None:
+            entity_ids.append(self._controller.availability_entity)
+        if entity_ids:
+            async_track_state_change(self.hass, entity_ids,
+                                     controller_state_listener)
+
+    @property
+    def should_poll(self):
+        """If entity should be polled."""
+        return False
+
+    @property
+    def name(self):
+        """Return the name of the controller."""
+        return self._controller.name
+
+    @property
+    def icon(self):
+        """Return the icon to be used for this entity."""
+        return 'mdi:developer-board'
+
+    @property
+    def state(self):
+        """Return on while the controller is available."""
+        return STATE_ON if self._available else STATE_OFF
+
+    @property
+    def state_attributes(self):
+        """Return the health and command statistics of the controller."""
+        stats = self._commander.controller_stats(self._controller)
+        return {ATTR_SWITCHES:len(self._controller.switches),
+                ATTR_MAX_COMMANDS:self._controller.max_commands,
+                ATTR_IN_FLIGHT:self._controller.in_flight,
+                ATTR_UNAVAILABLE_COUNT:self._unavailable_count,
+                ATTR_LAST_UNAVAILABLE:self._last_unavailable,
+                ATTR_SWITCH_COMMANDS:stats.as_dict(),
+                ATTR_SWITCH_LATENCY:stats.histogram}
+
+    async def async_check_available(self):
+        """ record a change of availability, rescheduling the zones held
+            while the controller was unavailable """
+        available = self._controller.available
+        if available != self._available:
+            self._available = available
+            if not available:
+                self._unavailable_count += 1
+                self._last_unavailable = dt_util.utcnow().isoformat()
+                _LOGGER.error('irrigation controller %s is unavailable',
+                              self._controller.name)
+            else:
+                for program_id, zones in self._controller.take_deferred():
+                    program = await self._find_program(program_id)
+                    if program is None:
+                        _LOGGER.info('%s zones of %s not rescheduled, the '
+                                     'program was removed', len(zones),
+                                     program_id)
+                        continue
+                    _LOGGER.info('rescheduling %s zones of %s',
+                                 len(zones), program_id)
+                    await self._queue.async_submit(program, False, zones)
+                """ a lazy program created to take zones that were all
+                    queued already is released again """
+                self._queue.async_check_idle()
+        self.async_schedule_update_ha_state()
+
+
+class IrrigationMaster(Entity):
+    """Representation of the master valve or pump held on while zones run."""
+
+    def __init__(self, irrigation_id, master):
+        """Initialize an Irrigation master."""
+        self.entity_id = irrigation_id
+        self._master   = master
+
+    async def async_added_to_hass(self):
+        await super().async_added_to_hass()
+        self._master.on_change = self.async_schedule_update_ha_state
+
+    @property
+    def should_poll(self):
+        """If entity should be polled."""
+        return False
+
+    @property
+    def name(self):
+        """Return the name of the master switch."""
+        return self.entity_id.split('.', 1)[1]
+
+    @property
+    def icon(self):
+        """Return the icon to be used for this entity."""
+        return 'mdi:water-pump'
+
+    @property
+    def state(self):
+        """Return on while the master switch is held on."""
+        return STATE_ON if self._master.on else STATE_OFF
+
+    @property
+    def state_attributes(self):
+        """Return the delays and the starts saved by holding the switch."""
+        return {ATTR_SWITCH:self._master.switch,
+                ATTR_PRE_START:self._master.pre_start,
+                ATTR_POST_STOP:self._master.post_stop,
+                ATTR_ACTIVE_ZONES:self._master.users,
+                ATTR_STARTS:self._master.starts,
+                ATTR_ZONE_RUNS:self._master.zone_runs,
+                ATTR_CYCLES:self._master.cycles,
+                ATTR_DUTY_TIME:round(self._master.duty)}
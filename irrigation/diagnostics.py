@@ -0,0 +1,121 @@
+"""Runtime counters and profiling for the irrigation component.
+
+The counters are collected where the work happens and read only when the
+dump_stats service asks for them, so gathering them costs a few additions
+on paths that already run. Profiling one program run uses cProfile, which
+measures everything the event loop does while the program runs.
+"""
+import cProfile
+import json
+import logging
+
+from homeassistant.const import ATTR_ENTITY_ID, EVENT_STATE_CHANGED
+from homeassistant.core import callback
+
+_LOGGER = logging.getLogger(__name__)
+
+STATS_FILE   = 'irrigation_stats.json'
+PROFILE_FILE = 'irrigation_profile.prof'
+
+
+def _milliseconds(seconds):
+    return round(seconds * 1000, 3)
+
+
+class Diagnostics:
+    """Collect the counters of every irrigation entity into one report."""
+
+    def __init__(self, hass, domains):
+        self._hass    = hass
+        self._domains = tuple(domain + '.' for domain in domains)
+        self._started = hass.loop.time()
+        self.state_writes = {}
+        self.programs = {}
+        self.zones    = {}
+        self.commander = None
+        self.analyser = None
+        self.switches_off = None
+
+    @callback
+    def async_start(self):
+        """Count the state changes written by the irrigation entities."""
+        self._hass.bus.async_listen(EVENT_STATE_CHANGED, self._state_changed)
+
+    @callback
+    def _state_changed(self, event):
+        entity_id = event.data.get(ATTR_ENTITY_ID, '')
+        if entity_id.startswith(self._domains):
+            self.state_writes[entity_id] = \
+                self.state_writes.get(entity_id, 0) + 1
+
+    def snapshot(self):
+        """The counters and timings as a JSON serialisable dict."""
+        templates = {}
+        for entity_id, program in self.programs.items():
+            template = program.template
+            templates[entity_id] = {
+                'renders':template.renders,
+                'cache_hits':template.cache_hits,
+                'render_ms':_milliseconds(template.render_time)}
+
+        zones = {}
+        for entity_id, zone in self.zones.items():
+            count, total, largest = zone.phase_lag
+            zones[entity_id] = {
+                'wakeups':zone.wakeups,
+                'phase_starts':count,
+                'lag_mean_ms':_milliseconds(total / count) if count else 0,
+                'lag_max_ms':_milliseconds(largest)}
+
+        switches = {}
+        if self.commander is not None:
+            for entity_id, stats in self.commander.stats.items():
+                report = stats.as_dict()
+                report['call_mean_ms'] = _milliseconds(
+                    stats.call_time / stats.sent) if stats.sent else 0
+                report['call_max_ms'] = _milliseconds(stats.call_max)
+                report['confirm_ms'] = stats.histogram
+                switches[entity_id] = report
+
+        startup = {'switches_off_ms':_milliseconds(self.switches_off)
+                   if self.switches_off is not None else None}
+        if self.analyser is not None:
+            startup['templates_analysed'] = self.analyser.analysed
+            startup['templates_reused'] = self.analyser.reused
+
+        return {'uptime':round(self._hass.loop.time() - self._started),
+                'startup':startup,
+                'templates':templates,
+                'state_writes':dict(self.state_writes),
+                'zones':zones,
+                'switches':switches}
+
+    def _write(self, path, report):
+        with open(path, 'w') as stats:
+            json.dump(report, stats, indent=2, sort_keys=True)
+
+    async def async_dump(self, path):
+        """Write the snapshot to a file and the log."""
+        report = self.snapshot()
+        _LOGGER.info('irrigation stats: %s', json.dumps(report))
+        await self._hass.async_add_executor_job(self._write, path, report)
+        return report
+
+
+class RunProfiler:
+    """Profile a single program run and write the stats to a file."""
+
+    def __init__(self, hass, path):
+        self._hass    = hass
+        self._path    = path
+        self._profile = cProfile.Profile()
+
+    def __enter__(self):
+        self._profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self._profile.disable()
+        self._hass.async_add_executor_job(self._profile.dump_stats,
+                                          self._path)
+        _LOGGER.info('irrigation profile written to %s', self._path)
@@ -0,0 +1,289 @@
+"""Zone run times from reference evapotranspiration.
+
+Reference evapotranspiration (ET0) is calculated with the FAO-56 Penman
+Monteith equation using the missing data procedures: solar radiation is
+estimated from the temperature range and the extraterrestrial radiation
+for the latitude and day of year, and the wind speed is the 2 m/s the
+guidance recommends. Humidity and pressure improve the estimate when they
+are available. Rain that fell over the window reduces the water needed.
+
+Sensor samples are added to bounded rolling windows as their states change,
+so nothing is read from history when a program starts. Samples older than
+the window are dropped whenever a window is read, so rain that stopped
+counting and temperatures that stopped changing age out. ET0 and the zone
+depths are cached for the day once there are temperature readings to
+calculate them from.
+
+Temperatures are converted to C, rain to mm and pressure to kPa from the
+sensor's unit_of_measurement. Without one, temperature and rain are in the
+Home Assistant unit system and a pressure over 200 is taken to be hPa.
+"""
+import logging
+import math
+from collections import deque
+
+from homeassistant.const import (ATTR_UNIT_OF_MEASUREMENT, LENGTH_INCHES,
+                                 PRESSURE_BAR, PRESSURE_PA, TEMP_CELSIUS)
+from homeassistant.core import callback
+from homeassistant.helpers.event import async_track_state_change
+import homeassistant.util.dt as dt_util
+from homeassistant.util.pressure import convert as convert_pressure
+from homeassistant.util.temperature import convert as convert_temperature
+
+_LOGGER = logging.getLogger(__name__)
+
+WINDOW_SAMPLES   = 1440
+MM_PER_INCH      = 25.4
+WIND_SPEED       = 2.0
+SOLAR_COEFF      = 0.16
+STEFAN_BOLTZMANN = 4.903e-9
+ALBEDO           = 0.23
+PRESSURE_KPA     = 'kPa'
+
+
+class RollingWindow:
+    """Samples over a time window with O(1) mean, sum, min and max.
+
+    The minimum and maximum are kept in monotonic queues, so each sample
+    is added and removed once. The number of samples is bounded, the
+    oldest are dropped when a sensor reports faster than expected.
+    """
+
+    def __init__(self, seconds, max_samples=WINDOW_SAMPLES):
+        self._seconds = seconds
+        self._max     = max_samples
+        self._samples = deque()
+        self._minimum = deque()
+        self._maximum = deque()
+        self._total   = 0.0
+        self._index   = 0
+
+    def add(self, when, value):
+        self.evict(when)
+        if len(self._samples) >= self._max:
+            self._pop()
+        self._samples.append((self._index, when, value))
+        self._total += value
+        while self._minimum and self._minimum[-1][1] >= value:
+            self._minimum.pop()
+        self._minimum.append((self._index, value))
+        while self._maximum and self._maximum[-1][1] <= value:
+            self._maximum.pop()
+        self._maximum.append((self._index, value))
+        self._index += 1
+
+    def _pop(self):
+        index, _, value = self._samples.popleft()
+        self._total -= value
+        if self._minimum[0][0] == index:
+            self._minimum.popleft()
+        if self._maximum[0][0] == index:
+            self._maximum.popleft()
+
+    def evict(self, now):
+        """Drop the samples that are older than the window."""
+        while self._samples and self._samples[0][1] <= now - self._seconds:
+            self._pop()
+
+    def __len__(self):
+        return len(self._samples)
+
+    @property
+    def total(self):
+        return self._total
+
+    @property
+    def mean(self):
+        if not self._samples:
+            return None
+        return self._total / len(self._samples)
+
+    @property
+    def minimum(self):
+        return self._minimum[0][1] if self._minimum else None
+
+    @property
+    def maximum(self):
+        return self._maximum[0][1] if self._maximum else None
+
+
+def saturation_pressure(temperature):
+    """Saturation vapour pressure in kPa at a temperature in C."""
+    return 0.6108 * math.exp(17.27 * temperature / (temperature + 237.3))
+
+
+def extraterrestrial_radiation(latitude, day_of_year):
+    """Daily extraterrestrial radiation in MJ/m2/day, FAO-56 eq 21."""
+    phi = math.radians(latitude)
+    dr = 1 + 0.033 * math.cos(2 * math.pi * day_of_year / 365)
+    delta = 0.409 * math.sin(2 * math.pi * day_of_year / 365 - 1.39)
+    omega = math.acos(max(-1.0, min(1.0, -math.tan(phi) * math.tan(delta))))
+    return (24 * 60 / math.pi * 0.0820 * dr
+            * (omega * math.sin(phi) * math.sin(delta)
+               + math.cos(phi) * math.cos(delta) * math.sin(omega)))
+
+
+def reference_et(t_min, t_max, latitude, day_of_year, elevation=0,
+                 humidity=None, pressure=None, wind=WIND_SPEED):
+    """Daily reference evapotranspiration in mm, FAO-56 eq 6.
+
+    Pressure is in kPa and humidity the mean relative humidity in %.
+    """
+    t_mean = (t_min + t_max) / 2
+    if pressure is None:
+        pressure = 101.3 * ((293 - 0.0065 * elevation) / 293) ** 5.26
+    gamma = 0.000665 * pressure
+    slope = (4098 * saturation_pressure(t_mean)
+             / (t_mean + 237.3) ** 2)
+
+    e_s = (saturation_pressure(t_max) + saturation_pressure(t_min)) / 2
+    if humidity is None:
+        e_a = saturation_pressure(t_min)
+    else:
+        e_a = e_s * humidity / 100
+
+    r_a  = extraterrestrial_radiation(latitude, day_of_year)
+    r_s  = SOLAR_COEFF * math.sqrt(max(0, t_max - t_min)) * r_a
+    r_so = (0.75 + 2e-5 * elevation) * r_a
+    r_nl = (STEFAN_BOLTZMANN
+            * ((t_max + 273.16) ** 4 + (t_min + 273.16) ** 4) / 2
+            * (0.34 - 0.14 * math.sqrt(max(0, e_a)))
+            * (1.35 * min(1.0, r_s / r_so) - 0.35 if r_so else 0))
+    r_n  = (1 - ALBEDO) * r_s - r_nl
+
+    et0 = ((0.408 * slope * r_n
+            + gamma * 900 / (t_mean + 273) * wind * max(0, e_s - e_a))
+           / (slope + gamma * (1 + 0.34 * wind)))
+    return max(0.0, et0)
+
+
+class ETCalculator:
+    """Weather windows and the daily zone depths derived from them."""
+
+    def __init__(self, hass, sensors, window_hours=24):
+        self._hass    = hass
+        self._sensors = {kind:entity for kind, entity in sensors.items()
+                         if entity}
+        seconds = window_hours * 3600
+        self._windows = {kind:RollingWindow(seconds)
+                         for kind in self._sensors}
+        self._last_rain = None
+        self._day       = None
+        self._et0       = None
+        self._depths    = {}
+
+    @property
+    def available(self):
+        return 'temperature' in self._sensors
+
+    @callback
+    def async_start(self):
+        """Seed the windows from the current states and track changes."""
+        by_entity = {entity:kind for kind, entity in self._sensors.items()}
+        for entity, kind in by_entity.items():
+            self._add(kind, self._hass.states.get(entity))
+
+        @callback
+        def sensor_listener(entity, old_state, new_state):
+            self._add(by_entity[entity], new_state)
+
+        if by_entity:
+            async_track_state_change(self._hass, list(by_entity),
+                                     sensor_listener)
+
+    @callback
+    def _add(self, kind, state):
+        if state is None:
+            return
+        try:
+            value = float(state.state)
+        except ValueError:
+            return
+        unit = state.attributes.get(ATTR_UNIT_OF_MEASUREMENT)
+        if kind == 'temperature':
+            try:
+                value = convert_temperature(
+                    value, unit or self._hass.config.units.temperature_unit,
+                    TEMP_CELSIUS)
+            except ValueError as err:
+                _LOGGER.error('%s not used for ET: %s',
+                              self._sensors[kind], err)
+                return
+        if kind == 'rain' and (unit == LENGTH_INCHES or unit is None
+                               and not self._hass.config.units.is_metric):
+            value *= MM_PER_INCH
+        if kind == 'pressure':
+            try:
+                value = self._kilopascals(value, unit)
+            except ValueError as err:
+                _LOGGER.error('%s not used for ET: %s',
+                              self._sensors[kind], err)
+                return
+        if kind == 'rain':
+            """ rain sensors count up, the window holds the increments """
+            previous, self._last_rain = self._last_rain, value
+            if previous is None:
+                return
+            value = max(0.0, value - previous)
+        self._windows[kind].add(dt_util.utcnow().timestamp(), value)
+
+    @staticmethod
+    def _kilopascals(value, unit):
+        if unit == PRESSURE_KPA:
+            return value
+        if unit == PRESSURE_BAR:
+            return value * 100
+        if unit is None:
+            """ hPa to kPa """
+            return value / 10 if value > 200 else value
+        return convert_pressure(value, unit, PRESSURE_PA) / 1000
+
+    def _window(self, kind, attribute):
+        window = self._windows.get(kind)
+        if window is None:
+            return None
+        window.evict(dt_util.utcnow().timestamp())
+        if not len(window) and kind != 'rain':
+            """ a sensor that has not changed over the window still
+                reports its current state """
+            self._add(kind, self._hass.states.get(self._sensors[kind]))
+        if not len(window):
+            return None
+        return getattr(window, attribute)
+
+    @property
+    def rain(self):
+        """Millimetres of rain over the window."""
+        return self._window('rain', 'total') or 0.0
+
+    def et0(self):
+        """Today's reference evapotranspiration in mm, cached for the day
+        once it has been calculated."""
+        today = dt_util.now().date()
+        if today != self._day:
+            self._day  = today
+            self._depths = {}
+            self._et0  = None
+        if self._et0 is None:
+            t_min = self._window('temperature', 'minimum')
+            t_max = self._window('temperature', 'maximum')
+            if t_min is not None:
+                self._et0 = reference_et(
+                    t_min, t_max, self._hass.config.latitude,
+                    today.timetuple().tm_yday,
+                    self._hass.config.elevation or 0,
+                    self._window('humidity', 'mean'),
+                    self._window('pressure', 'mean'))
+        return self._et0
+
+    def zone_depth(self, zone, crop_coefficient):
+        """Millimetres a zone needs today, or None without readings.
+
+        The depth is ET0 times the crop coefficient less the rain.
+        """
+        et0 = self.et0()
+        if et0 is None:
+            return None
+        if zone not in self._depths:
+            self._depths[zone] = max(0.0, et0 * crop_coefficient - self.rain)
+        return self._depths[zone]
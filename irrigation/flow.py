@@ -0,0 +1,279 @@
+"""Flow meters, delivered volume and leak detection.
+
+A meter is a flow sensor reporting L/min or a pulse counter that counts
+up. Each sample updates the live flow rate and the cumulative litres in
+place, so a meter holds a few numbers however long it runs. A zone meter
+measures its own zone, the main line meter measures a zone while it is
+the only valve open. One state_changed listener serves every meter.
+
+Each zone learns the flow it normally draws as an exponentially weighted
+mean, updated once the flow has settled after the valve opens. Flow through
+a meter whose valves have all been closed for the settle time, or flow far
+above a zone's mean, is an anomaly: an irrigation_flow_anomaly event is
+fired and every program and zone is stopped, the switches turned off in
+one batch. The means are saved with the Home Assistant storage helper so
+they survive a restart.
+"""
+import logging
+
+from homeassistant.const import ATTR_ENTITY_ID, EVENT_STATE_CHANGED
+from homeassistant.core import callback
+from homeassistant.helpers.event import async_call_later
+from homeassistant.helpers.storage import Store
+
+_LOGGER = logging.getLogger(__name__)
+
+STORAGE_KEY     = 'irrigation.flow_baselines'
+STORAGE_VERSION = 1
+SAVE_DELAY      = 60
+
+EVENT_FLOW_ANOMALY = 'irrigation_flow_anomaly'
+ANOMALY_CLOSED     = 'flow_while_closed'
+ANOMALY_HIGH       = 'flow_above_baseline'
+
+LEAK_FLOW     = 0.5
+LEAK_FACTOR   = 1.5
+SETTLE        = 30
+STALE         = 60
+SMOOTHING     = 0.3
+LEARNING_RATE = 0.1
+MIN_SAMPLES   = 10
+
+
+class FlowMeter:
+    """Live flow rate in L/min and cumulative litres of one sensor."""
+
+    def __init__(self, entity_id, pulses_per_litre=None, zone=None,
+                 smoothing=SMOOTHING):
+        self.entity_id = entity_id
+        self.zone      = zone
+        self._pulses_per_litre = pulses_per_litre
+        self._smoothing = smoothing
+        self._last_time  = None
+        self._last_value = None
+        self.rate   = 0.0
+        self.litres = 0.0
+
+    def add(self, when, value):
+        """Add a sample taken at a time in seconds, returning the litres
+        that flowed since the last sample."""
+        last_time, last_value = self._last_time, self._last_value
+        self._last_time, self._last_value = when, value
+        if last_time is None:
+            if self._pulses_per_litre is None:
+                self.rate = value
+            return 0.0
+        elapsed = when - last_time
+
+        if self._pulses_per_litre is not None:
+            pulses = value - last_value
+            if pulses < 0:
+                """ the counter was reset """
+                pulses = value
+            litres = pulses / self._pulses_per_litre
+            if elapsed > STALE:
+                """ the counter was idle, the rate starts from the next
+                    sample """
+                self.rate = 0.0
+            elif not self.rate:
+                self.rate = litres / elapsed * 60
+            elif elapsed > 0:
+                self.rate += self._smoothing * (litres / elapsed * 60
+                                                - self.rate)
+        else:
+            """ the area under the rate between the samples """
+            litres = max(0.0, (last_value + value) / 2 * elapsed / 60)
+            self.rate = value
+        self.litres += litres
+        return litres
+
+    def rate_at(self, when):
+        """The flow rate, a pulse counter that has stopped counting has
+        no flow."""
+        if (self._pulses_per_litre is not None and self._last_time is not None
+                and when - self._last_time > STALE):
+            return 0.0
+        return self.rate
+
+
+class Baseline:
+    """The flow a zone normally draws, as an exponentially weighted mean."""
+
+    def __init__(self, mean=0.0, samples=0):
+        self.mean    = mean
+        self.samples = samples
+
+    @property
+    def learned(self):
+        return self.samples >= MIN_SAMPLES
+
+    def add(self, rate):
+        if not self.samples:
+            self.mean = rate
+        else:
+            """ learn quickly at first, then settle to the learning rate """
+            weight = max(LEARNING_RATE, 1 / (self.samples + 1))
+            self.mean += weight * (rate - self.mean)
+        self.samples += 1
+
+
+class FlowMonitor:
+    """Route meter samples to the zones and watch for anomalies."""
+
+    def __init__(self, hass, main_sensor=None, pulses_per_litre=None,
+                 leak_flow=LEAK_FLOW, leak_factor=LEAK_FACTOR):
+        self._hass        = hass
+        self._leak_flow   = leak_flow
+        self._leak_factor = leak_factor
+        self._store       = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+        self._meters      = {}
+        self._zone_meters = {}
+        self._baselines   = {}
+        self._closed_since = {}
+        self._alerted     = set()
+        self._recheck     = None
+        self._shutting_down = False
+        self.main   = None
+        self.zones  = {}
+        self.on_anomaly = None
+        self.anomalies  = 0
+        if main_sensor is not None:
+            self.main = FlowMeter(main_sensor, pulses_per_litre)
+            self._meters[main_sensor] = self.main
+
+    async def async_start(self):
+        """Load the baselines and follow the meters."""
+        data = await self._store.async_load() or {}
+        for entity_id, (mean, samples) in data.items():
+            self._baselines[entity_id] = Baseline(mean, samples)
+        self._hass.bus.async_listen(EVENT_STATE_CHANGED, self._state_changed)
+
+    def _data(self):
+        return {entity_id:[round(baseline.mean, 3), baseline.samples]
+                for entity_id, baseline in self._baselines.items()}
+
+    @callback
+    def add_zone(self, zone):
+        """Follow the zone's own meter, replacing one it had before."""
+        self.remove_zone(zone)
+        if zone.flow_sensor is None:
+            return
+        meter = FlowMeter(zone.flow_sensor, zone.pulses_per_litre,
+                          zone.entity_id)
+        self._meters[zone.flow_sensor] = meter
+        self._zone_meters[zone.entity_id] = meter
+
+    @callback
+    def remove_zone(self, zone):
+        meter = self._zone_meters.pop(zone.entity_id, None)
+        if meter is not None:
+            self._meters.pop(meter.entity_id, None)
+            self._closed_since.pop(meter.entity_id, None)
+
+    def meter_for(self, zone):
+        """The meter measuring the zone, None when it has none."""
+        meter = self._zone_meters.get(zone.entity_id)
+        if meter is None:
+            meter = self.main
+        return meter
+
+    def baseline(self, zone):
+        """The learned flow of the zone in L/min, None while learning."""
+        baseline = self._baselines.get(zone.entity_id)
+        if baseline is None or not baseline.learned:
+            return None
+        return round(baseline.mean, 2)
+
+    def _measured_zone(self, meter):
+        """The open zone the meter measures, None when its valves are
+        closed, False when it cannot tell the open zones apart."""
+        if meter.zone is not None:
+            zone = self.zones.get(meter.zone)
+            return zone if zone is not None and zone.valve_open else None
+        open_zones = [zone for zone in self.zones.values()
+                      if zone.valve_open]
+        if not open_zones:
+            return None
+        if len(open_zones) > 1 or open_zones[0].entity_id in self._zone_meters:
+            return False
+        return open_zones[0]
+
+    @callback
+    def _state_changed(self, event):
+        meter = self._meters.get(event.data.get(ATTR_ENTITY_ID))
+        if meter is None:
+            return
+        new_state = event.data.get('new_state')
+        try:
+            value = float(new_state.state)
+        except (AttributeError, ValueError):
+            return
+        now = self._hass.loop.time()
+        litres = meter.add(now, value)
+
+        zone = self._measured_zone(meter)
+        if zone is None:
+            self._closed_since.setdefault(meter.entity_id, now)
+            self._check_closed(now)
+            return
+        self._closed_since.pop(meter.entity_id, None)
+        self._alerted.discard(meter.entity_id)
+        if zone is False:
+            return
+        zone.async_add_litres(litres, meter.rate)
+        self._check_zone(zone, meter.rate, now)
+
+    @callback
+    def _check_closed(self, now):
+        """Flow through a closed meter once it has had time to stop."""
+        self._recheck = None
+        pending = False
+        for entity_id, since in self._closed_since.items():
+            meter = self._meters[entity_id]
+            rate = meter.rate_at(now)
+            if rate <= self._leak_flow:
+                self._alerted.discard(entity_id)
+            elif entity_id in self._alerted:
+                continue
+            elif now - since >= SETTLE:
+                self._alerted.add(entity_id)
+                self._anomaly(ANOMALY_CLOSED, meter.zone, rate, None)
+            else:
+                pending = True
+        if pending and self._recheck is None:
+            """ a meter that reports only on change may not report again """
+            self._recheck = async_call_later(self._hass, SETTLE,
+                                             self._async_recheck)
+
+    @callback
+    def _async_recheck(self, now):
+        """ a callback so the check runs in the event loop """
+        self._check_closed(self._hass.loop.time())
+
+    def _check_zone(self, zone, rate, now):
+        if zone.water_started is None or now - zone.water_started < SETTLE:
+            return
+        baseline = self._baselines.setdefault(zone.entity_id, Baseline())
+        if baseline.learned and rate > baseline.mean * self._leak_factor:
+            self._anomaly(ANOMALY_HIGH, zone.entity_id, rate, baseline.mean)
+            return
+        baseline.add(rate)
+        self._store.async_delay_save(self._data, SAVE_DELAY)
+
+    @callback
+    def _anomaly(self, kind, entity_id, rate, baseline):
+        self.anomalies += 1
+        _LOGGER.error('irrigation flow anomaly %s %s, %.1f L/min, '
+                      'stopping every zone', kind, entity_id or '', rate)
+        self._hass.bus.async_fire(EVENT_FLOW_ANOMALY, {
+            'type':kind, ATTR_ENTITY_ID:entity_id, 'rate':round(rate, 2),
+            'baseline':round(baseline, 2) if baseline is not None else None})
+        if self.on_anomaly is not None and not self._shutting_down:
+            self._shutting_down = True
+            self._hass.async_create_task(self._async_shutdown())
+
+    async def _async_shutdown(self):
+        try:
+            await self.on_anomaly()
+        finally:
+            self._shutting_down = False
@@ -0,0 +1,178 @@
+"""Skip, shorten or defer program runs on the rain forecast.
+
+The forecast attribute of a weather entity is parsed the first time it is
+needed after the entity changes, and the parsed periods are kept until it
+changes again, so every program that triggers in between reads the same
+list. A program asks for one decision when it triggers and the decision
+covers all of its zones.
+
+Each period runs from its forecast time to the next one. The rain expected
+over the forecast window is the rain of each period weighted by its
+probability. A run is skipped when enough rain is expected, deferred past
+a period that is likely to rain soon, shortened in proportion to smaller
+amounts, and otherwise run as planned.
+"""
+import logging
+from collections import namedtuple
+from datetime import datetime
+
+from homeassistant.core import callback
+from homeassistant.helpers.event import async_track_state_change
+import homeassistant.util.dt as dt_util
+
+_LOGGER = logging.getLogger(__name__)
+
+ATTR_FORECAST      = 'forecast'
+ATTR_DATETIME      = 'datetime'
+ATTR_PRECIPITATION = 'precipitation'
+ATTR_PROBABILITY   = 'precipitation_probability'
+
+ACTION_RUN     = 'run'
+ACTION_SKIP    = 'skip'
+ACTION_SHORTEN = 'shorten'
+ACTION_DEFER   = 'defer'
+
+FORECAST_HOURS    = 24
+SKIP_RAIN         = 5.0
+SHORTEN_RAIN      = 1.0
+DEFER_PROBABILITY = 70
+DEFER_HOURS       = 6
+DEFAULT_PERIOD    = 3600
+
+ForecastPeriod = namedtuple('ForecastPeriod', 'start end rain probability')
+
+ForecastDecision = namedtuple('ForecastDecision', 'action rain scale until')
+
+
+def _timestamp(value):
+    if isinstance(value, datetime):
+        return dt_util.as_utc(value).timestamp()
+    parsed = dt_util.parse_datetime(str(value))
+    if parsed is None:
+        return None
+    return dt_util.as_utc(parsed).timestamp()
+
+
+def parse_forecast(forecast):
+    """The periods of a forecast attribute in time order.
+
+    Entries without a time are ignored, a missing precipitation is no
+    rain and a missing probability is taken as certain.
+    """
+    points = []
+    for entry in forecast or []:
+        try:
+            start = _timestamp(entry.get(ATTR_DATETIME))
+            rain = float(entry.get(ATTR_PRECIPITATION) or 0)
+            probability = entry.get(ATTR_PROBABILITY)
+            if probability is not None:
+                probability = float(probability)
+        except (AttributeError, TypeError, ValueError):
+            continue
+        if start is not None:
+            points.append((start, rain, probability))
+    points.sort()
+
+    periods = []
+    for index, (start, rain, probability) in enumerate(points):
+        if index + 1 < len(points):
+            end = points[index + 1][0]
+        elif index:
+            end = start + (start - points[index - 1][0])
+        else:
+            end = start + DEFAULT_PERIOD
+        periods.append(ForecastPeriod(start, end, rain, probability))
+    return periods
+
+
+class WeatherForecast:
+    """The parsed forecast of one weather entity and the run decisions
+    made from it."""
+
+    def __init__(self, hass, entity_id, hours=FORECAST_HOURS,
+                 skip_rain=SKIP_RAIN, shorten_rain=SHORTEN_RAIN,
+                 defer_probability=DEFER_PROBABILITY,
+                 defer_hours=DEFER_HOURS):
+        self._hass      = hass
+        self._entity_id = entity_id
+        self._hours     = hours
+        self._skip_rain = skip_rain
+        self._shorten_rain = shorten_rain
+        self._defer_probability = defer_probability
+        self._defer_hours = defer_hours
+        self._periods   = None
+        self.parses     = 0
+
+    @callback
+    def async_start(self):
+        """Forget the parsed forecast whenever the entity changes."""
+
+        @callback
+        def forecast_listener(entity, old_state, new_state):
+            self._periods = None
+
+        async_track_state_change(self._hass, self._entity_id,
+                                 forecast_listener)
+
+    @property
+    def periods(self):
+        if self._periods is None:
+            state = self._hass.states.get(self._entity_id)
+            forecast = None
+            if state is not None:
+                forecast = state.attributes.get(ATTR_FORECAST)
+            self._periods = parse_forecast(forecast)
+            self.parses += 1
+        return self._periods
+
+    def expected_rain(self, now, hours):
+        """Millimetres of rain expected over the hours from now."""
+        until = now + hours * 3600
+        rain = 0.0
+        for period in self.periods:
+            if period.end <= now:
+                continue
+            if period.start >= until:
+                break
+            weight = 1.0 if period.probability is None \
+                else period.probability / 100
+            rain += period.rain * weight
+        return rain
+
+    def _rain_soon(self, now):
+        """The end of the likely rain starting within the defer window,
+        or None when no rain is likely that soon."""
+        until = None
+        for period in self.periods:
+            if period.end <= now:
+                continue
+            likely = period.rain > 0 and (
+                period.probability is None
+                or period.probability >= self._defer_probability)
+            if until is None:
+                if period.start >= now + self._defer_hours * 3600:
+                    break
+                if likely:
+                    until = period.end
+            elif likely and period.start <= until:
+                until = period.end
+            else:
+                break
+        return until
+
+    def decide(self, allow_defer=True, now=None):
+        """Whether a run starting now should be skipped, deferred,
+        shortened or run as planned."""
+        if now is None:
+            now = dt_util.utcnow().timestamp()
+        rain = round(self.expected_rain(now, self._hours), 1)
+        if rain >= self._skip_rain:
+            return ForecastDecision(ACTION_SKIP, rain, 0.0, None)
+        if allow_defer and self._defer_hours:
+            until = self._rain_soon(now)
+            if until is not None:
+                return ForecastDecision(ACTION_DEFER, rain, 1.0, until)
+        if rain >= self._shorten_rain:
+            scale = round(max(0.0, 1 - rain / self._skip_rain), 2)
+            return ForecastDecision(ACTION_SHORTEN, rain, scale, None)
+        return ForecastDecision(ACTION_RUN, rain, 1.0, None)
@@ -0,0 +1,271 @@
+"""Watering history kept per zone and per program.
+
+Each entry is a fixed width record of the start and end of a run as UTC
+timestamps, the minutes and litres delivered and why the run stopped or
+was skipped. Records are appended to a file per entity and the most recent
+are held in a ring buffer, so the attributes are answered from memory and
+only queries reaching further back read the file. Records are stored in
+start order, so a time range is found with a binary search in both.
+
+An export streams the records of every entity from the files to a CSV
+file a chunk at a time, so it holds no more than a chunk in memory however
+long the history.
+"""
+import asyncio
+import csv
+import logging
+import os
+import struct
+from collections import namedtuple
+
+from homeassistant.core import callback
+import homeassistant.util.dt as dt_util
+
+_LOGGER = logging.getLogger(__name__)
+
+HISTORY_DIR   = 'irrigation_history'
+HISTORY_EXT   = '.history'
+RING_CAPACITY = 512
+CHUNK_RECORDS = 1024
+EXPORT_FILE   = 'irrigation_export.csv'
+EXPORT_FIELDS = ('entity_id', 'start', 'end', 'minutes', 'litres', 'reason')
+
+REASON_WATERED   = 0
+REASON_STOPPED   = 1
+REASON_TEMPLATE  = 2
+REASON_RAIN      = 3
+REASON_UNAVAILABLE = 4
+REASON_FORECAST  = 5
+REASON_FAILED    = 6
+REASONS = {REASON_WATERED:'watered',
+           REASON_STOPPED:'stopped',
+           REASON_TEMPLATE:'template',
+           REASON_RAIN:'rain',
+           REASON_UNAVAILABLE:'unavailable',
+           REASON_FORECAST:'forecast',
+           REASON_FAILED:'failed'}
+
+RECORD = struct.Struct('<ddffB')
+
+HistoryRecord = namedtuple('HistoryRecord',
+                           'start end minutes litres reason')
+
+
+def _bisect(count, start_at, timestamp):
+    """The first index whose start is not before the timestamp."""
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if start_at(middle) < timestamp:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+class HistoryRing:
+    """The most recent records of one entity in a fixed size buffer."""
+
+    def __init__(self, capacity=RING_CAPACITY):
+        self._capacity = capacity
+        self._buffer   = bytearray(capacity * RECORD.size)
+        self._head     = 0
+        self.count     = 0
+
+    def _offset(self, index):
+        return ((self._head + index) % self._capacity) * RECORD.size
+
+    def append(self, packed):
+        if self.count < self._capacity:
+            offset = self._offset(self.count)
+            self.count += 1
+        else:
+            """ overwrite the oldest record """
+            offset = self._offset(0)
+            self._head = (self._head + 1) % self._capacity
+        self._buffer[offset:offset + RECORD.size] = packed
+
+    def record(self, index):
+        return HistoryRecord._make(
+            RECORD.unpack_from(self._buffer, self._offset(index)))
+
+    def start_at(self, index):
+        return RECORD.unpack_from(self._buffer, self._offset(index))[0]
+
+    @property
+    def oldest(self):
+        """Start of the oldest record held, or None when empty."""
+        if not self.count:
+            return None
+        return self.start_at(0)
+
+    def query(self, start, end):
+        first = _bisect(self.count, self.start_at, start)
+        last  = _bisect(self.count, self.start_at, end)
+        return [self.record(index) for index in range(first, last)]
+
+
+class WateringHistory:
+    """History store for every irrigation entity."""
+
+    def __init__(self, hass, directory, capacity=RING_CAPACITY):
+        self._hass      = hass
+        self._directory = directory
+        self._capacity  = capacity
+        self._rings     = {}
+        self._stored    = {}
+        self._lock      = asyncio.Lock()
+        self.rollups    = None
+
+    def _path(self, entity_id):
+        return os.path.join(self._directory, entity_id + HISTORY_EXT)
+
+    def stored_entities(self):
+        """The entities with a history file, run in the executor."""
+        if not os.path.isdir(self._directory):
+            return []
+        return sorted(name[:-len(HISTORY_EXT)]
+                      for name in os.listdir(self._directory)
+                      if name.endswith(HISTORY_EXT))
+
+    def stored_count(self, entity_id):
+        """The records in the entity's file, run in the executor."""
+        path = self._path(entity_id)
+        if not os.path.exists(path):
+            return 0
+        return os.path.getsize(path) // RECORD.size
+
+    def iter_chunks(self, entity_id, first=0, start=None, end=None):
+        """Lists of the entity's records from the file, a chunk at a
+        time, from the index first or the records that started in
+        [start, end). Run in the executor."""
+        path = self._path(entity_id)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as history:
+
+            def start_at(index):
+                history.seek(index * RECORD.size)
+                return RECORD.unpack(history.read(RECORD.size))[0]
+
+            history.seek(0, os.SEEK_END)
+            count = history.tell() // RECORD.size
+            if start is not None:
+                first = max(first, _bisect(count, start_at, start))
+            if end is not None:
+                count = _bisect(count, start_at, end)
+            while first < count:
+                last = min(count, first + CHUNK_RECORDS)
+                history.seek(first * RECORD.size)
+                data = history.read((last - first) * RECORD.size)
+                yield [HistoryRecord._make(fields)
+                       for fields in RECORD.iter_unpack(data)]
+                first = last
+
+    def _read_tail(self, entity_id):
+        path = self._path(entity_id)
+        if not os.path.exists(path):
+            return 0, b''
+        with open(path, 'rb') as history:
+            history.seek(0, os.SEEK_END)
+            count = history.tell() // RECORD.size
+            first = max(0, count - self._capacity)
+            history.seek(first * RECORD.size)
+            return count, history.read((count - first) * RECORD.size)
+
+    async def async_load(self, entity_id):
+        """Fill the entity's ring with the end of its history file."""
+        count, data = await self._hass.async_add_executor_job(
+            self._read_tail, entity_id)
+        ring = HistoryRing(self._capacity)
+        for offset in range(0, len(data) - RECORD.size + 1, RECORD.size):
+            ring.append(data[offset:offset + RECORD.size])
+        self._rings[entity_id]  = ring
+        self._stored[entity_id] = count
+
+    def _append(self, entity_id, packed):
+        os.makedirs(self._directory, exist_ok=True)
+        with open(self._path(entity_id), 'ab') as history:
+            history.write(packed)
+
+    @callback
+    def async_record(self, entity_id, start, end, minutes=0.0, litres=0.0,
+                     reason=REASON_WATERED):
+        """Add a run or a skipped run to the entity's history."""
+        ring = self._rings.setdefault(entity_id,
+                                      HistoryRing(self._capacity))
+        if ring.count and start < ring.start_at(ring.count - 1):
+            """ keep the records in start order """
+            start = ring.start_at(ring.count - 1)
+        packed = RECORD.pack(start, end, minutes, litres, reason)
+        ring.append(packed)
+        self._stored[entity_id] = self._stored.get(entity_id, 0) + 1
+        if self.rollups is not None:
+            self.rollups.add(entity_id, HistoryRecord._make(
+                RECORD.unpack(packed)))
+        self._hass.async_create_task(self._async_append(entity_id, packed))
+
+    async def _async_append(self, entity_id, packed):
+        """ the lock keeps the writes in the order they were recorded """
+        async with self._lock:
+            await self._hass.async_add_executor_job(
+                self._append, entity_id, packed)
+
+    def _read_range(self, entity_id, start, end):
+        return [record for chunk in self.iter_chunks(entity_id, 0, start, end)
+                for record in chunk]
+
+    async def async_query(self, entity_id, start, end):
+        """Records that started in [start, end), oldest first."""
+        ring = self._rings.get(entity_id)
+        if ring is None:
+            return []
+        if (ring.oldest is not None and ring.oldest <= start) or (
+                ring.count == self._stored.get(entity_id, 0)):
+            return ring.query(start, end)
+        return await self._hass.async_add_executor_job(
+            self._read_range, entity_id, start, end)
+
+    def totals(self, entity_id, start, end):
+        """Minutes and litres delivered by the records held in memory."""
+        ring = self._rings.get(entity_id)
+        if ring is None:
+            return 0.0, 0.0
+        records = ring.query(start, end)
+        return (sum(record.minutes for record in records),
+                sum(record.litres for record in records))
+
+    def _export(self, path, entity_ids, start, end):
+        rows = 0
+        with open(path, 'w', newline='') as export:
+            writer = csv.writer(export)
+            writer.writerow(EXPORT_FIELDS)
+            for entity_id in entity_ids:
+                for chunk in self.iter_chunks(entity_id, 0, start, end):
+                    writer.writerows(
+                        (entity_id, _local_time(record.start),
+                         _local_time(record.end), round(record.minutes, 2),
+                         round(record.litres, 2),
+                         REASONS.get(record.reason, record.reason))
+                        for record in chunk)
+                    rows += len(chunk)
+        return rows
+
+    async def async_export(self, path, entity_ids=None, start=None,
+                           end=None):
+        """Write the records that started in [start, end) to a CSV file,
+        returning the number written. The lock lets the records already
+        recorded reach the files first."""
+        async with self._lock:
+            stored = await self._hass.async_add_executor_job(
+                self.stored_entities)
+            if entity_ids is not None:
+                stored = [entity_id for entity_id in stored
+                          if entity_id in entity_ids]
+            return await self._hass.async_add_executor_job(
+                self._export, path, stored, start, end)
+
+
+def _local_time(timestamp):
+    return dt_util.as_local(
+        dt_util.utc_from_timestamp(timestamp)).isoformat()
@@ -0,0 +1,216 @@
+"""Append only journal of irrigation runs so they survive a restart.
+
+Each record is one line of space separated fields:
+
+    P <time> <program> <zone,zone,...>          program started
+    Z <time> <program> <zone> <origin> <s-e,...>  zone schedule started
+    F <time> <program> <zone> <interval> <state>  zone phase changed
+    D <time> <program> <zone>                   zone finished
+    E <time> <program>                          program finished
+    S <time>                                    Home Assistant stopped
+
+Times are UTC timestamps, a zone schedule is the water intervals in
+seconds from its origin. A run resumes from where it was when Home
+Assistant stopped, or when the last record was written if it did not
+stop cleanly, the time it was down does not count as watering. Zones run on their own use the zone as the
+program. Records are buffered and written with a single fsync, and the
+journal is rewritten to hold only the unfinished runs once it grows past
+COMPACT_RECORDS, so loading it takes a bounded time.
+"""
+import asyncio
+import logging
+import os
+
+from homeassistant.core import callback
+from homeassistant.helpers.event import async_call_later
+import homeassistant.util.dt as dt_util
+
+_LOGGER = logging.getLogger(__name__)
+
+JOURNAL_FILE    = 'irrigation.journal'
+FLUSH_DELAY     = 2
+COMPACT_RECORDS = 500
+
+RECORD_PROGRAM  = 'P'
+RECORD_ZONE     = 'Z'
+RECORD_PHASE    = 'F'
+RECORD_DONE     = 'D'
+RECORD_END      = 'E'
+RECORD_STOP     = 'S'
+
+
+class InterruptedRun:
+    """A run that was in progress when the journal was last written."""
+
+    def __init__(self, zones):
+        self.zones     = zones
+        self.done      = set()
+        self.schedules = {}
+
+    @property
+    def remaining(self):
+        """Zones that had not finished, in program order."""
+        return [zone for zone in self.zones if zone not in self.done]
+
+
+def _format_intervals(intervals):
+    return ','.join('{:g}-{:g}'.format(start, end)
+                    for start, end in intervals)
+
+
+def _parse_intervals(text):
+    intervals = []
+    for interval in text.split(','):
+        start, end = interval.split('-')
+        intervals.append((float(start), float(end)))
+    return intervals
+
+
+class RunJournal:
+    """Record program and zone phase transitions to disk."""
+
+    def __init__(self, hass, path):
+        self._hass    = hass
+        self._path    = path
+        self._buffer  = []
+        self._flush   = None
+        self._records = 0
+        self._lock    = asyncio.Lock()
+        self.runs     = {}
+        self.stopped  = None
+
+    @callback
+    def _apply(self, fields):
+        kind, time = fields[0], float(fields[1])
+        if kind == RECORD_STOP:
+            self.stopped = time
+            return
+        self.stopped = None
+        program = fields[2]
+        if kind == RECORD_PROGRAM:
+            self.runs[program] = InterruptedRun(fields[3].split(','))
+        elif kind == RECORD_ZONE:
+            run = self.runs.setdefault(program, InterruptedRun([fields[3]]))
+            run.schedules[fields[3]] = (float(fields[4]),
+                                        _parse_intervals(fields[5]))
+        elif kind == RECORD_DONE and program in self.runs:
+            self.runs[program].done.add(fields[3])
+            self.runs[program].schedules.pop(fields[3], None)
+        elif kind == RECORD_END:
+            self.runs.pop(program, None)
+
+    @callback
+    def _record(self, *fields):
+        fields = (fields[0], '{:.3f}'.format(dt_util.utcnow().timestamp()),
+                  ) + tuple(str(field) for field in fields[1:])
+        self._apply(fields)
+        self._buffer.append(' '.join(fields) + '\n')
+        if self._flush is None:
+            self._flush = async_call_later(self._hass, FLUSH_DELAY,
+                                           self._async_flush_later)
+
+    @callback
+    def program_start(self, program, zones):
+        self._record(RECORD_PROGRAM, program, ','.join(zones))
+
+    @callback
+    def zone_start(self, program, zone, origin, intervals):
+        """Record a zone schedule, origin is a UTC timestamp."""
+        self._record(RECORD_ZONE, program, zone, '{:.3f}'.format(origin),
+                     _format_intervals(intervals))
+
+    @callback
+    def phase(self, program, zone, interval, state):
+        self._record(RECORD_PHASE, program, zone, interval, state)
+
+    @callback
+    def zone_end(self, program, zone):
+        self._record(RECORD_DONE, program, zone)
+
+    @callback
+    def program_end(self, program):
+        self._record(RECORD_END, program)
+
+    @callback
+    def stop(self):
+        """Record that Home Assistant is stopping."""
+        self._record(RECORD_STOP)
+
+    async def _async_flush_later(self, now):
+        self._flush = None
+        await self.async_flush()
+
+    async def async_flush(self):
+        """Write the buffered records with a single fsync."""
+        if self._flush is not None:
+            self._flush()
+            self._flush = None
+        async with self._lock:
+            if not self._buffer:
+                return
+            lines, self._buffer = self._buffer, []
+            self._records += len(lines)
+            mode = 'a'
+            if self._records > COMPACT_RECORDS:
+                self._records = 0
+                lines = self._snapshot()
+                mode = 'w'
+            await self._hass.async_add_executor_job(self._write, lines, mode)
+
+    def _snapshot(self):
+        """The records needed to describe the unfinished runs."""
+        now = '{:.3f}'.format(dt_util.utcnow().timestamp())
+        lines = []
+        for program, run in self.runs.items():
+            lines.append(' '.join((RECORD_PROGRAM, now, program,
+                                   ','.join(run.zones))) + '\n')
+            for zone, (origin, intervals) in run.schedules.items():
+                lines.append(' '.join((RECORD_ZONE, now, program, zone,
+                                       '{:.3f}'.format(origin),
+                                       _format_intervals(intervals))) + '\n')
+            for zone in run.done:
+                lines.append(' '.join((RECORD_DONE, now, program, zone))
+                             + '\n')
+        if self.stopped is not None:
+            lines.append(' '.join((RECORD_STOP,
+                                   '{:.3f}'.format(self.stopped))) + '\n')
+        return lines
+
+    def _write(self, lines, mode):
+        if mode == 'w':
+            path = self._path + '.tmp'
+        else:
+            path = self._path
+        with open(path, mode) as journal:
+            journal.writelines(lines)
+            journal.flush()
+            os.fsync(journal.fileno())
+        if mode == 'w':
+            os.replace(path, self._path)
+
+    def _read(self):
+        if not os.path.exists(self._path):
+            return []
+        with open(self._path) as journal:
+            return journal.readlines()
+
+    async def async_load(self):
+        """Replay the journal and return the interrupted runs, stopped is
+        then the time they stopped."""
+        lines = await self._hass.async_add_executor_job(self._read)
+        last = None
+        for line in lines:
+            fields = line.split()
+            if not fields:
+                continue
+            try:
+                self._apply(fields)
+                last = float(fields[1])
+            except (IndexError, ValueError):
+                _LOGGER.warning('ignoring damaged journal record: %s',
+                                line.strip())
+        if self.stopped is None:
+            """ Home Assistant did not stop cleanly """
+            self.stopped = last
+        self._records = len(lines)
+        return dict(self.runs)
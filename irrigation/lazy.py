@@ -0,0 +1,215 @@
+"""Program schedules kept in a table until the program is needed.
+
+In lazy mode a program whose template is a sensor.time trigger is not
+created as an entity at start up. Its trigger time, weekdays, days_since
+comparison and remaining condition are kept in a row of a table, and a
+single timer set for the earliest row replaces a listener per program.
+When a row comes due its condition is rendered and, when it is true, the
+program and its zones are created and started. They are removed again
+once nothing is running.
+
+A program that is not an entity has no state to restore, so the last run
+date of each row is saved with the Home Assistant storage helper.
+"""
+import heapq
+import logging
+from datetime import date, timedelta
+
+from homeassistant.core import callback
+from homeassistant.exceptions import TemplateError
+from homeassistant.helpers.event import async_track_point_in_time
+from homeassistant.helpers.storage import Store
+from homeassistant.helpers.template import Template
+import homeassistant.util.dt as dt_util
+
+from .planner import next_run_dates, run_times
+
+_LOGGER = logging.getLogger(__name__)
+
+STORAGE_KEY     = 'irrigation.schedule'
+STORAGE_VERSION = 1
+SAVE_DELAY      = 10
+
+
+class ScheduleRow:
+    """The schedule of one program that is not an entity."""
+
+    __slots__ = ('entity_id', 'hour', 'minute', 'weekdays', 'days_since',
+                 'condition', 'last_run', 'due')
+
+    def __init__(self, entity_id, hour, minute, weekdays, days_since,
+                 condition):
+        self.entity_id  = entity_id
+        self.hour       = hour
+        self.minute     = minute
+        self.weekdays   = weekdays
+        self.days_since = days_since
+        self.condition  = condition
+        self.last_run   = None
+        self.due        = None
+
+
+def schedule_row(entity_id, analysis):
+    """The row for an analysed program template, None when the template
+    is not a sensor.time trigger and the program has to track it as an
+    entity."""
+    if analysis.time_trigger is None:
+        return None
+    hour, minute = analysis.time_trigger
+    return ScheduleRow(entity_id, hour, minute, analysis.weekdays,
+                       analysis.days_since, analysis.condition)
+
+
+class ScheduleTable:
+    """Trigger the programs in the table from one timer."""
+
+    def __init__(self, hass, on_due):
+        """on_due is awaited with the entity id of a program whose
+        trigger time came with its condition true."""
+        self._hass   = hass
+        self._on_due = on_due
+        self._store  = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+        self._rows   = {}
+        self._heap   = []
+        self._timer  = None
+        self._armed  = None
+        self._last_runs = {}
+        self.fired   = 0
+
+    def __contains__(self, entity_id):
+        return entity_id in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def last_run(self, entity_id):
+        row = self._rows.get(entity_id)
+        return row.last_run if row is not None else None
+
+    async def async_load(self):
+        data = await self._store.async_load() or {}
+        for entity_id, day in data.items():
+            try:
+                self._last_runs[entity_id] = date.fromisoformat(day)
+            except (TypeError, ValueError):
+                continue
+
+    def _data(self):
+        return {entity_id:row.last_run.isoformat()
+                for entity_id, row in self._rows.items()
+                if row.last_run is not None}
+
+    @callback
+    def add(self, row):
+        """Schedule a program, replacing the row it had before."""
+        row.last_run = self._last_runs.get(row.entity_id)
+        self._rows[row.entity_id] = row
+        self._push(row, dt_util.now())
+        self._arm()
+
+    @callback
+    def remove(self, entity_id):
+        """ the heap entry is dropped when it comes to the top """
+        self._rows.pop(entity_id, None)
+
+    @callback
+    def set_last_run(self, entity_id, day):
+        """A created program ran, count days_since from its run."""
+        row = self._rows.get(entity_id)
+        if row is None or row.last_run == day:
+            return
+        row.last_run = day
+        self._last_runs[entity_id] = day
+        self._store.async_delay_save(self._data, SAVE_DELAY)
+        self._push(row, dt_util.now())
+        self._arm()
+
+    def next_runs(self, entity_id, now, count):
+        """The next times the program's row will come due."""
+        row = self._rows.get(entity_id)
+        if row is None:
+            return []
+        return self._next_runs(row, now, count)
+
+    def _next_runs(self, row, now, count):
+        first = now.date()
+        if (row.hour, row.minute) <= (now.hour, now.minute):
+            first += timedelta(days=1)
+        dates = next_run_dates(first, row.weekdays, row.days_since,
+                               row.last_run, count)
+        return run_times(dates, row.hour, row.minute,
+                         dt_util.DEFAULT_TIME_ZONE)
+
+    def _push(self, row, now):
+        runs = self._next_runs(row, now, 1)
+        row.due = runs[0].timestamp() if runs else None
+        if row.due is not None:
+            heapq.heappush(self._heap, (row.due, row.entity_id))
+
+    def _pop_stale(self):
+        """ entries for rows removed or rescheduled since they were
+            pushed are left in the heap until they reach the top """
+        while self._heap:
+            due, entity_id = self._heap[0]
+            row = self._rows.get(entity_id)
+            if row is not None and row.due == due:
+                return
+            heapq.heappop(self._heap)
+
+    @callback
+    def _arm(self):
+        self._pop_stale()
+        due = self._heap[0][0] if self._heap else None
+        if due == self._armed:
+            return
+        if self._timer is not None:
+            self._timer()
+            self._timer = None
+        self._armed = due
+        if due is not None:
+            self._timer = async_track_point_in_time(
+                self._hass, self._async_fire, dt_util.utc_from_timestamp(due))
+
+    async def _async_fire(self, now):
+        """ a program that fails to start is logged, the other due rows
+            still run and the timer is always armed again """
+        self._timer = None
+        self._armed = None
+        try:
+            due_rows = []
+            self._pop_stale()
+            while self._heap and self._heap[0][0] <= now.timestamp():
+                due, entity_id = heapq.heappop(self._heap)
+                due_rows.append(self._rows[entity_id])
+                self._pop_stale()
+
+            for row in due_rows:
+                self.fired += 1
+                try:
+                    if self._render(row) == 'True':
+                        row.last_run = dt_util.as_local(now).date()
+                        self._last_runs[row.entity_id] = row.last_run
+                        self._store.async_delay_save(self._data, SAVE_DELAY)
+                        await self._on_due(row.entity_id)
+                except Exception:
+                    _LOGGER.exception('Program %s, not started',
+                                      row.entity_id)
+                finally:
+                    """ the next run counts from the run just made """
+                    if row.entity_id in self._rows:
+                        self._push(row,
+                                   dt_util.now() + timedelta(minutes=1))
+        finally:
+            self._arm()
+
+    def _render(self, row):
+        """ the rest of the condition is compiled only when it is due """
+        if row.condition is None:
+            return 'True'
+        try:
+            return Template('{{ ' + row.condition + ' }}',
+                            self._hass).async_render()
+        except TemplateError as err:
+            _LOGGER.error('Program template %s, invalid: %s',
+                          row.entity_id, err)
+            return None
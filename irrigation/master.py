@@ -0,0 +1,135 @@
+"""Master valve or pump shared by every zone.
+
+The master switch is held on while any zone runs, whichever program runs
+it. Each zone run takes a reference when its schedule starts and gives it
+back when the run ends, so the switch stays on through Eco waits and the
+handover from one zone to the next. It is turned on once for a block of
+watering rather than once per zone or cycle.
+
+The first valve opens once the switch has been on for the pre start delay,
+letting a pump build pressure. When the last reference is given back the
+switch stays on for the post stop delay, a zone starting within that time
+keeps it on, so short gaps between zones do not cycle the relay.
+"""
+import asyncio
+import logging
+
+from homeassistant.core import callback
+
+_LOGGER = logging.getLogger(__name__)
+
+PRE_START = 0
+POST_STOP = 5
+
+
+class MasterSwitch:
+    """Reference counted master valve or pump switch."""
+
+    def __init__(self, hass, switch, turn, pre_start=PRE_START,
+                 post_stop=POST_STOP):
+        """turn is awaited with the switch and True or False to operate
+        the switch, returning True when the switch confirmed it."""
+        self._hass      = hass
+        self._turn      = turn
+        self._ready     = asyncio.Event()
+        self._starting  = None
+        self._stopping  = None
+        self._on_since  = None
+        self._duty      = 0.0
+        self.switch     = switch
+        self.pre_start  = pre_start
+        self.post_stop  = post_stop
+        self.on         = False
+        self.users      = 0
+        self.starts     = 0
+        self.zone_runs  = 0
+        self.cycles     = 0
+        self.on_change  = None
+
+    @property
+    def duty(self):
+        """Seconds the switch has been on, including the current block."""
+        if self._on_since is None:
+            return self._duty
+        return self._duty + self._hass.loop.time() - self._on_since
+
+    async def async_acquire(self):
+        """Hold the switch on for a zone run, returning the seconds the
+        zone waited for it to be ready."""
+        self.users     += 1
+        self.zone_runs += 1
+        if self._stopping is not None:
+            self._stopping.cancel()
+            self._stopping = None
+        if not self.on:
+            self.on = True
+            self._ready.clear()
+            self._starting = self._hass.async_create_task(self._async_start())
+        self._changed()
+        if self._ready.is_set():
+            return 0
+        waited = self._hass.loop.time()
+        await self._ready.wait()
+        return self._hass.loop.time() - waited
+
+    @callback
+    def release(self):
+        """A zone run ended, the switch turns off after the post stop
+        delay once no zone holds it."""
+        self.users = max(0, self.users - 1)
+        self._changed()
+        if self.users or not self.on or self._stopping is not None:
+            return
+        self._stopping = self._hass.loop.call_later(
+            self.post_stop,
+            lambda: self._hass.async_create_task(self._async_stop()))
+
+    @callback
+    def cycle(self):
+        """A zone valve opened while the switch was held on."""
+        self.cycles += 1
+
+    @callback
+    def halt(self):
+        """The switch was turned off with every zone, the next zone run
+        turns it on again."""
+        if self._stopping is not None:
+            self._stopping.cancel()
+            self._stopping = None
+        self._off()
+
+    async def _async_start(self):
+        self.starts  += 1
+        self._on_since = self._hass.loop.time()
+        if not await self._turn(self.switch, True):
+            _LOGGER.error('master switch %s did not confirm on, watering '
+                          'continues', self.switch)
+        if self.pre_start:
+            await asyncio.sleep(self.pre_start)
+        self._ready.set()
+
+    async def _async_stop(self):
+        self._stopping = None
+        if self.users or not self.on:
+            return
+        self._off()
+        await self._turn(self.switch, False)
+
+    @callback
+    def _off(self):
+        """ release any zone waiting for the pre start, it finds its run
+            was stopped """
+        if self._starting is not None and not self._starting.done():
+            self._starting.cancel()
+        self._starting = None
+        self._ready.set()
+        if self._on_since is not None:
+            self._duty += self._hass.loop.time() - self._on_since
+            self._on_since = None
+        self.on = False
+        self._changed()
+
+    @callback
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
@@ -0,0 +1,166 @@
+"""Zone scheduling for irrigation programs.
+
+Times are in seconds measured from the start of the program. A zone run is
+described by the water intervals it occupies, the gaps between intervals
+are the Eco wait phases.
+"""
+import math
+import operator
+from collections import namedtuple
+from datetime import datetime, time, timedelta
+
+ZoneRun = namedtuple('ZoneRun', 'zone water wait repeat flow')
+
+SURFACE_STORAGE = 2.5
+MAX_CYCLE       = 30 * 60
+NEXT_RUNS       = 5
+HORIZON_DAYS    = 366
+
+COMPARISONS = {'>':operator.gt, '>=':operator.ge, '==':operator.eq}
+
+
+def run_length(run):
+    """Seconds a zone takes when it runs on its own."""
+    return run.water * run.repeat + run.wait * (run.repeat - 1)
+
+
+def run_intervals(run, start=0):
+    """Water intervals for an uninterrupted water/wait/repeat cycle."""
+    intervals = []
+    for _ in range(run.repeat):
+        intervals.append((start, start + run.water))
+        start += run.water + run.wait
+    return intervals
+
+
+def eco_cycles(depth, precipitation_rate, infiltration_rate=None,
+               surface_storage=SURFACE_STORAGE, max_cycle=MAX_CYCLE):
+    """The fewest water/wait/repeat cycles that apply a depth without runoff.
+
+    Depths are in mm and rates in mm/hour. Water the soil cannot take in
+    ponds on the surface and runs off once more than surface_storage mm
+    has collected, so a cycle ends before then and the wait lets the
+    ponded water soak in. A cycle is never longer than max_cycle seconds.
+    Returns the water and wait in seconds and the number of cycles.
+    """
+    if depth <= 0:
+        return 0, 0, 0
+    total = depth / precipitation_rate * 3600
+    excess = 0
+    if infiltration_rate and precipitation_rate > infiltration_rate:
+        excess = precipitation_rate - infiltration_rate
+        max_cycle = min(max_cycle, surface_storage / excess * 3600)
+    repeat = max(1, math.ceil(total / max_cycle - 1e-9))
+    water = math.ceil(total / repeat)
+    wait = 0
+    if repeat > 1 and excess:
+        ponded = excess * water / 3600
+        wait = math.ceil(ponded / infiltration_rate * 3600)
+    return water, wait, repeat
+
+
+def sequential_plan(runs):
+    """Run the zones one after another, the way a program always has."""
+    plan = {}
+    start = 0
+    for run in runs:
+        plan[run.zone] = run_intervals(run, start)
+        start += run_length(run)
+    return plan
+
+
+def makespan(plan):
+    """Seconds from the start of a plan until its last valve closes."""
+    return max((intervals[-1][1] for intervals in plan.values()
+                if intervals), default=0)
+
+
+def parallel_plan(runs, max_concurrent=None, flow_limit=None):
+    """Pack water intervals to run zones together within supply limits.
+
+    Valves are limited by count and by the total flow of the open valves.
+    A zone's Eco wait is the shortest soak between its water phases, other
+    zones water while it soaks. Ready zones with the most outstanding time
+    are started first, which keeps the longest zones off the critical path.
+    """
+    if not runs:
+        return {}
+
+    plan        = {run.zone: [] for run in runs}
+    cycles_left = {run.zone: run.repeat for run in runs}
+    ready_at    = {run.zone: 0 for run in runs}
+    by_zone     = {run.zone: run for run in runs}
+    active      = []
+    now         = 0
+
+    def outstanding(run):
+        cycles = cycles_left[run.zone]
+        return run.water * cycles + run.wait * (cycles - 1)
+
+    while any(cycles_left.values()):
+        """ release the valves that have closed """
+        active = [entry for entry in active if entry[0] > now]
+        flow   = sum(entry[1] for entry in active)
+
+        ready = [by_zone[zone] for zone, cycles in cycles_left.items()
+                 if cycles and ready_at[zone] <= now
+                 and zone not in (entry[2] for entry in active)]
+        ready.sort(key=outstanding, reverse=True)
+
+        for run in ready:
+            if max_concurrent and len(active) >= max_concurrent:
+                break
+            zone_flow = run.flow or 0
+            if (flow_limit and active
+                    and flow + zone_flow > flow_limit):
+                """ a zone larger than the budget still runs alone """
+                continue
+            end = now + run.water
+            plan[run.zone].append((now, end))
+            active.append((end, zone_flow, run.zone))
+            flow += zone_flow
+            cycles_left[run.zone] -= 1
+            ready_at[run.zone] = end + run.wait
+
+        pending = [ready_at[zone] for zone, cycles in cycles_left.items()
+                   if cycles and ready_at[zone] > now]
+        events = [entry[0] for entry in active] + pending
+        if not events:
+            break
+        now = min(events)
+
+    return plan
+
+
+def next_run_dates(first, weekdays=None, days_since=None, last_run=None,
+                   count=NEXT_RUNS, horizon=HORIZON_DAYS):
+    """The dates a program will run on from the first date considered.
+
+    weekdays are the days allowed, Monday being 0, or None for every day.
+    days_since is a comparison and a number of days, counted from the last
+    run, which becomes each predicted date in turn.
+    """
+    dates = []
+    day = first
+    for _ in range(horizon):
+        if len(dates) >= count:
+            break
+        if weekdays is None or day.weekday() in weekdays:
+            if (days_since is None or last_run is None
+                    or COMPARISONS[days_since[0]](
+                        (day - last_run).days, days_since[1])):
+                dates.append(day)
+                last_run = day
+        day += timedelta(days=1)
+    return dates
+
+
+def run_times(dates, hour, minute, time_zone):
+    """The local time of day on each date, in a pytz time zone.
+
+    Each time takes the UTC offset in force at that time of day, not the
+    offset at midnight, so a run on a daylight saving change is not an
+    hour out.
+    """
+    return [time_zone.localize(datetime.combine(day, time(hour, minute)))
+            for day in dates]
@@ -0,0 +1,51 @@
+"""Differences between a new configuration and the running entities.
+
+Each running program and zone keeps a comparable key of the configuration
+it was built from, so a reload compares keys rather than entities and only
+the entries that were added, removed or changed are built or updated.
+Templates are compared by their text.
+"""
+import logging
+
+from homeassistant.helpers.template import Template
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def config_key(value):
+    """A hashable, comparable form of a validated configuration."""
+    if isinstance(value, dict):
+        return tuple(sorted(((key, config_key(item))
+                             for key, item in value.items()),
+                            key=lambda item: str(item[0])))
+    if isinstance(value, (list, tuple)):
+        return tuple(config_key(item) for item in value)
+    if isinstance(value, Template):
+        return ('template', value.template)
+    return value
+
+
+class ConfigDiff:
+    """The entity ids added, removed and changed by a new configuration."""
+
+    def __init__(self, running, configs):
+        """running maps entity ids to their configuration keys, configs
+        maps entity ids to the new configurations."""
+        self.added   = {}
+        self.changed = {}
+        self.keys    = {}
+        for entity_id, config in configs.items():
+            key = config_key(config)
+            self.keys[entity_id] = key
+            if entity_id not in running:
+                self.added[entity_id] = config
+            elif running[entity_id] != key:
+                self.changed[entity_id] = config
+        self.removed = [entity_id for entity_id in running
+                        if entity_id not in configs]
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    def __len__(self):
+        return len(self.added) + len(self.changed) + len(self.removed)
@@ -0,0 +1,164 @@
+"""Daily, weekly and monthly water budgets per zone and program.
+
+Each history record is added to the totals of its day, ISO week and month
+as it is recorded, so a report reads the totals rather than the history.
+A total holds the runs, the runs skipped, the minutes and the litres. The
+totals are saved with the Home Assistant storage helper together with the
+number of records of each entity they include. At start up any records in
+the history files beyond that number, written before a save was lost, are
+added, and an entity whose file holds fewer records has its totals built
+again from the file.
+"""
+import csv
+import logging
+
+from homeassistant.core import callback
+from homeassistant.helpers.storage import Store
+import homeassistant.util.dt as dt_util
+
+from .history import REASON_FORECAST, REASON_RAIN, REASON_TEMPLATE
+
+_LOGGER = logging.getLogger(__name__)
+
+STORAGE_KEY     = 'irrigation.rollups'
+STORAGE_VERSION = 1
+SAVE_DELAY      = 60
+
+PERIOD_DAY   = 'day'
+PERIOD_WEEK  = 'week'
+PERIOD_MONTH = 'month'
+PERIODS      = [PERIOD_DAY,PERIOD_WEEK,PERIOD_MONTH]
+KEPT         = {PERIOD_DAY:400, PERIOD_WEEK:160, PERIOD_MONTH:None}
+
+SKIPPED = (REASON_TEMPLATE, REASON_RAIN, REASON_FORECAST)
+REPORT_FIELDS = ('entity_id', 'period', 'runs', 'skipped', 'minutes',
+                 'litres')
+
+
+def period_keys(day):
+    """The day, ISO week and month a date falls in, as sortable keys."""
+    year, week, _ = day.isocalendar()
+    return {PERIOD_DAY:day.isoformat(),
+            PERIOD_WEEK:'{:04}-W{:02}'.format(year, week),
+            PERIOD_MONTH:'{:04}-{:02}'.format(day.year, day.month)}
+
+
+def _add(totals, record):
+    """ fold a record into an entity's totals, dropping the oldest
+        period once more are held than are kept """
+    day = dt_util.as_local(dt_util.utc_from_timestamp(record.start)).date()
+    skipped = record.reason in SKIPPED
+    for period, key in period_keys(day).items():
+        periods = totals.setdefault(period, {})
+        total = periods.get(key)
+        if total is None:
+            total = periods[key] = [0, 0, 0.0, 0.0]
+            if KEPT[period] is not None and len(periods) > KEPT[period]:
+                del periods[min(periods)]
+        total[1 if skipped else 0] += 1
+        total[2] += record.minutes
+        total[3] += record.litres
+
+
+class Rollups:
+    """Water budget totals kept up to date as runs are recorded."""
+
+    def __init__(self, hass, history):
+        self._hass    = hass
+        self._history = history
+        self._store   = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+        self._totals  = {}
+        self._folded  = {}
+        self.caught_up = 0
+
+    async def async_load(self):
+        """Read the saved totals and add the records they are missing."""
+        data = await self._store.async_load() or {}
+        self._totals = data.get('totals', {})
+        self._folded = data.get('folded', {})
+        caught_up = await self._hass.async_add_executor_job(
+            self._catch_up, dict(self._folded))
+        for entity_id, (folded, totals, rebuilt) in caught_up.items():
+            self.caught_up += folded - (0 if rebuilt else
+                                        self._folded.get(entity_id, 0))
+            if rebuilt:
+                self._totals[entity_id] = totals
+            else:
+                self._merge(self._totals.setdefault(entity_id, {}), totals)
+            self._folded[entity_id] = folded
+        if caught_up:
+            _LOGGER.info('irrigation rollups caught up with %s records',
+                         self.caught_up)
+            self._store.async_delay_save(self._data, SAVE_DELAY)
+
+    def _catch_up(self, folded):
+        """ the totals of the records each entity's file holds beyond
+            those already folded, run in the executor """
+        caught_up = {}
+        for entity_id in self._history.stored_entities():
+            count = self._history.stored_count(entity_id)
+            first = folded.get(entity_id, 0)
+            if count == first:
+                continue
+            rebuilt = count < first
+            if rebuilt:
+                first = 0
+            totals = {}
+            for chunk in self._history.iter_chunks(entity_id, first):
+                for record in chunk:
+                    _add(totals, record)
+            caught_up[entity_id] = (count, totals, rebuilt)
+        return caught_up
+
+    @staticmethod
+    def _merge(totals, other):
+        for period, periods in other.items():
+            mine = totals.setdefault(period, {})
+            for key, total in periods.items():
+                if key in mine:
+                    mine[key] = [a + b for a, b in zip(mine[key], total)]
+                else:
+                    mine[key] = total
+
+    def _data(self):
+        return {'totals':self._totals, 'folded':self._folded}
+
+    @callback
+    def add(self, entity_id, record):
+        """A record was added to the entity's history."""
+        _add(self._totals.setdefault(entity_id, {}), record)
+        self._folded[entity_id] = self._folded.get(entity_id, 0) + 1
+        self._store.async_delay_save(self._data, SAVE_DELAY)
+
+    def rows(self, period, entity_ids=None, start=None, end=None):
+        """The totals of each period from the date start to the date end,
+        both included, by entity then period."""
+        first = period_keys(start)[period] if start is not None else None
+        last  = period_keys(end)[period] if end is not None else None
+        rows = []
+        for entity_id in sorted(self._totals):
+            if entity_ids is not None and entity_id not in entity_ids:
+                continue
+            periods = self._totals[entity_id].get(period, {})
+            for key in sorted(periods):
+                if (first is not None and key < first) or (
+                        last is not None and key > last):
+                    continue
+                runs, skipped, minutes, litres = periods[key]
+                rows.append((entity_id, key, runs, skipped,
+                             round(minutes, 2), round(litres, 2)))
+        return rows
+
+    def _write(self, path, rows):
+        with open(path, 'w', newline='') as report:
+            writer = csv.writer(report)
+            writer.writerow(REPORT_FIELDS)
+            writer.writerows(rows)
+
+    async def async_export(self, path, period, entity_ids=None, start=None,
+                           end=None):
+        """Write the totals of each period to a CSV file, returning the
+        number of rows written."""
+        rows = self.rows(period, entity_ids, start, end)
+        await self._hass.async_add_executor_job(self._write, path, rows)
+        return len(rows)
@@ -0,0 +1,227 @@
+"""Central run queue shared by all irrigation programs."""
+import asyncio
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+POLICY_QUEUE   = 'queue'
+POLICY_PREEMPT = 'preempt'
+POLICY_MERGE   = 'merge'
+POLICY_DROP    = 'drop'
+POLICIES = [POLICY_QUEUE,POLICY_PREEMPT,POLICY_MERGE,POLICY_DROP]
+
+
+class RunRequest:
+    """A program waiting for, or holding, the irrigation supply."""
+
+    def __init__(self, program, zones, perform_eval, enqueued, sequence):
+        self.program      = program
+        self.zones        = zones
+        self.perform_eval = perform_eval
+        self.priority     = program.priority
+        self.enqueued     = enqueued
+        self.sequence     = sequence
+        self.preempted    = False
+        self.accepting    = True
+        self.resumed      = False
+        self.cancelled    = False
+        self.resume       = {}
+        self.scale        = 1.0
+        self.finished     = asyncio.Event()
+        self.stopping     = asyncio.Event()
+
+    @property
+    def zone_ids(self):
+        return [zone.get('zone') for zone in self.zones]
+
+    def stop(self):
+        """Ask the worker running the request to stop the program."""
+        self.stopping.set()
+
+
+class RunQueue:
+    """Start programs one at a time in priority order.
+
+    A request for a program while another is running is handled by the
+    policy: queue it, preempt the running program when the new request has
+    the same or a higher priority, merge its zones into the running
+    program, or drop it. Zones already running or waiting to run are
+    removed from new requests so no zone is watered twice, a preempting
+    request keeps the zones of the run it stops and they are removed from
+    that run's remainder instead.
+
+    on_cancel is called with the program of a preempted or resumed run
+    that is forgotten before it finishes, so its journal run is closed.
+    """
+
+    def __init__(self, hass, policy=POLICY_PREEMPT):
+        self._hass     = hass
+        self._policy   = policy
+        self._pending  = []
+        self._sequence = 0
+        self._worker   = None
+        self.running   = None
+        self.on_idle   = None
+        self.on_cancel = None
+
+    @property
+    def depth(self):
+        """Number of requests waiting to run."""
+        return len(self._pending)
+
+    def waiting(self, program):
+        """Seconds the program's queued request has waited, or None."""
+        for request in self._pending:
+            if request.program is program:
+                return round(self._hass.loop.time() - request.enqueued)
+        return None
+
+    async def async_submit(self, program, perform_eval, zones=None,
+                           resume=None, scale=1.0):
+        """Request a program run, applying the queue policy.
+
+        A run interrupted by a restart passes its remaining zones and the
+        schedules of the zones that had started. Scale shortens the water
+        time of every zone in the run.
+        """
+        if zones is None:
+            zones = program.zones
+        running = self.running
+        preempt = (running is not None and self._policy == POLICY_PREEMPT
+                   and program.priority >= running.priority
+                   and running.program is not program)
+        zones = self._deduplicate(list(zones), not preempt)
+        request = self._request(program, zones, perform_eval)
+        request.resume  = dict(resume or {})
+        request.resumed = resume is not None
+        request.scale   = scale
+        if not zones:
+            _LOGGER.info('%s zones are already queued', program.entity_id)
+            self._cancel(request)
+            return
+
+        if running is not None:
+            if self._policy == POLICY_DROP:
+                _LOGGER.info('%s dropped, %s is running',
+                             program.entity_id, running.program.entity_id)
+                self._cancel(request)
+                return
+            if (self._policy == POLICY_MERGE and running.accepting
+                    and running.program.can_merge):
+                running.zones.extend(zones)
+                return
+            if preempt:
+                request.sequence = -request.sequence
+                self._pending.append(request)
+                running.preempted = True
+                running.stop()
+                return
+
+        self._pending.append(request)
+        self._start()
+
+    def async_check_idle(self):
+        """Run on_idle when nothing is running or waiting, after a request
+        that ended without reaching the worker."""
+        if (self.on_idle is None or self.running is not None
+                or self._pending
+                or (self._worker is not None and not self._worker.done())):
+            return
+        self._hass.async_create_task(self.on_idle())
+
+    def async_clear(self):
+        """Forget every request waiting to run, a preempted run that is
+        stopping is not queued again."""
+        if self.running is not None:
+            self.running.cancelled = True
+        pending, self._pending = self._pending, []
+        for request in pending:
+            self._cancel(request)
+
+    async def async_remove(self, program):
+        """Forget the program's requests, stopping its run and waiting
+        for the run to end when it is running."""
+        running = self.running
+        if running is not None and running.program is program:
+            running.cancelled = True
+            running.stop()
+            await running.finished.wait()
+        for request in self._pending:
+            if request.program is program:
+                self._cancel(request)
+        self._pending = [request for request in self._pending
+                         if request.program is not program]
+
+    def _cancel(self, request):
+        if request.resumed and self.on_cancel is not None:
+            self.on_cancel(request.program)
+
+    def _request(self, program, zones, perform_eval):
+        self._sequence += 1
+        return RunRequest(program, zones, perform_eval,
+                          self._hass.loop.time(), self._sequence)
+
+    def _deduplicate(self, zones, running=True):
+        queued = set()
+        for request in self._pending:
+            queued.update(request.zone_ids)
+        if running and self.running is not None:
+            queued.update(self.running.zone_ids)
+        return [zone for zone in zones if zone.get('zone') not in queued]
+
+    def _start(self):
+        if self._worker is None or self._worker.done():
+            self._worker = self._hass.async_create_task(self._async_work())
+
+    async def _async_run(self, request):
+        """ run the program, stopping it here when a preempting request
+            or a removal asks, so the caller is not held up by the stop """
+        run = self._hass.async_create_task(
+            request.program.async_run_sequence(request))
+        stopping = self._hass.async_create_task(request.stopping.wait())
+        try:
+            await asyncio.wait([run, stopping],
+                               return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            run.cancel()
+            raise
+        finally:
+            stopping.cancel()
+        if not run.done():
+            await request.program.async_preempt()
+        await run
+
+    async def _async_work(self):
+        while self._pending:
+            self._pending.sort(key=lambda request:
+                               (-request.priority, request.sequence))
+            request = self._pending.pop(0)
+            self.running = request
+            request.program.async_queue_wait(
+                self._hass.loop.time() - request.enqueued)
+            try:
+                await self._async_run(request)
+            finally:
+                self.running = None
+                request.finished.set()
+
+            if request.preempted:
+                """ the unfinished zones wait behind the preempting run,
+                    less those it waters """
+                zones = []
+                if not request.cancelled:
+                    zones = self._deduplicate(request.zones)
+                requeued = self._request(request.program, zones,
+                                         request.perform_eval)
+                requeued.enqueued = request.enqueued
+                requeued.scale    = request.scale
+                requeued.resumed  = True
+                if zones:
+                    self._pending.append(requeued)
+                else:
+                    self._cancel(requeued)
+
+        if self.on_idle is not None:
+            """ in its own task, a request submitted meanwhile starts a
+                new worker """
+            self._hass.async_create_task(self.on_idle())
@@ -0,0 +1,341 @@
+"""Switch commands that are confirmed by the switch state.
+
+A command is sent, then the switch's state_changed event is awaited. When
+the switch does not reach the new state within the timeout the command is
+sent again, waiting longer between each attempt. A command for the state a
+switch already has, or for the state it is already being sent to, is not
+sent again. The time from sending to confirmation is kept per switch in a
+histogram.
+
+Switches can be grouped by the controller board that drives them. Each
+controller has its own limit on commands in flight, so boards are
+commanded in parallel without any one being sent more than it can take,
+and commands to an unavailable controller fail at once rather than
+waiting out their retries.
+
+Optimistic switches, like the MQTT switches in the example configuration,
+report the new state as soon as the command is sent, so confirmation only
+proves the command reached Home Assistant. Give the switch a state topic
+to confirm the valve itself.
+"""
+import asyncio
+import logging
+
+from homeassistant.const import (ATTR_ENTITY_ID, EVENT_STATE_CHANGED,
+                                 SERVICE_TURN_OFF, SERVICE_TURN_ON,
+                                 STATE_OFF, STATE_ON, STATE_UNAVAILABLE)
+from homeassistant.core import callback
+
+_LOGGER = logging.getLogger(__name__)
+
+CONST_SWITCH    = 'switch'
+CONFIRM_TIMEOUT = 5
+RETRIES         = 3
+BACKOFF         = 1
+LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000)
+
+UNAVAILABLE_SKIP       = 'skip'
+UNAVAILABLE_RESCHEDULE = 'reschedule'
+UNAVAILABLE_POLICIES   = [UNAVAILABLE_SKIP,UNAVAILABLE_RESCHEDULE]
+
+
+class SwitchStats:
+    """Command counts and confirmation latency of one switch."""
+
+    def __init__(self):
+        self.sent      = 0
+        self.coalesced = 0
+        self.retries   = 0
+        self.failures  = 0
+        self.latency   = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.call_time = 0.0
+        self.call_max  = 0.0
+
+    def record(self, seconds):
+        milliseconds = seconds * 1000
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if milliseconds <= bound:
+                self.latency[index] += 1
+                return
+        self.latency[-1] += 1
+
+    @property
+    def histogram(self):
+        """Confirmations counted by upper bound in milliseconds."""
+        labels = ['<={}'.format(bound) for bound in LATENCY_BUCKETS]
+        labels.append('>{}'.format(LATENCY_BUCKETS[-1]))
+        return dict(zip(labels, self.latency))
+
+    def record_call(self, seconds):
+        """Time spent in the switch service call itself."""
+        self.call_time += seconds
+        self.call_max   = max(self.call_max, seconds)
+
+    def as_dict(self):
+        return {'sent':self.sent,
+                'coalesced':self.coalesced,
+                'retries':self.retries,
+                'failures':self.failures}
+
+    def add(self, other):
+        """Accumulate another switch's counts into these."""
+        self.sent      += other.sent
+        self.coalesced += other.coalesced
+        self.retries   += other.retries
+        self.failures  += other.failures
+        self.call_time += other.call_time
+        self.call_max   = max(self.call_max, other.call_max)
+        self.latency = [mine + theirs for mine, theirs
+                        in zip(self.latency, other.latency)]
+
+
+class Controller:
+    """A board driving a group of switches."""
+
+    def __init__(self, hass, name, availability_entity=None, max_commands=1,
+                 unavailable=UNAVAILABLE_SKIP):
+        self._hass       = hass
+        self.name        = name
+        self.availability_entity = availability_entity
+        self.max_commands = max_commands
+        self.unavailable = unavailable
+        self.semaphore   = asyncio.Semaphore(max_commands)
+        self.switches    = []
+        self.in_flight   = 0
+        self._deferred   = {}
+
+    @property
+    def available(self):
+        """False when the availability entity is off or unavailable, or
+        when every switch on the controller is unavailable."""
+        if self.availability_entity is not None:
+            state = self._hass.states.get(self.availability_entity)
+            if state is not None and state.state in (STATE_OFF,
+                                                     STATE_UNAVAILABLE):
+                return False
+        states = [self._hass.states.get(switch) for switch in self.switches]
+        states = [state for state in states if state is not None]
+        return not states or any(state.state != STATE_UNAVAILABLE
+                                 for state in states)
+
+    def defer(self, program_id, zone):
+        """Hold a program's zone to run when the controller is available
+        again. The program is held by entity id, the entity may be
+        released or removed meanwhile."""
+        self._deferred.setdefault(program_id, []).append(zone)
+
+    def take_deferred(self):
+        """The program entity ids and zones held, which are then
+        forgotten."""
+        deferred, self._deferred = self._deferred, {}
+        return list(deferred.items())
+
+
+class SwitchCommander:
+    """Send switch commands and wait for the switches to confirm them."""
+
+    def __init__(self, hass, timeout=CONFIRM_TIMEOUT, retries=RETRIES):
+        self._hass     = hass
+        self._timeout  = timeout
+        self._retries  = retries
+        self._waiters  = {}
+        self._inflight = {}
+        self._wanted   = {}
+        self._controllers = {}
+        self.stats     = {}
+        hass.bus.async_listen(EVENT_STATE_CHANGED, self._state_changed)
+
+    def add_controller(self, controller):
+        for entity_id in controller.switches:
+            self._controllers[entity_id] = controller
+
+    def controller_for(self, entity_id):
+        return self._controllers.get(entity_id)
+
+    def controller_stats(self, controller):
+        """The counts of every switch on the controller together."""
+        stats = SwitchStats()
+        for entity_id in controller.switches:
+            stats.add(self.stats_for(entity_id))
+        return stats
+
+    def stats_for(self, entity_id):
+        if entity_id not in self.stats:
+            self.stats[entity_id] = SwitchStats()
+        return self.stats[entity_id]
+
+    @callback
+    def _state_changed(self, event):
+        entity_id = event.data.get(ATTR_ENTITY_ID)
+        if entity_id not in self._waiters:
+            return
+        new_state = event.data.get('new_state')
+        if new_state is not None:
+            self._confirm(entity_id, new_state.state)
+
+    @callback
+    def _confirm(self, entity_id, state):
+        """ resolve every waiter for the state the switch reached """
+        waiters = []
+        for target, future, sent in self._waiters.get(entity_id, []):
+            if target != state:
+                waiters.append((target, future, sent))
+            elif not future.done():
+                self.stats_for(entity_id).record(
+                    self._hass.loop.time() - sent)
+                future.set_result(True)
+        self._set_waiters(entity_id, waiters)
+
+    @callback
+    def _wait_for(self, entity_id, target):
+        """ waiters for the same state share the confirmation, a waiter
+            for the other state was superseded and fails at once rather
+            than waiting out the timeout """
+        waiters = []
+        for waiter in self._waiters.get(entity_id, []):
+            if waiter[0] == target:
+                waiters.append(waiter)
+            elif not waiter[1].done():
+                waiter[1].set_result(False)
+        future = self._hass.loop.create_future()
+        waiters.append((target, future, self._hass.loop.time()))
+        self._waiters[entity_id] = waiters
+        return future
+
+    @callback
+    def _drop_waiter(self, entity_id, future):
+        self._set_waiters(entity_id, [
+            waiter for waiter in self._waiters.get(entity_id, [])
+            if waiter[1] is not future])
+
+    @callback
+    def _set_waiters(self, entity_id, waiters):
+        if waiters:
+            self._waiters[entity_id] = waiters
+        else:
+            self._waiters.pop(entity_id, None)
+
+    @callback
+    def _confirm_current(self, entity_id):
+        """ the state may have changed while the call was made """
+        state = self._hass.states.get(entity_id)
+        if state is not None and entity_id in self._waiters:
+            self._confirm(entity_id, state.state)
+
+    async def async_turn(self, entity_id, on, force=False):
+        """Turn a switch on or off, True when the switch confirmed it."""
+        target = STATE_ON if on else STATE_OFF
+        stats = self.stats_for(entity_id)
+        inflight = self._inflight.get(entity_id)
+        if inflight is not None and inflight[0] == target:
+            stats.coalesced += 1
+            return await asyncio.shield(inflight[1])
+        state = self._hass.states.get(entity_id)
+        if (not force and inflight is None and state is not None
+                and state.state == target
+                and self._wanted.get(entity_id, target) == target):
+            """ a switch a batch is turning the other way is sent the
+                command even though it has not changed yet """
+            stats.coalesced += 1
+            return True
+
+        self._wanted[entity_id] = target
+        task = self._hass.async_create_task(
+            self._async_send(entity_id, target))
+        self._inflight[entity_id] = (target, task)
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if self._inflight.get(entity_id, (None, None))[1] is task:
+                del self._inflight[entity_id]
+
+    async def _async_send(self, entity_id, target):
+        stats = self.stats_for(entity_id)
+        service = SERVICE_TURN_ON if target == STATE_ON else SERVICE_TURN_OFF
+        controller = self._controllers.get(entity_id)
+        delay = BACKOFF
+        for attempt in range(self._retries + 1):
+            if self._wanted.get(entity_id) != target:
+                """ a later command replaced this one """
+                return False
+            if controller is not None and not controller.available:
+                """ an off command is still sent in case the board
+                    returns, but nothing waits on the controller """
+                stats.failures += 1
+                if target == STATE_OFF:
+                    stats.sent += 1
+                    await self._hass.services.async_call(
+                        CONST_SWITCH, service, {ATTR_ENTITY_ID:entity_id})
+                _LOGGER.error('%s not turned %s, controller %s is '
+                              'unavailable', entity_id, target,
+                              controller.name)
+                return False
+            if attempt:
+                stats.retries += 1
+                _LOGGER.warning('%s did not turn %s, retrying',
+                                entity_id, target)
+            if controller is not None:
+                await controller.semaphore.acquire()
+                controller.in_flight += 1
+            try:
+                future = self._wait_for(entity_id, target)
+                stats.sent += 1
+                called = self._hass.loop.time()
+                await self._hass.services.async_call(
+                    CONST_SWITCH, service, {ATTR_ENTITY_ID:entity_id})
+                stats.record_call(self._hass.loop.time() - called)
+                self._confirm_current(entity_id)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future),
+                                                  self._timeout)
+                except asyncio.TimeoutError:
+                    self._drop_waiter(entity_id, future)
+            finally:
+                if controller is not None:
+                    controller.in_flight -= 1
+                    controller.semaphore.release()
+            if attempt < self._retries:
+                await asyncio.sleep(delay)
+                delay *= 2
+
+        stats.failures += 1
+        _LOGGER.error('%s did not turn %s after %s attempts',
+                      entity_id, target, self._retries + 1)
+        return False
+
+    async def async_turn_all(self, entity_ids, on):
+        """Send one command for all the switches, then retry each switch
+        that does not confirm it on its own."""
+        if not entity_ids:
+            return True
+        target = STATE_ON if on else STATE_OFF
+        service = SERVICE_TURN_ON if on else SERVICE_TURN_OFF
+        futures = {}
+        for entity_id in entity_ids:
+            self._wanted[entity_id] = target
+            self.stats_for(entity_id).sent += 1
+            futures[entity_id] = self._wait_for(entity_id, target)
+
+        await self._hass.services.async_call(
+            CONST_SWITCH, service, {ATTR_ENTITY_ID:list(entity_ids)},
+            blocking=True)
+        for entity_id in entity_ids:
+            self._confirm_current(entity_id)
+        await asyncio.wait(list(futures.values()), timeout=self._timeout)
+
+        """ a switch sent another command meanwhile is left to it """
+        unconfirmed = []
+        superseded  = False
+        for entity_id, future in futures.items():
+            if not future.done():
+                self._drop_waiter(entity_id, future)
+                self.stats_for(entity_id).retries += 1
+                unconfirmed.append(entity_id)
+            elif not future.result():
+                superseded = True
+        if not unconfirmed:
+            return not superseded
+        results = await asyncio.gather(*[
+            self.async_turn(entity_id, on, force=True)
+            for entity_id in unconfirmed])
+        return all(results) and not superseded
@@ -0,0 +1,293 @@
+"""Cached rendering of irrigation program templates."""
+import hashlib
+import json
+import logging
+import re
+import time
+from collections import namedtuple
+
+import homeassistant.util.dt as dt_util
+from homeassistant.const import MATCH_ALL
+from homeassistant.exceptions import TemplateError
+from homeassistant.helpers.storage import Store
+from homeassistant.helpers.template import Template, extract_entities
+
+_LOGGER = logging.getLogger(__name__)
+
+STORAGE_KEY     = 'irrigation.templates'
+STORAGE_VERSION = 1
+
+TemplateAnalysis = namedtuple(
+    'TemplateAnalysis', 'entities time_trigger weekdays days_since condition')
+
+EXPRESSION_PATTERN = re.compile(r'^\s*\{\{(.*)\}\}\s*$', re.DOTALL)
+NOW_PATTERN = re.compile(r'\b(?:utc)?now\s*\(')
+
+""" states('sensor.time') == 'HH:MM' """
+TIME_TERM = re.compile(
+    r"""^states\(\s*['"]sensor\.time['"]\s*\)\s*==\s*"""
+    r"""['"](\d{1,2}):(\d{2})['"]$""")
+""" now().weekday() in [0,2,4] or now().weekday() == 0 """
+WEEKDAY_TERM = re.compile(
+    r"""^now\(\)\.weekday\(\)\s*(?:in\s*[\[\(]([\d\s,]*)[\]\)]"""
+    r"""|==\s*(\d))$""")
+""" now().strftime('%a') in ['Mon','Wed'] """
+DAY_NAME_TERM = re.compile(
+    r"""^now\(\)\.strftime\(\s*['"]%a['"]\s*\)\s*in\s*"""
+    r"""[\[\(]([\w\s,'"]*)[\]\)]$""")
+""" state_attr('irrigation.morning', 'days_since') > 2 """
+DAYS_SINCE_TERM = re.compile(
+    r"""^state_attr\(\s*['"]([\w.]+)['"]\s*,\s*['"]days_since['"]\s*\)"""
+    r"""\s*(>=|>|==)\s*(\d+)$""")
+DAY_NAMES = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+
+def _terms(expression):
+    """The terms of an expression joined by 'and', or None when it uses
+    'or' or a term does not balance its brackets."""
+    if re.search(r'\bor\b', expression):
+        return None
+    terms = [term.strip() for term in re.split(r'\band\b', expression)]
+    for term in terms:
+        if (not term or term.count('(') != term.count(')')
+                or term.count('[') != term.count(']')):
+            return None
+    return terms
+
+
+def parse_time_trigger(text):
+    """Split a template into its trigger time and remaining condition.
+
+    Returns None unless the template is a single expression of terms
+    joined by 'and', one of them a sensor.time comparison.
+    """
+    match = EXPRESSION_PATTERN.match(text)
+    if match is None:
+        return None
+    terms = _terms(match.group(1))
+    if terms is None:
+        return None
+    for index, term in enumerate(terms):
+        time_match = TIME_TERM.match(term)
+        if time_match is not None:
+            break
+    else:
+        return None
+    hour, minute = int(time_match.group(1)), int(time_match.group(2))
+    if hour > 23 or minute > 59:
+        return None
+    condition = ' and '.join(terms[:index] + terms[index + 1:])
+    return hour, minute, condition or None
+
+
+def _weekdays(term):
+    match = WEEKDAY_TERM.match(term)
+    if match is not None:
+        if match.group(2) is not None:
+            return frozenset([int(match.group(2))])
+        return frozenset(int(day) for day in match.group(1).split(',')
+                         if day.strip())
+    match = DAY_NAME_TERM.match(term)
+    if match is not None:
+        names = [name.strip().strip('\'"')
+                 for name in match.group(1).split(',') if name.strip()]
+        if all(name in DAY_NAMES for name in names):
+            return frozenset(DAY_NAMES.index(name) for name in names)
+    return None
+
+
+def parse_calendar(condition, entity_id=None):
+    """Take the weekday and days_since terms out of a condition.
+
+    Returns the weekdays the condition allows, Monday being 0, or None for
+    every day, the program's own days_since comparison as an operator and
+    a number, or None, and the terms left over as a condition, or None.
+    """
+    weekdays   = None
+    days_since = None
+    remaining  = []
+    for term in _terms(condition) if condition else []:
+        days = _weekdays(term)
+        if days is not None:
+            weekdays = days if weekdays is None else weekdays & days
+            continue
+        match = DAYS_SINCE_TERM.match(term)
+        if (match is not None and days_since is None
+                and match.group(1) == entity_id):
+            days_since = (match.group(2), int(match.group(3)))
+            continue
+        remaining.append(term)
+    return weekdays, days_since, ' and '.join(remaining) or None
+
+
+def analyse_template(hass, text, owner=None):
+    """The entities a template depends on and, when it is a sensor.time
+    trigger, its time, weekdays, days_since comparison and the condition
+    left over."""
+    entities = extract_entities(hass, text)
+    if entities != MATCH_ALL:
+        entities = sorted(set(entities))
+    trigger = parse_time_trigger(text)
+    if trigger is None:
+        return TemplateAnalysis(entities, None, None, None, None)
+    hour, minute, condition = trigger
+    weekdays, days_since, condition = parse_calendar(condition, owner)
+    return TemplateAnalysis(entities, (hour, minute), weekdays, days_since,
+                            condition)
+
+
+def _to_json(analysis):
+    return [analysis.entities, analysis.time_trigger,
+            sorted(analysis.weekdays) if analysis.weekdays is not None
+            else None,
+            analysis.days_since, analysis.condition]
+
+
+def _from_json(value):
+    entities, trigger, weekdays, days_since, condition = value
+    return TemplateAnalysis(
+        entities,
+        tuple(trigger) if trigger is not None else None,
+        frozenset(weekdays) if weekdays is not None else None,
+        tuple(days_since) if days_since is not None else None,
+        condition)
+
+
+def templates_hash(templates):
+    """A hash of the program templates by owner."""
+    text = json.dumps(sorted(templates.items()))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class TemplateAnalyser:
+    """Analyse every program template in one pass at start up.
+
+    The results are saved with a hash of the templates they came from, so
+    a start up with the same templates reads them back instead. A template
+    that changes on reload is analysed when it is asked for.
+    """
+
+    def __init__(self, hass):
+        self._hass    = hass
+        self._store   = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+        self._results = {}
+        self.analysed = 0
+        self.reused   = False
+
+    async def async_analyse(self, templates):
+        """templates maps the owner of each template to its text."""
+        key = templates_hash(templates)
+        data = await self._store.async_load()
+        if data is not None and data.get('hash') == key:
+            self._results = {owner:(templates[owner], _from_json(value))
+                             for owner, value in data['templates'].items()
+                             if owner in templates}
+            self.reused = True
+            return
+
+        self._results = {owner:(text, analyse_template(self._hass, text,
+                                                       owner))
+                         for owner, text in templates.items()}
+        self.analysed += len(self._results)
+        self._hass.async_create_task(self._store.async_save({
+            'hash':key,
+            'templates':{owner:_to_json(analysis) for owner, (text, analysis)
+                         in self._results.items()}}))
+
+    def get(self, owner, text):
+        """The analysis of the owner's template."""
+        result = self._results.get(owner)
+        if result is None or result[0] != text:
+            result = (text, analyse_template(self._hass, text, owner))
+            self._results[owner] = result
+            self.analysed += 1
+        return result[1]
+
+
+class CachedTemplate:
+    """A program template compiled once and rendered only when its inputs
+    change.
+
+    The render result is cached against the last_updated time of each
+    entity the template references, and the current minute when the
+    template calls now(). A template that fires on a sensor.time value
+    exposes time_trigger so the program can schedule a single callback
+    and render only the rest of the condition when it fires. Weekday and
+    days_since terms of such a template are exposed too, so the program
+    can predict its runs, and are not rendered. The rest of the condition
+    is compiled the first time it is rendered.
+    """
+
+    def __init__(self, hass, template, analysis):
+        """Compile the template and take its analysis."""
+        self._hass     = hass
+        self._template = template
+        self.entities  = analysis.entities
+        self.renders   = 0
+        self.cache_hits = 0
+        self.render_time = 0.0
+        self._key      = None
+        self._result   = None
+        self._uses_now = bool(NOW_PATTERN.search(template.template))
+        self.time_trigger = None
+        self.weekdays     = None
+        self.days_since   = None
+        self._condition   = None
+
+        template.hass = hass
+        try:
+            template.ensure_valid()
+        except TemplateError as err:
+            _LOGGER.error('template %s, invalid: %s', template.template, err)
+            return
+
+        if analysis.time_trigger is not None:
+            self.time_trigger = analysis.time_trigger
+            self.weekdays     = analysis.weekdays
+            self.days_since   = analysis.days_since
+            if analysis.condition:
+                self._condition = Template(
+                    '{{ ' + analysis.condition + ' }}', hass)
+
+    @property
+    def template(self):
+        """Return the underlying template."""
+        return self._template
+
+    def _version(self):
+        if self.entities == MATCH_ALL:
+            return None
+        key = []
+        for entity_id in self.entities:
+            state = self._hass.states.get(entity_id)
+            key.append(state.last_updated if state is not None else None)
+        if self._uses_now:
+            key.append(dt_util.now().replace(second=0, microsecond=0))
+        return tuple(key)
+
+    def _render(self, template):
+        start = time.perf_counter()
+        try:
+            return template.async_render()
+        finally:
+            self.renders += 1
+            self.render_time += time.perf_counter() - start
+
+    def async_render(self):
+        """Render the template, reusing the last result when nothing the
+        template depends on has changed."""
+        key = self._version()
+        if key is not None and key == self._key:
+            self.cache_hits += 1
+            return self._result
+
+        self._key    = None
+        self._result = self._render(self._template)
+        self._key    = key
+        return self._result
+
+    def async_render_trigger(self):
+        """Render the condition that accompanies the trigger time."""
+        if self._condition is None:
+            return 'True'
+        return self._render(self._condition)
@@ -0,0 +1,67 @@
+"""Deadline based phase timer for irrigation zones."""
+
+
+class PhaseTimer:
+    """Wake once at a phase boundary instead of polling every second.
+
+    Deadlines are held against the event loop's monotonic clock so the time
+    remaining can be calculated whenever it is asked for.
+    """
+
+    def __init__(self, loop):
+        """Initialise the timer against an event loop."""
+        self._loop    = loop
+        self._handle  = None
+        self._waiter  = None
+        self.deadline = None
+        self.wakeups  = 0
+
+    def now(self):
+        """Return the loop's monotonic time."""
+        return self._loop.time()
+
+    def remaining(self):
+        """Seconds until the current deadline, zero when idle."""
+        if self.deadline is None:
+            return 0
+        return max(0, self.deadline - self._loop.time())
+
+    @property
+    def waiting(self):
+        """True while a phase is pending."""
+        return self._waiter is not None and not self._waiter.done()
+
+    async def async_wait_until(self, deadline):
+        """Sleep until the deadline, return False if cancelled first."""
+        self.cancel()
+        self.deadline = deadline
+        waiter = self._waiter = self._loop.create_future()
+        self._handle = self._loop.call_at(deadline, self._expire, waiter)
+        try:
+            return await waiter
+        finally:
+            self._handle.cancel()
+            self._handle = None
+            if self._waiter is waiter:
+                self._waiter = None
+
+    async def async_wait(self, seconds):
+        """Sleep for a number of seconds, return False if cancelled first."""
+        return await self.async_wait_until(self._loop.time() + seconds)
+
+    def cancel(self):
+        """Release a pending wait immediately."""
+        if self._handle is not None:
+            self._handle.cancel()
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(False)
+
+    def finish(self):
+        """End a pending wait early as though its deadline was reached."""
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(True)
+
+    def _expire(self, waiter):
+        self.wakeups += 1
+        if not waiter.done():
+            waiter.set_result(True)
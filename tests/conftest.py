@@ -0,0 +1,185 @@
+"""Shared fixtures for the irrigation tests.
+
+The component directory is imported as the package irrigation, so the
+tests run from a checkout of the repository with Home Assistant installed.
+Tests of the whole component set it up on Home Assistant, which loads a
+copy of it as custom_components.irrigation.
+
+The event loop's clock is moved forward by the tests, so a zone watering
+for minutes runs in milliseconds. Home Assistant's now and utcnow move
+with it, timers on the loop fire as the clock passes them and a time
+changed event is fired for Home Assistant's own timers. Files are read
+and written in the executor in real time, so the clock only moves once
+the executor jobs started have finished.
+"""
+import asyncio
+from datetime import timedelta
+import os
+import shutil
+import sys
+
+import pytest
+
+from homeassistant import config_entries, core
+from homeassistant.const import ATTR_NOW, EVENT_TIME_CHANGED
+from homeassistant.setup import async_setup_component
+import homeassistant.util.dt as dt_util
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from simulator import install_component  # noqa: E402
+
+SETTLE_ROUNDS = 20
+
+
+def pytest_configure(config):
+    config.component_path = install_component()
+
+
+def pytest_unconfigure(config):
+    sys.path.remove(config.component_path)
+    shutil.rmtree(config.component_path, ignore_errors=True)
+
+
+class ClockLoop(asyncio.SelectorEventLoop):
+    """Event loop whose clock the tests move forward."""
+
+    def __init__(self):
+        super().__init__()
+        self.offset = 0.0
+
+    def time(self):
+        return super().time() + self.offset
+
+
+async def async_settle(hass):
+    """ until no callback is ready and no executor job is running """
+    while True:
+        for _ in range(SETTLE_ROUNDS):
+            await asyncio.sleep(0)
+        jobs = [job for job in hass.executor_jobs if not job.done()]
+        hass.executor_jobs.clear()
+        if not jobs:
+            return
+        await asyncio.wait(jobs)
+
+
+class Switches:
+    """Stand in switch platform recording each command.
+
+    A switch in stuck does not change state when commanded.
+    """
+
+    def __init__(self, hass):
+        self._hass  = hass
+        self.calls  = []
+        self.stuck  = set()
+        hass.services.async_register('switch', 'turn_on', self._async_call)
+        hass.services.async_register('switch', 'turn_off', self._async_call)
+
+    async def _async_call(self, call):
+        entity_ids = call.data['entity_id']
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        state = 'on' if call.service == 'turn_on' else 'off'
+        for entity_id in entity_ids:
+            self.calls.append((round(self._hass.loop.offset), entity_id,
+                               state))
+            if entity_id not in self.stuck:
+                self._hass.states.async_set(entity_id, state)
+
+    def timeline(self, entity_id=None):
+        """The commands sent, as (seconds, entity, state)."""
+        return [call for call in self.calls
+                if entity_id is None or call[1] == entity_id]
+
+
+@pytest.fixture
+def hass(tmp_path, monkeypatch):
+    """A Home Assistant instance on its own event loop, not started."""
+    loop = ClockLoop()
+    asyncio.set_event_loop(loop)
+    utcnow = dt_util.utcnow
+    now = dt_util.now
+    monkeypatch.setattr(dt_util, 'utcnow', lambda: utcnow()
+                        + timedelta(seconds=loop.offset))
+    monkeypatch.setattr(dt_util, 'now', lambda time_zone=None: now(time_zone)
+                        + timedelta(seconds=loop.offset))
+    instance = core.HomeAssistant(loop)
+    instance.config.config_dir = str(tmp_path)
+    instance.config.skip_pip = True
+    add_executor_job = instance.async_add_executor_job
+    instance.executor_jobs = []
+
+    def async_add_executor_job(target, *args):
+        job = add_executor_job(target, *args)
+        instance.executor_jobs.append(job)
+        return job
+
+    instance.async_add_executor_job = async_add_executor_job
+    yield instance
+    """ a run still watering when the test ended """
+    pending = asyncio.all_tasks(loop)
+    for task in pending:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    loop.run_until_complete(instance.async_stop(force=True))
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def run(hass):
+    """Run a coroutine to completion on the hass event loop."""
+    return hass.loop.run_until_complete
+
+
+@pytest.fixture
+def settle(hass, run):
+    """Let the tasks and callbacks that are ready run."""
+    return lambda: run(async_settle(hass))
+
+
+@pytest.fixture
+def advance(hass, run):
+    """Move the clock forward by seconds, a step at a time so each timer
+    fires at about its own time."""
+
+    async def async_advance(seconds, step):
+        moved = 0
+        while moved < seconds:
+            delta = min(step, seconds - moved)
+            hass.loop.offset += delta
+            moved += delta
+            hass.bus.async_fire(EVENT_TIME_CHANGED,
+                                {ATTR_NOW: dt_util.utcnow()})
+            await async_settle(hass)
+
+    return lambda seconds, step=1: run(async_advance(seconds, step))
+
+
+@pytest.fixture
+def switches(hass):
+    return Switches(hass)
+
+
+@pytest.fixture
+def component(hass, run, settle, switches):
+    """Set up the component from the irrigation section of a
+    configuration and return its diagnostics, which hold every program
+    and zone entity. The switches turned off at start up are not left in
+    the switch timeline."""
+
+    def setup(config):
+        hass.config_entries = config_entries.ConfigEntries(hass, {})
+        run(hass.config_entries.async_initialize())
+        assert run(async_setup_component(hass, 'irrigation',
+                                         {'irrigation': config}))
+        run(hass.async_start())
+        run(hass.async_block_till_done())
+        settle()
+        switches.calls.clear()
+        return hass.data['irrigation']['diagnostics']
+
+    return setup
@@ -0,0 +1,411 @@
+"""Discrete event simulator for irrigation programs.
+
+Programs and zones run unchanged against a local stand in for Home
+Assistant on an event loop with a virtual clock. When nothing is ready to
+run the clock jumps straight to the next timer, so hours of watering replay
+in milliseconds. Every switch command is recorded with its virtual time.
+The tests drive programs through it, and run from the repository root it
+reports the scheduler benchmark.
+
+    python tests/simulator.py
+
+The setup benchmark instead runs the real component setup on Home
+Assistant, with and without lazy mode, for configurations of growing size.
+
+    python tests/simulator.py setup
+"""
+import asyncio
+import os
+import selectors
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from homeassistant.const import (ATTR_ENTITY_ID, EVENT_STATE_CHANGED,
+                                 SERVICE_TURN_ON, STATE_OFF, STATE_ON)
+from homeassistant.core import CoreState
+from homeassistant.helpers import config_validation as cv
+
+from irrigation import (ATTR_IRRIG_ID, ATTR_LAZY, ATTR_PROGRAMS,
+                        ATTR_SWITCH, ATTR_TEMPLATE, ATTR_ZONE, ATTR_ZONES,
+                        CONST_SWITCH, DATA_SWITCHES, DOMAIN,
+                        ENTITY_ID_FORMAT, ZONE_ENTITY_ID_FORMAT,
+                        Irrigation, IrrigationZone)
+from irrigation.runqueue import RunQueue, RunRequest
+from irrigation.switches import SwitchCommander
+
+BENCHMARK_SIZES = (3, 10, 50, 100, 500)
+SETUP_SIZES     = (100, 500, 1000, 2000)
+ZONES_PER_PROGRAM = 10
+
+
+class _VirtualSelector:
+    """Selector that advances the loop clock instead of blocking."""
+
+    def __init__(self, loop, selector):
+        self._loop     = loop
+        self._selector = selector
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise RuntimeError('simulation stalled with nothing scheduled')
+        if timeout > 0:
+            self._loop.wakeups += 1
+            self._loop.now += timeout
+        return self._selector.select(0)
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """Event loop whose time() only moves when the loop would sleep."""
+
+    def __init__(self):
+        self.now     = 0.0
+        self.wakeups = 0
+        super().__init__(_VirtualSelector(self, selectors.DefaultSelector()))
+
+    def time(self):
+        return self.now
+
+
+class SimStates:
+    """State machine stand in counting writes per entity."""
+
+    def __init__(self, bus):
+        self._bus    = bus
+        self._states = {}
+        self.writes  = {}
+
+    def get(self, entity_id):
+        return self._states.get(entity_id)
+
+    def async_set(self, entity_id, new_state, attributes=None,
+                  force_update=False, context=None):
+        self.writes[entity_id] = self.writes.get(entity_id, 0) + 1
+        old_state = self._states.get(entity_id)
+        self._states[entity_id] = SimpleNamespace(
+            entity_id=entity_id, state=new_state,
+            attributes=dict(attributes or {}))
+        self._bus.async_fire(EVENT_STATE_CHANGED, {
+            ATTR_ENTITY_ID:entity_id, 'old_state':old_state,
+            'new_state':self._states[entity_id]})
+
+
+class SimServices:
+    """Service registry stand in that operates simulated switches."""
+
+    def __init__(self, hass, latency=0.0):
+        self._hass   = hass
+        self.latency = latency
+        self.events  = []
+        self.calls   = 0
+
+    async def async_call(self, domain, service, service_data=None,
+                         blocking=False, context=None):
+        if domain != CONST_SWITCH:
+            return
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        entity_ids = (service_data or {}).get(ATTR_ENTITY_ID, [])
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        new_state = STATE_ON if service == SERVICE_TURN_ON else STATE_OFF
+        for entity_id in entity_ids:
+            self.events.append((self._hass.loop.time(), entity_id,
+                                new_state))
+            self._hass.states.async_set(entity_id, new_state)
+
+
+class SimBus:
+    """Event bus stand in, start up listeners are never fired."""
+
+    def __init__(self):
+        self._listeners = {}
+
+    def async_listen_once(self, event_type, listener):
+        if asyncio.iscoroutine(listener):
+            listener.close()
+        return lambda: None
+
+    def async_listen(self, event_type, listener):
+        self._listeners.setdefault(event_type, []).append(listener)
+        return lambda: self._listeners[event_type].remove(listener)
+
+    def async_fire(self, event_type, event_data=None):
+        event = SimpleNamespace(event_type=event_type, data=event_data or {})
+        for listener in self._listeners.get(event_type, []):
+            listener(event)
+
+
+class SimHass:
+    """The parts of Home Assistant the irrigation entities use."""
+
+    def __init__(self, loop, latency=0.0):
+        self.loop     = loop
+        self.state    = CoreState.not_running
+        self.data     = {}
+        self.bus      = SimBus()
+        self.states   = SimStates(self.bus)
+        self.services = SimServices(self, latency)
+        self.config   = SimpleNamespace(
+            units=SimpleNamespace(temperature_unit=None),
+            path=lambda *parts: '/'.join(parts))
+
+    def async_create_task(self, target):
+        return self.loop.create_task(target)
+
+    def async_add_job(self, target, *args):
+        if asyncio.iscoroutine(target):
+            return self.loop.create_task(target)
+        return self.loop.call_soon(target, *args)
+
+
+class SimTemplate:
+    """Program template stand in, simulated programs run on request."""
+
+    entities     = []
+    time_trigger = None
+    renders      = 0
+    render_time  = 0.0
+    template     = 'True'
+
+    def async_render(self):
+        return 'True'
+
+
+class SimComponent:
+    """Entity component stand in."""
+
+    def __init__(self, entities):
+        self._entities = entities
+
+    def get_entity(self, entity_id):
+        return self._entities.get(entity_id)
+
+
+class SimResult:
+    """What happened during a simulated run."""
+
+    def __init__(self, hass, makespan, elapsed):
+        self.switch_events = hass.services.events
+        self.switch_calls  = hass.services.calls
+        self.state_writes  = hass.states.writes
+        self.wakeups       = hass.loop.wakeups
+        self.makespan      = makespan
+        self.elapsed       = elapsed
+
+    @property
+    def total_state_writes(self):
+        return sum(self.state_writes.values())
+
+    @property
+    def gaps(self):
+        """Seconds between a valve closing and another valve opening."""
+        gaps = []
+        closed = None
+        for when, entity_id, state in self.switch_events:
+            if state == STATE_OFF:
+                closed = (when, entity_id)
+            elif closed is not None:
+                if closed[1] != entity_id:
+                    gaps.append(when - closed[0])
+                closed = None
+        return gaps
+
+
+def simulate(config, program=None, latency=0.0):
+    """Run a program from the configuration on a virtual clock.
+
+    The configuration has the same shape as the irrigation section of
+    configuration.yaml after validation. The first program is run when
+    no program name is given.
+    """
+    loop = VirtualClockLoop()
+    try:
+        hass = SimHass(loop, latency)
+        start = time.perf_counter()
+        makespan = loop.run_until_complete(
+            _async_simulate(hass, config, program))
+        return SimResult(hass, makespan, time.perf_counter() - start)
+    finally:
+        loop.close()
+
+
+async def _async_simulate(hass, config, program_name):
+    hass.data[DOMAIN] = {DATA_SWITCHES:SwitchCommander(hass)}
+    entities = {}
+    for zone in config[ATTR_ZONES]:
+        entity = IrrigationZone(
+            ZONE_ENTITY_ID_FORMAT.format(cv.slugify(zone[ATTR_IRRIG_ID])),
+            zone, config)
+        entity.hass = hass
+        await entity.async_added_to_hass()
+        entities[entity.entity_id] = entity
+
+    queue = RunQueue(hass)
+    programs = config[ATTR_PROGRAMS]
+    if program_name is not None:
+        programs = [program for program in programs
+                    if program[ATTR_IRRIG_ID] == program_name]
+    attributes = programs[0]
+    program = Irrigation(
+        ENTITY_ID_FORMAT.format(cv.slugify(attributes[ATTR_IRRIG_ID])),
+        attributes, SimTemplate(), SimComponent(entities), queue)
+    program.hass = hass
+
+    request = RunRequest(program, list(attributes[ATTR_ZONES]), False,
+                         hass.loop.time(), 0)
+    start = hass.loop.time()
+    await program.async_run_sequence(request)
+    return hass.loop.time() - start
+
+
+def benchmark_config(size):
+    """A program watering a number of zones, every third zone in Eco."""
+    zones = []
+    for index in range(size):
+        zone = {ATTR_IRRIG_ID: 'zone {}'.format(index),
+                'water': 1 + index % 5,
+                ATTR_SWITCH: 'switch.solenoid_{:03}'.format(index)}
+        if index % 3 == 0:
+            zone.update({'wait': 2, 'repeat': 3})
+        zones.append(zone)
+    program = {ATTR_IRRIG_ID: 'benchmark',
+               ATTR_ZONES: [{ATTR_ZONE: ZONE_ENTITY_ID_FORMAT.format(
+                   cv.slugify(zone[ATTR_IRRIG_ID]))} for zone in zones]}
+    return {ATTR_ZONES: zones, ATTR_PROGRAMS: [program]}
+
+
+def benchmark(sizes=BENCHMARK_SIZES, latency=0.05):
+    """Simulate programs of increasing size and report the costs."""
+    rows = []
+    for size in sizes:
+        result = simulate(benchmark_config(size), latency=latency)
+        gaps = result.gaps
+        rows.append({
+            'zones': size,
+            'makespan': round(result.makespan),
+            'wakeups': result.wakeups,
+            'state_writes': result.total_state_writes,
+            'switch_calls': result.switch_calls,
+            'max_gap': round(max(gaps, default=0), 3),
+            'elapsed_ms': round(result.elapsed * 1000, 1)})
+    return rows
+
+
+def setup_config(size, lazy=False):
+    """Zones in programs of ten, each program watering at its own time
+    on two days of the week."""
+    zones = [{ATTR_IRRIG_ID: 'zone {}'.format(index),
+              'water': 5,
+              ATTR_SWITCH: 'switch.solenoid_{:04}'.format(index)}
+             for index in range(size)]
+    programs = []
+    for first in range(0, size, ZONES_PER_PROGRAM):
+        number = first // ZONES_PER_PROGRAM
+        minute = number % (24 * 60)
+        programs.append({
+            ATTR_IRRIG_ID: 'program {}'.format(number),
+            ATTR_TEMPLATE: "{{{{ states('sensor.time') == '{:02}:{:02}' and "
+                           "now().weekday() in [0,3] }}}}".format(
+                               minute // 60, minute % 60),
+            ATTR_ZONES: [{ATTR_ZONE: ZONE_ENTITY_ID_FORMAT.format(
+                cv.slugify(zone[ATTR_IRRIG_ID]))}
+                for zone in zones[first:first + ZONES_PER_PROGRAM]]})
+    return {DOMAIN: {ATTR_LAZY: lazy, ATTR_ZONES: zones,
+                     ATTR_PROGRAMS: programs}}
+
+
+async def _async_setup(config_dir, config, trace):
+    from homeassistant import config_entries, core
+    from homeassistant.setup import async_setup_component
+
+    hass = core.HomeAssistant()
+    hass.config.config_dir = config_dir
+    hass.config.skip_pip = True
+    hass.config_entries = config_entries.ConfigEntries(hass, {})
+    await hass.config_entries.async_initialize()
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    await async_setup_component(hass, DOMAIN, config)
+    await hass.async_block_till_done()
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0] if trace else None
+    tracemalloc.stop()
+    entities = len(hass.states.async_entity_ids())
+    await hass.async_stop()
+    return elapsed, memory, entities
+
+
+def _setup(config, trace):
+    config_dir = tempfile.mkdtemp()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(
+            _async_setup(config_dir, config, trace))
+    finally:
+        loop.close()
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+
+def install_component():
+    """Copy the component to a directory added to the module search path,
+    where Home Assistant loads it as custom_components.irrigation, and
+    return the directory."""
+    path = tempfile.mkdtemp()
+    shutil.copytree(os.path.join(ROOT, DOMAIN),
+                    os.path.join(path, 'custom_components', DOMAIN),
+                    ignore=shutil.ignore_patterns('__pycache__'))
+    sys.path.insert(0, path)
+    return path
+
+
+def setup_benchmark(sizes=SETUP_SIZES):
+    """Time the component setup and measure the memory it allocates,
+    with every program and zone an entity and in lazy mode.
+
+    The memory is what the setup leaves allocated on the Python heap,
+    measured with tracemalloc in a second setup so tracing does not slow
+    the timed one.
+    """
+    path = install_component()
+    rows = []
+    try:
+        for size in sizes:
+            for lazy in (False, True):
+                config = setup_config(size, lazy)
+                elapsed, _, entities = _setup(config, False)
+                _, memory, _ = _setup(config, True)
+                rows.append({
+                    'zones': size,
+                    'lazy': lazy,
+                    'entities': entities,
+                    'setup_ms': round(elapsed * 1000, 1),
+                    'memory_kb': round(memory / 1024)})
+    finally:
+        sys.path.remove(path)
+        shutil.rmtree(path, ignore_errors=True)
+    return rows
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['setup']:
+        ROWS = setup_benchmark()
+    else:
+        ROWS = benchmark()
+    COLUMNS = list(ROWS[0])
+    print(' '.join('{:>12}'.format(column) for column in COLUMNS))
+    for row in ROWS:
+        print(' '.join('{:>12}'.format(row[column]) for column in COLUMNS))
@@ -0,0 +1,77 @@
+"""Tests for reference evapotranspiration from weather sensor windows."""
+import pytest
+
+import homeassistant.util.dt as dt_util
+
+from irrigation.et import ETCalculator, RollingWindow, reference_et
+
+TEMPERATURE = 'sensor.temperature'
+PRESSURE    = 'sensor.pressure'
+SEA_LEVEL   = 101.325
+
+
+def test_rolling_window():
+    window = RollingWindow(60, max_samples=3)
+    for when, value in enumerate([5, 1, 4]):
+        window.add(when, value)
+    assert (window.minimum, window.maximum, window.total) == (1, 5, 10)
+    """ the oldest sample is dropped for the fourth """
+    window.add(3, 2)
+    assert (window.minimum, window.maximum, window.mean) == (1, 4, 7 / 3)
+    window.evict(61.5)
+    assert (window.minimum, window.maximum) == (2, 4)
+
+
+def _temperatures(hass):
+    for value in ('12', '28'):
+        hass.states.async_set(TEMPERATURE, value,
+                              {'unit_of_measurement': '°C'})
+
+
+def _calculator(hass, settle, pressure=None):
+    calculator = ETCalculator(hass, {'temperature': TEMPERATURE,
+                                     'pressure': pressure and PRESSURE})
+    calculator.async_start()
+    settle()
+    return calculator
+
+
+@pytest.mark.parametrize('value, unit', [
+    ('1013.25', 'hPa'), ('1013.25', 'mbar'), ('101325', 'Pa'),
+    ('101.325', 'kPa'), ('1.01325', 'bar'), ('29.92', 'inHg'),
+    ('14.696', 'psi'), ('1013.25', None), ('101.325', None)])
+def test_pressure_units(hass, settle, value, unit):
+    calculator = _calculator(hass, settle, pressure=True)
+    hass.states.async_set(PRESSURE, value, {} if unit is None else {
+        'unit_of_measurement': unit})
+    _temperatures(hass)
+    settle()
+    expected = reference_et(12, 28, hass.config.latitude,
+                            dt_util.now().timetuple().tm_yday,
+                            pressure=SEA_LEVEL)
+    assert calculator.et0() == pytest.approx(expected, rel=1e-4)
+
+
+def test_pressure_in_unknown_unit_is_not_used(hass, settle):
+    calculator = _calculator(hass, settle, pressure=True)
+    hass.states.async_set(PRESSURE, '760', {'unit_of_measurement': 'mmHg'})
+    _temperatures(hass)
+    settle()
+    assert calculator.et0() == pytest.approx(reference_et(
+        12, 28, hass.config.latitude, dt_util.now().timetuple().tm_yday))
+
+
+def test_et0_calculated_once_temperatures_arrive(hass, settle):
+    calculator = _calculator(hass, settle)
+    assert calculator.et0() is None
+    assert calculator.zone_depth('irrigation_zone.a', 1.0) is None
+    _temperatures(hass)
+    settle()
+    et0 = calculator.et0()
+    assert et0 is not None and et0 > 0
+    assert calculator.zone_depth('irrigation_zone.a', 0.5) == \
+        pytest.approx(et0 / 2)
+    """ cached for the rest of the day """
+    hass.states.async_set(TEMPERATURE, '40', {'unit_of_measurement': '°C'})
+    settle()
+    assert calculator.et0() == et0
@@ -0,0 +1,134 @@
+"""Tests for flow meters, learned zone flow and leak detection."""
+from types import SimpleNamespace
+
+import pytest
+
+from homeassistant.core import callback
+
+from irrigation.flow import (ANOMALY_CLOSED, ANOMALY_HIGH, EVENT_FLOW_ANOMALY,
+                             MIN_SAMPLES, SETTLE, Baseline, FlowMeter,
+                             FlowMonitor)
+
+MAIN = 'sensor.main_flow'
+
+
+def test_rate_sensor_litres_are_area_under_rate():
+    meter = FlowMeter(MAIN)
+    assert meter.add(0, 10) == 0
+    assert meter.rate == 10
+    assert meter.add(60, 20) == pytest.approx(15)
+    assert meter.add(90, 0) == pytest.approx(5)
+    assert meter.litres == pytest.approx(20)
+    assert meter.rate == 0
+
+
+def test_pulse_counter():
+    meter = FlowMeter(MAIN, pulses_per_litre=2)
+    meter.add(0, 100)
+    assert meter.add(30, 120) == 10
+    assert meter.rate == 20
+    """ the counter was reset """
+    assert meter.add(60, 10) == 5
+    assert meter.litres == 15
+    """ a counter that stops counting has no flow """
+    assert meter.rate_at(200) == 0
+
+
+def test_baseline_learns_mean():
+    baseline = Baseline()
+    for rate in [10] * (MIN_SAMPLES - 1):
+        baseline.add(rate)
+    assert not baseline.learned
+    baseline.add(20)
+    assert baseline.learned
+    assert 10 < baseline.mean < 12
+
+
+class Zone(SimpleNamespace):
+    """Stand in zone as the monitor sees it."""
+
+    def async_add_litres(self, litres, rate):
+        self.litres += litres
+
+
+def _anomalies(hass):
+    """ the anomaly events fired from now on """
+    events = []
+    hass.bus.async_listen(EVENT_FLOW_ANOMALY,
+                          callback(lambda event: events.append(event.data)))
+    return events
+
+
+def _monitor(hass, run, zone):
+    monitor = FlowMonitor(hass, MAIN)
+    monitor.zones[zone.entity_id] = zone
+    run(monitor.async_start())
+    return monitor, _anomalies(hass)
+
+
+def test_flow_while_closed(hass, run, settle, advance):
+    zone = Zone(entity_id='irrigation_zone.a', valve_open=False,
+                water_started=None, litres=0.0)
+    monitor, events = _monitor(hass, run, zone)
+    hass.states.async_set(MAIN, '0')
+    hass.states.async_set(MAIN, '4')
+    settle()
+    advance(SETTLE - 5)
+    assert not events
+    """ the meter does not report again, the recheck finds the flow """
+    advance(10)
+    assert [event['type'] for event in events] == [ANOMALY_CLOSED]
+    assert monitor.anomalies == 1
+    assert zone.litres == 0
+
+
+def test_flow_above_baseline(hass, run, settle, advance):
+    zone = Zone(entity_id='irrigation_zone.a', valve_open=True,
+                water_started=hass.loop.time(), litres=0.0)
+    monitor, events = _monitor(hass, run, zone)
+    stopped = []
+
+    async def async_stop():
+        stopped.append(True)
+
+    monitor.on_anomaly = async_stop
+    advance(SETTLE)
+    for sample in range(MIN_SAMPLES):
+        hass.states.async_set(MAIN, str(10 + sample % 2))
+        advance(5)
+    assert monitor.baseline(zone) == pytest.approx(10.5, abs=0.5)
+    assert zone.litres > 0
+    assert not events
+    hass.states.async_set(MAIN, '20')
+    settle()
+    assert [event['type'] for event in events] == [ANOMALY_HIGH]
+    assert stopped == [True]
+
+
+def test_leak_stops_running_program(hass, component, switches, run, settle,
+                                    advance):
+    diagnostics = component({
+        'flow_sensor': MAIN,
+        'zones': [{'name': 'a', 'water': 10, 'switch_entity': 'switch.a'}],
+        'programs': [{'name': 'p', 'template': '{{ false }}',
+                      'zones': [{'zone': 'irrigation_zone.a'}]}]})
+    switches.calls.clear()
+    run(hass.services.async_call('irrigation', 'run_program',
+                                 {'entity_id': 'irrigation.p'}))
+    settle()
+    advance(SETTLE, 5)
+    for sample in range(MIN_SAMPLES + 1):
+        hass.states.async_set(MAIN, ('10', '10.0')[sample % 2])
+        advance(5, 5)
+    zone = diagnostics.zones['irrigation_zone.a']
+    assert hass.data['irrigation']['flow'].baseline(zone) == 10
+    events = _anomalies(hass)
+    hass.states.async_set(MAIN, '30')
+    advance(5, 5)
+    assert [(event['type'], event['entity_id']) for event in events] == [
+        (ANOMALY_HIGH, 'irrigation_zone.a')]
+    assert switches.timeline('switch.a') == [(0, 'switch.a', 'on'),
+                                             (90, 'switch.a', 'off')]
+    state = hass.states.get('irrigation_zone.a')
+    assert state.state == 'off'
+    assert state.attributes['actual_time'] == 90
@@ -0,0 +1,55 @@
+"""Tests for the run decisions made from a weather entity's forecast."""
+import homeassistant.util.dt as dt_util
+
+from irrigation.forecast import (ACTION_DEFER, ACTION_RUN, ACTION_SHORTEN,
+                                 ACTION_SKIP, ForecastDecision,
+                                 WeatherForecast)
+
+NOW     = dt_util.parse_datetime('2026-10-19T06:00:00+00:00').timestamp()
+WEATHER = 'weather.home'
+
+
+def _weather(hass, *hours):
+    """Set the stand in weather entity to an hourly forecast of
+    (hours from now, mm, probability) entries."""
+    hass.states.async_set(WEATHER, 'cloudy', {'forecast': [
+        {'datetime': dt_util.utc_from_timestamp(
+            NOW + hour * 3600).isoformat(),
+         'precipitation': rain,
+         'precipitation_probability': probability}
+        for hour, rain, probability in hours]})
+    return WeatherForecast(hass, WEATHER)
+
+
+def test_run_without_forecast(hass):
+    assert WeatherForecast(hass, WEATHER).decide(now=NOW) == \
+        ForecastDecision(ACTION_RUN, 0.0, 1.0, None)
+
+
+def test_skip_heavy_rain(hass):
+    forecast = _weather(hass, (0, 3, None), (1, 3, None))
+    assert forecast.decide(now=NOW) == \
+        ForecastDecision(ACTION_SKIP, 6.0, 0.0, None)
+
+
+def test_shorten_by_expected_rain(hass):
+    """An uncertain 2 mm counts as 1 mm and is not likely enough to
+    defer for."""
+    forecast = _weather(hass, (0, 2, 50))
+    assert forecast.decide(now=NOW) == \
+        ForecastDecision(ACTION_SHORTEN, 1.0, 0.8, None)
+
+
+def test_defer_until_rain_ends(hass):
+    forecast = _weather(hass, (2, 3, 80), (3, 1, 90), (4, 0, 0))
+    assert forecast.decide(now=NOW) == \
+        ForecastDecision(ACTION_DEFER, 3.3, 1.0, NOW + 4 * 3600)
+    assert forecast.decide(allow_defer=False, now=NOW) == \
+        ForecastDecision(ACTION_SHORTEN, 3.3, 0.34, None)
+
+
+def test_forecast_parsed_once(hass):
+    forecast = _weather(hass, (0, 0, 0), (1, 0, 0))
+    forecast.decide(now=NOW)
+    forecast.decide(now=NOW)
+    assert forecast.parses == 1
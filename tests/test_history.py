@@ -0,0 +1,50 @@
+"""Tests for the watering history ring buffer and files."""
+from irrigation.history import (RECORD, REASON_RAIN, REASON_WATERED,
+                                HistoryRing, WateringHistory)
+
+
+def _ring(capacity, starts):
+    ring = HistoryRing(capacity)
+    for start in starts:
+        ring.append(RECORD.pack(start, start + 1, 1.0, 2.0, REASON_WATERED))
+    return ring
+
+
+def test_ring_empty():
+    ring = HistoryRing(4)
+    assert ring.count == 0
+    assert ring.oldest is None
+    assert ring.query(0, 100) == []
+
+
+def test_ring_overwrites_oldest():
+    ring = _ring(3, [1, 2, 3, 4, 5])
+    assert ring.count == 3
+    assert ring.oldest == 3
+    assert [ring.record(index).start for index in range(3)] == [3, 4, 5]
+    assert ring.record(2) == (5, 6, 1.0, 2.0, REASON_WATERED)
+
+
+def test_ring_query_is_half_open():
+    ring = _ring(4, [10, 20, 30, 40, 50])
+    assert [record.start for record in ring.query(20, 40)] == [20, 30]
+    assert [record.start for record in ring.query(0, 35)] == [20, 30]
+    assert ring.query(60, 70) == []
+
+
+def test_query_reads_beyond_ring_from_file(hass, run, tmp_path):
+    history = WateringHistory(hass, str(tmp_path / 'history'), capacity=2)
+    for start in (10, 20, 30, 40):
+        history.async_record('irrigation_zone.a', start, start + 5, 1.0)
+    history.async_record('irrigation_zone.a', 50, 50, reason=REASON_RAIN)
+    run(hass.async_block_till_done())
+    records = run(history.async_query('irrigation_zone.a', 0, 100))
+    assert [record.start for record in records] == [10, 20, 30, 40, 50]
+    assert records[-1].reason == REASON_RAIN
+    assert history.totals('irrigation_zone.a', 0, 100) == (1.0, 0.0)
+
+    reloaded = WateringHistory(hass, str(tmp_path / 'history'), capacity=2)
+    run(reloaded.async_load('irrigation_zone.a'))
+    assert reloaded.stored_count('irrigation_zone.a') == 5
+    assert [record.start for record in run(reloaded.async_query(
+        'irrigation_zone.a', 15, 45))] == [20, 30, 40]
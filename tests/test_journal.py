@@ -0,0 +1,187 @@
+"""Tests for replaying and compacting the run journal and for the runs
+it closes and resumes."""
+import os
+
+import yaml
+
+import homeassistant.util.dt as dt_util
+
+from irrigation import journal
+from irrigation.journal import RunJournal
+
+PROGRAM = 'irrigation.morning'
+
+
+def _journal(hass, tmp_path):
+    return RunJournal(hass, str(tmp_path / journal.JOURNAL_FILE))
+
+
+def _lines(tmp_path):
+    with open(str(tmp_path / journal.JOURNAL_FILE)) as lines:
+        return lines.readlines()
+
+
+def test_replay_interrupted_run(hass, run, tmp_path):
+    writer = _journal(hass, tmp_path)
+    writer.program_start(PROGRAM, ['irrigation_zone.a', 'irrigation_zone.b',
+                                   'irrigation_zone.c'])
+    writer.zone_start(PROGRAM, 'irrigation_zone.a', 1000, [(0, 60)])
+    writer.phase(PROGRAM, 'irrigation_zone.a', 0, 'water')
+    writer.zone_end(PROGRAM, 'irrigation_zone.a')
+    writer.zone_start(PROGRAM, 'irrigation_zone.b', 1060.5,
+                      [(0, 60), (180, 240.5)])
+    writer.program_start('irrigation.evening', ['irrigation_zone.c'])
+    writer.program_end('irrigation.evening')
+    run(writer.async_flush())
+
+    runs = run(_journal(hass, tmp_path).async_load())
+    assert list(runs) == [PROGRAM]
+    assert runs[PROGRAM].remaining == ['irrigation_zone.b',
+                                       'irrigation_zone.c']
+    assert runs[PROGRAM].schedules == {
+        'irrigation_zone.b': (1060.5, [(0.0, 60.0), (180.0, 240.5)])}
+
+
+def test_replay_ignores_damaged_record(hass, run, tmp_path):
+    with open(str(tmp_path / journal.JOURNAL_FILE), 'w') as lines:
+        lines.write('P 1.000 {} irrigation_zone.a\n'.format(PROGRAM))
+        lines.write('Z 2.000 {} irrigation_zone.a 10 0-x\n'.format(PROGRAM))
+        lines.write('D 3.000\n')
+    runs = run(_journal(hass, tmp_path).async_load())
+    assert runs[PROGRAM].remaining == ['irrigation_zone.a']
+    assert runs[PROGRAM].schedules == {}
+
+
+def test_compaction_keeps_unfinished_runs(hass, run, tmp_path,
+                                          monkeypatch):
+    monkeypatch.setattr(journal, 'COMPACT_RECORDS', 10)
+    writer = _journal(hass, tmp_path)
+    for index in range(5):
+        program = 'irrigation.p{}'.format(index)
+        writer.program_start(program, ['irrigation_zone.a'])
+        writer.program_end(program)
+    writer.program_start(PROGRAM, ['irrigation_zone.a', 'irrigation_zone.b'])
+    writer.zone_start(PROGRAM, 'irrigation_zone.a', 1000, [(0, 60)])
+    writer.zone_end(PROGRAM, 'irrigation_zone.a')
+    writer.zone_start(PROGRAM, 'irrigation_zone.b', 1060, [(0, 60)])
+    run(writer.async_flush())
+
+    """ the ended programs are gone, only the running one is kept """
+    assert [line.split()[0] for line in _lines(tmp_path)] == ['P', 'Z', 'D']
+    runs = run(_journal(hass, tmp_path).async_load())
+    assert list(runs) == [PROGRAM]
+    assert runs[PROGRAM].remaining == ['irrigation_zone.b']
+    assert runs[PROGRAM].schedules == {
+        'irrigation_zone.b': (1060.0, [(0.0, 60.0)])}
+
+    """ later records are appended to the compacted journal """
+    writer.program_end(PROGRAM)
+    run(writer.async_flush())
+    assert len(_lines(tmp_path)) == 4
+    assert run(_journal(hass, tmp_path).async_load()) == {}
+
+
+def test_stop_time(hass, run, tmp_path):
+    writer = _journal(hass, tmp_path)
+    writer.program_start(PROGRAM, ['irrigation_zone.a'])
+    writer.zone_start(PROGRAM, 'irrigation_zone.a', 1000, [(0, 600)])
+    run(writer.async_flush())
+    stopped = dt_util.utcnow().timestamp()
+    reader = _journal(hass, tmp_path)
+    run(reader.async_load())
+    """ without a stop record the last record is the stop time """
+    assert abs(reader.stopped - stopped) < 1
+
+    hass.loop.offset += 60
+    writer.stop()
+    run(writer.async_flush())
+    reader = _journal(hass, tmp_path)
+    assert list(run(reader.async_load())) == [PROGRAM]
+    assert abs(reader.stopped - stopped - 60) < 1
+
+
+def _zone(name, water=1):
+    return {'name': name, 'water': water, 'switch_entity': 'switch.' + name}
+
+
+def _program(name, zones, priority=0):
+    return {'name': name, 'template': '{{ false }}', 'priority': priority,
+            'zones': [{'zone': 'irrigation_zone.' + zone} for zone in zones]}
+
+
+def _preempt(hass, component, run, settle, advance, programs):
+    """ p1 is preempted by p2 and waits to carry on """
+    component({'zones': [_zone('a'), _zone('b'), _zone('c')],
+               'programs': programs})
+    for entity_id in ('irrigation.p1', 'irrigation.p2'):
+        run(hass.services.async_call('irrigation', 'run_program',
+                                     {'entity_id': entity_id}))
+        settle()
+        advance(10)
+    assert hass.states.get('irrigation.p1').attributes['queue_depth'] == 1
+
+
+def _open_runs(hass, run):
+    run(hass.data['irrigation']['journal'].async_flush())
+    return run(RunJournal(hass, hass.config.path(
+        '.storage', journal.JOURNAL_FILE)).async_load())
+
+
+def test_stopped_preempted_run_is_closed(hass, component, switches, run,
+                                         settle, advance):
+    _preempt(hass, component, run, settle, advance,
+             [_program('p1', ['a', 'b']), _program('p2', ['c'], 5)])
+    assert list(_open_runs(hass, run)) == ['irrigation.p1', 'irrigation.p2']
+    run(hass.services.async_call('irrigation', 'stop_programs', {},
+                                 blocking=True))
+    settle()
+    assert _open_runs(hass, run) == {}
+    advance(300)
+    """ nothing runs after the stop turned every switch off """
+    assert switches.timeline()[:3] == [
+        (0, 'switch.a', 'on'), (10, 'switch.a', 'off'), (10, 'switch.c', 'on')]
+    assert sorted(switches.timeline()[3:]) == [
+        (20, 'switch.a', 'off'), (20, 'switch.b', 'off'),
+        (20, 'switch.c', 'off')]
+
+
+def test_removed_preempted_run_is_closed(hass, component, switches, run,
+                                         settle, advance):
+    _preempt(hass, component, run, settle, advance,
+             [_program('p1', ['a', 'b']), _program('p2', ['c'], 5)])
+    with open(hass.config.path('configuration.yaml'), 'w') as config_file:
+        yaml.safe_dump({'irrigation': {
+            'zones': [_zone('a'), _zone('b'), _zone('c')],
+            'programs': [_program('p2', ['c'], 5)]}}, config_file)
+    run(hass.services.async_call('irrigation', 'reload', {}, blocking=True))
+    settle()
+    assert list(_open_runs(hass, run)) == ['irrigation.p2']
+    advance(300)
+    assert _open_runs(hass, run) == {}
+    assert [call for call in switches.timeline() if call[2] == 'on'] == [
+        (0, 'switch.a', 'on'), (10, 'switch.c', 'on')]
+
+
+def test_resume_does_not_count_downtime(hass, component, switches, run,
+                                        advance):
+    """ zone a had watered 1 of its 5 minutes when Home Assistant stopped
+        3 minutes ago """
+    now = dt_util.utcnow().timestamp()
+    os.makedirs(hass.config.path('.storage'))
+    writer = RunJournal(hass, hass.config.path('.storage',
+                                               journal.JOURNAL_FILE))
+    hass.loop.offset -= 240
+    writer.program_start('irrigation.p1', ['irrigation_zone.a'])
+    writer.zone_start('irrigation.p1', 'irrigation_zone.a', now - 240,
+                      [(0, 300)])
+    hass.loop.offset += 60
+    writer.stop()
+    run(writer.async_flush())
+    hass.loop.offset += 180
+
+    component({'zones': [_zone('a', 5)],
+               'programs': [_program('p1', ['a'])]})
+    assert hass.states.get('switch.a').state == 'on'
+    advance(300)
+    assert switches.timeline() == [(240, 'switch.a', 'off')]
+    assert _open_runs(hass, run) == {}
@@ -0,0 +1,70 @@
+"""Tests for programs kept in the schedule table until they are due."""
+from datetime import timedelta
+
+from homeassistant.const import EVENT_STATE_CHANGED
+from homeassistant.core import callback
+import homeassistant.util.dt as dt_util
+
+
+def _entities(hass):
+    return sorted(entity_id for entity_id in hass.states.async_entity_ids()
+                  if entity_id.startswith('irrigation'))
+
+
+def _config(due, condition=''):
+    return {
+        'lazy': True,
+        'zones': [
+            {'name': 'a', 'water': 1, 'switch_entity': 'switch.a'},
+            {'name': 'b', 'water': 1, 'switch_entity': 'switch.b',
+             'pinned': True}],
+        'programs': [
+            {'name': 'lz',
+             'template': "{{ states('sensor.time') == '%02d:%02d'%s }}" % (
+                 due.hour, due.minute, condition),
+             'zones': [{'zone': 'irrigation_zone.a'}]}]}
+
+
+def _due():
+    """ at least a minute ahead, whatever the second now """
+    return dt_util.now() + timedelta(minutes=2)
+
+
+def _created(hass):
+    """ the entities added from now on """
+    created = []
+
+    @callback
+    def listener(event):
+        if event.data['old_state'] is None:
+            created.append(event.data['entity_id'])
+
+    hass.bus.async_listen(EVENT_STATE_CHANGED, listener)
+    return created
+
+
+def test_program_created_when_due_and_released(hass, component, switches,
+                                               advance):
+    diagnostics = component(_config(_due()))
+    assert _entities(hass) == ['irrigation_zone.b']
+    assert diagnostics.programs == {}
+    created = _created(hass)
+
+    """ due within two minutes, then watering for one """
+    advance(300, 5)
+    on, off = switches.timeline('switch.a')
+    assert on[2] == 'on' and 60 <= on[0] <= 125
+    assert off[0] - on[0] == 60
+    assert sorted(created) == ['irrigation.lz', 'irrigation_zone.a']
+    assert _entities(hass) == ['irrigation_zone.b']
+    assert diagnostics.programs == {}
+
+
+def test_false_condition_creates_nothing(hass, component, switches, advance):
+    hass.states.async_set('input_boolean.go', 'off')
+    component(_config(_due(), " and is_state('input_boolean.go','on')"))
+    created = _created(hass)
+    advance(300, 5)
+    assert switches.timeline('switch.a') == []
+    assert created == []
+    assert _entities(hass) == ['irrigation_zone.b']
@@ -0,0 +1,102 @@
+"""Tests for the reference counted master valve or pump switch."""
+from irrigation.master import MasterSwitch
+
+PUMP = 'switch.pump'
+
+
+def _master(hass, commands, pre_start=0, post_stop=5):
+
+    async def async_turn(switch, on):
+        commands.append((round(hass.loop.offset), switch, on))
+        return True
+
+    return MasterSwitch(hass, PUMP, async_turn, pre_start, post_stop)
+
+
+def test_held_on_while_any_zone_runs(hass, run, advance):
+    commands = []
+    master = _master(hass, commands)
+    assert round(run(master.async_acquire())) == 0
+    assert run(master.async_acquire()) == 0
+    master.release()
+    advance(10)
+    assert master.on and master.users == 1
+    master.release()
+    advance(4)
+    assert master.on
+    advance(2)
+    assert not master.on
+    assert commands == [(0, PUMP, True), (15, PUMP, False)]
+    assert (master.starts, master.zone_runs) == (1, 2)
+    assert round(master.duty) == 15
+
+
+def test_zone_within_post_stop_keeps_switch_on(hass, run, advance):
+    commands = []
+    master = _master(hass, commands)
+    run(master.async_acquire())
+    master.release()
+    advance(3)
+    run(master.async_acquire())
+    advance(10)
+    master.release()
+    advance(6)
+    assert commands == [(0, PUMP, True), (18, PUMP, False)]
+    assert master.starts == 1
+
+
+def test_first_valve_waits_for_pre_start(hass, run, settle, advance):
+    commands = []
+    master = _master(hass, commands, pre_start=3)
+    waited = []
+    hass.async_create_task(_async_record(master, waited))
+    settle()
+    assert commands == [(0, PUMP, True)] and not waited
+    advance(3)
+    assert waited == [3]
+    """ the switch is ready, the next zone does not wait """
+    assert run(master.async_acquire()) == 0
+
+
+async def _async_record(master, waited):
+    waited.append(round(await master.async_acquire()))
+
+
+def test_halt_releases_waiting_zone(hass, settle, advance):
+    commands = []
+    master = _master(hass, commands, pre_start=30)
+    waited = []
+    hass.async_create_task(_async_record(master, waited))
+    settle()
+    master.halt()
+    settle()
+    assert waited == [0]
+    assert not master.on
+
+
+def test_program_holds_pump_across_zones(hass, component, switches, run,
+                                         settle, advance):
+    component({
+        'master_switch': PUMP,
+        'master_post_stop': 5,
+        'zones': [
+            {'name': 'a', 'water': 1, 'switch_entity': 'switch.a'},
+            {'name': 'b', 'water': 1, 'switch_entity': 'switch.b',
+             'wait': 1, 'repeat': 2}],
+        'programs': [
+            {'name': 'p', 'template': '{{ false }}',
+             'zones': [{'zone': 'irrigation_zone.a'},
+                       {'zone': 'irrigation_zone.b'}]}]})
+    switches.calls.clear()
+    run(hass.services.async_call('irrigation', 'run_program',
+                                 {'entity_id': 'irrigation.p'}))
+    settle()
+    advance(300)
+    assert switches.timeline(PUMP) == [(0, PUMP, 'on'), (245, PUMP, 'off')]
+    assert switches.timeline('switch.b') == [
+        (60, 'switch.b', 'on'), (120, 'switch.b', 'off'),
+        (180, 'switch.b', 'on'), (240, 'switch.b', 'off')]
+    state = hass.states.get('irrigation_master.pump')
+    assert state.state == 'off'
+    assert (state.attributes['starts'], state.attributes['zone_runs'],
+            state.attributes['cycles']) == (1, 2, 3)
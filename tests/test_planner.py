@@ -0,0 +1,82 @@
+"""Tests for the zone scheduling helpers."""
+from datetime import date
+
+import homeassistant.util.dt as dt_util
+
+from irrigation.planner import (ZoneRun, eco_cycles, makespan,
+                                next_run_dates, parallel_plan, run_times,
+                                sequential_plan)
+
+
+def test_eco_cycles_nothing_to_apply():
+    assert eco_cycles(0, 20) == (0, 0, 0)
+
+
+def test_eco_cycles_without_infiltration_limit():
+    """Only the longest cycle splits the water."""
+    assert eco_cycles(10, 20) == (1800, 0, 1)
+    assert eco_cycles(20, 20) == (1800, 0, 2)
+
+
+def test_eco_cycles_stop_before_runoff():
+    """10 mm at 40 mm/h on soil taking 10 mm/h ponds 2.5 mm in 300 s,
+    which takes 900 s to soak in."""
+    water, wait, repeat = eco_cycles(10, 40, 10)
+    assert (water, wait, repeat) == (300, 900, 3)
+    assert water * repeat >= 10 / 40 * 3600
+
+
+def test_parallel_plan_fills_eco_waits():
+    runs = [ZoneRun('a', 60, 120, 3, None), ZoneRun('b', 120, 0, 1, None)]
+    plan = parallel_plan(runs, max_concurrent=1)
+    assert plan == {'a': [(0, 60), (180, 240), (360, 420)],
+                    'b': [(60, 180)]}
+    assert makespan(plan) == 420
+    assert makespan(sequential_plan(runs)) == 540
+
+
+def test_parallel_plan_keeps_within_flow_limit():
+    runs = [ZoneRun('a', 60, 0, 1, 10), ZoneRun('b', 60, 0, 1, 10)]
+    assert parallel_plan(runs, flow_limit=15) == {'a': [(0, 60)],
+                                                  'b': [(60, 120)]}
+    assert parallel_plan(runs, flow_limit=20) == {'a': [(0, 60)],
+                                                  'b': [(0, 60)]}
+
+
+def test_parallel_plan_runs_zone_over_flow_limit_alone():
+    runs = [ZoneRun('a', 60, 0, 1, 30), ZoneRun('b', 30, 0, 1, 5)]
+    assert parallel_plan(runs, flow_limit=20) == {'a': [(0, 60)],
+                                                  'b': [(60, 90)]}
+
+
+def test_parallel_plan_empty():
+    assert parallel_plan([]) == {}
+
+
+def test_next_run_dates_weekdays():
+    monday = date(2026, 10, 19)
+    assert next_run_dates(monday, frozenset([0, 2]), count=3) == [
+        date(2026, 10, 19), date(2026, 10, 21), date(2026, 10, 26)]
+
+
+def test_next_run_dates_days_since_counts_from_each_run():
+    first = date(2026, 10, 19)
+    assert next_run_dates(first, None, ('>', 2), date(2026, 10, 18),
+                          count=3) == [date(2026, 10, 21),
+                                       date(2026, 10, 24),
+                                       date(2026, 10, 27)]
+
+
+def test_next_run_dates_never():
+    assert next_run_dates(date(2026, 10, 19), frozenset()) == []
+
+
+def test_run_times_across_daylight_saving():
+    """Sydney moves its clocks forward on 4 October 2026 and back on
+    5 April 2026, the run stays at 06:00 local time."""
+    time_zone = dt_util.get_time_zone('Australia/Sydney')
+    times = run_times([date(2026, 10, 3), date(2026, 10, 4),
+                       date(2026, 4, 5)], 6, 0, time_zone)
+    assert [time.isoformat() for time in times] == [
+        '2026-10-03T06:00:00+10:00', '2026-10-04T06:00:00+11:00',
+        '2026-04-05T06:00:00+10:00']
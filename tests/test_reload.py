@@ -0,0 +1,104 @@
+"""Tests for comparing a reloaded configuration with the running one and
+for the reload service."""
+import yaml
+
+from homeassistant.helpers.template import Template
+
+from irrigation.reload import ConfigDiff, config_key
+
+
+def test_diff():
+    running = {'irrigation.a': config_key({'name': 'a', 'priority': 0}),
+               'irrigation.b': config_key({'name': 'b', 'priority': 0}),
+               'irrigation.c': config_key({'name': 'c'})}
+    diff = ConfigDiff(running, {
+        'irrigation.a': {'priority': 0, 'name': 'a'},
+        'irrigation.b': {'name': 'b', 'priority': 1},
+        'irrigation.d': {'name': 'd'}})
+    assert list(diff.added) == ['irrigation.d']
+    assert list(diff.changed) == ['irrigation.b']
+    assert diff.removed == ['irrigation.c']
+    assert len(diff) == 3
+    assert diff.keys['irrigation.a'] == running['irrigation.a']
+
+
+def test_no_difference():
+    config = {'name': 'a', 'zones': [{'zone': 'irrigation_zone.x'}]}
+    diff = ConfigDiff({'irrigation.a': config_key(config)},
+                      {'irrigation.a': config})
+    assert not diff
+    assert len(diff) == 0
+
+
+def test_templates_compared_by_text():
+    text = "{{ is_state('binary_sensor.wet','off') }}"
+    running = {'irrigation.a': config_key({'template': Template(text)})}
+    assert not ConfigDiff(running, {'irrigation.a': {
+        'template': Template(text)}})
+    assert ConfigDiff(running, {'irrigation.a': {
+        'template': Template(text.replace('off', 'on'))}}).changed
+
+
+def _zone(name, water=1):
+    return {'name': name, 'water': water, 'switch_entity': 'switch.' + name}
+
+
+def _program(name, *zones):
+    return {'name': name, 'template': '{{ false }}',
+            'zones': [{'zone': 'irrigation_zone.' + zone} for zone in zones]}
+
+
+def _reload(hass, run, settle, config):
+    """ write the configuration file and call the service """
+    with open(hass.config.path('configuration.yaml'), 'w') as config_file:
+        yaml.safe_dump({'irrigation': config}, config_file)
+    run(hass.services.async_call('irrigation', 'reload', {}, blocking=True))
+    settle()
+
+
+def _run_program(hass, run, settle, entity_id):
+    run(hass.services.async_call('irrigation', 'run_program',
+                                 {'entity_id': entity_id}))
+    settle()
+
+
+def test_reload_applies_differences(hass, component, switches, run, settle,
+                                    advance):
+    diagnostics = component({
+        'zones': [_zone('a'), _zone('b')],
+        'programs': [_program('p', 'a'), _program('q', 'b')]})
+    kept = diagnostics.programs['irrigation.q']
+    zone_b = diagnostics.zones['irrigation_zone.b']
+    _reload(hass, run, settle, {
+        'zones': [_zone('a', 2), _zone('b'), _zone('c')],
+        'programs': [_program('q', 'b'), _program('r', 'a', 'c')]})
+
+    assert sorted(diagnostics.programs) == ['irrigation.q', 'irrigation.r']
+    assert hass.states.get('irrigation.p') is None
+    assert hass.states.get('irrigation_zone.c') is not None
+    """ entities that did not change are the same entities """
+    assert diagnostics.programs['irrigation.q'] is kept
+    assert diagnostics.zones['irrigation_zone.b'] is zone_b
+
+    """ the changed zone waters for its new time """
+    _run_program(hass, run, settle, 'irrigation.r')
+    advance(240)
+    assert switches.timeline() == [
+        (0, 'switch.a', 'on'), (120, 'switch.a', 'off'),
+        (120, 'switch.c', 'on'), (180, 'switch.c', 'off')]
+
+
+def test_reload_stops_removed_program(hass, component, switches, run, settle,
+                                      advance):
+    diagnostics = component({
+        'zones': [_zone('a', 5)],
+        'programs': [_program('p', 'a')]})
+    _run_program(hass, run, settle, 'irrigation.p')
+    advance(60)
+    _reload(hass, run, settle, {'zones': [_zone('a', 5)], 'programs': []})
+    assert diagnostics.programs == {}
+    assert switches.timeline('switch.a') == [(0, 'switch.a', 'on'),
+                                             (60, 'switch.a', 'off')]
+    assert hass.states.get('irrigation_zone.a').state == 'off'
+    advance(300)
+    assert len(switches.timeline('switch.a')) == 2
@@ -0,0 +1,80 @@
+"""Tests for the water budget rollups catching up with the history."""
+import os
+
+from homeassistant.const import EVENT_HOMEASSISTANT_FINAL_WRITE
+import homeassistant.util.dt as dt_util
+
+from irrigation.history import REASON_RAIN, WateringHistory
+from irrigation.report import PERIOD_DAY, PERIOD_MONTH, Rollups
+
+ZONE = 'irrigation_zone.a'
+DAY1 = dt_util.parse_datetime('2026-10-19T06:00:00+00:00').timestamp()
+DAY2 = DAY1 + 86400
+
+
+def _history(hass, run, tmp_path, runs):
+    """Record (start, minutes, litres, reason) runs without rollups."""
+    history = WateringHistory(hass, str(tmp_path / 'history'))
+    for start, minutes, litres, reason in runs:
+        history.async_record(ZONE, start, start + minutes * 60, minutes,
+                             litres, reason)
+    run(hass.async_block_till_done())
+    return history
+
+
+def _rollups(hass, run, history):
+    rollups = Rollups(hass, history)
+    run(rollups.async_load())
+    return rollups
+
+
+def _save(hass, run):
+    """Write the delayed saves, as Home Assistant does when it stops."""
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_FINAL_WRITE)
+    run(hass.async_block_till_done())
+
+
+def test_catch_up_from_empty_store(hass, run, tmp_path):
+    history = _history(hass, run, tmp_path, [
+        (DAY1, 10, 100, 0), (DAY1 + 3600, 5, 50, 0),
+        (DAY2, 0, 0, REASON_RAIN)])
+    rollups = _rollups(hass, run, history)
+    assert rollups.caught_up == 3
+    assert rollups.rows(PERIOD_DAY) == [
+        (ZONE, '2026-10-19', 2, 0, 15.0, 150.0),
+        (ZONE, '2026-10-20', 0, 1, 0.0, 0.0)]
+    assert rollups.rows(PERIOD_MONTH) == [
+        (ZONE, '2026-10', 2, 1, 15.0, 150.0)]
+
+
+def test_catch_up_adds_records_missed_by_save(hass, run, tmp_path):
+    history = _history(hass, run, tmp_path, [(DAY1, 10, 100, 0)])
+    _rollups(hass, run, history)
+    _save(hass, run)
+
+    """ records written after the last save of the totals """
+    history.async_record(ZONE, DAY2, DAY2 + 60, 1, 10)
+    history.async_record(ZONE, DAY2 + 60, DAY2 + 120, 1, 10)
+    run(hass.async_block_till_done())
+    rollups = _rollups(hass, run, history)
+    assert rollups.caught_up == 2
+    assert rollups.rows(PERIOD_MONTH) == [
+        (ZONE, '2026-10', 3, 0, 12.0, 120.0)]
+
+    """ nothing more to add once the totals are saved again """
+    _save(hass, run)
+    assert _rollups(hass, run, history).caught_up == 0
+
+
+def test_rebuild_when_file_is_shorter(hass, run, tmp_path):
+    history = _history(hass, run, tmp_path, [
+        (DAY1, 10, 100, 0), (DAY2, 10, 100, 0)])
+    _rollups(hass, run, history)
+    _save(hass, run)
+
+    os.remove(str(tmp_path / 'history' / (ZONE + '.history')))
+    history = _history(hass, run, tmp_path, [(DAY2, 4, 40, 0)])
+    rollups = _rollups(hass, run, history)
+    assert rollups.caught_up == 1
+    assert rollups.rows(PERIOD_DAY) == [(ZONE, '2026-10-20', 1, 0, 4.0,
+                                         40.0)]
@@ -0,0 +1,165 @@
+"""Tests for the run queue policies, with stand in programs watering each
+zone for a minute."""
+import asyncio
+
+from irrigation.runqueue import (POLICY_DROP, POLICY_MERGE, POLICY_PREEMPT,
+                                 POLICY_QUEUE, RunQueue)
+
+WATER   = 60
+RELEASE = 5
+
+
+class Program:
+    """Stand in program running its zones in turn.
+
+    Once its zones have run it holds the request for the time a real
+    program takes to close the last valve.
+    """
+
+    def __init__(self, hass, log, name, zones, priority=0, can_merge=True):
+        self.hass      = hass
+        self.entity_id = 'irrigation.' + name
+        self.zones     = [{'zone': zone} for zone in zones]
+        self.priority  = priority
+        self.can_merge = can_merge
+        self._log      = log
+        self._stop     = asyncio.Event()
+
+    async def async_run_sequence(self, request):
+        self._stop.clear()
+        while request.zones:
+            self._log.append((round(self.hass.loop.offset), self.entity_id,
+                              request.zones[0]['zone']))
+            try:
+                await asyncio.wait_for(self._stop.wait(), WATER)
+                break
+            except asyncio.TimeoutError:
+                request.zones.pop(0)
+        request.accepting = False
+        await asyncio.sleep(RELEASE)
+
+    async def async_preempt(self):
+        self._stop.set()
+
+    def async_queue_wait(self, wait):
+        pass
+
+
+def _setup(hass, policy):
+    log = []
+    return RunQueue(hass, policy), log, \
+        lambda *args, **kwargs: Program(hass, log, *args, **kwargs)
+
+
+def test_queue(hass, run, settle, advance):
+    queue, log, program = _setup(hass, POLICY_QUEUE)
+    run(queue.async_submit(program('p1', ['a', 'b']), False))
+    run(queue.async_submit(program('p2', ['c'], priority=5), False))
+    """ a is running and b waiting, they are not queued again """
+    run(queue.async_submit(program('p3', ['a', 'b']), False))
+    assert queue.depth == 1
+    advance(300)
+    assert log == [(0, 'irrigation.p1', 'a'), (60, 'irrigation.p1', 'b'),
+                   (125, 'irrigation.p2', 'c')]
+    assert queue.running is None and queue.depth == 0
+
+
+def test_preempt_overlapping_program(hass, run, settle, advance):
+    """ p2 waters the zone p1 has not reached, p1 waters the rest """
+    queue, log, program = _setup(hass, POLICY_PREEMPT)
+    run(queue.async_submit(program('p1', ['z0', 'z1']), False))
+    advance(10)
+    run(queue.async_submit(program('p2', ['z1'], priority=5), False))
+    settle()
+    advance(300)
+    assert log == [(0, 'irrigation.p1', 'z0'), (15, 'irrigation.p2', 'z1'),
+                   (80, 'irrigation.p1', 'z0')]
+    assert queue.depth == 0
+
+
+def test_lower_priority_waits(hass, run, settle, advance):
+    queue, log, program = _setup(hass, POLICY_PREEMPT)
+    run(queue.async_submit(program('p1', ['a'], priority=5), False))
+    advance(10)
+    run(queue.async_submit(program('p2', ['b']), False))
+    settle()
+    advance(200)
+    assert log == [(0, 'irrigation.p1', 'a'), (65, 'irrigation.p2', 'b')]
+
+
+def test_program_does_not_preempt_itself(hass, run, settle, advance):
+    queue, log, program = _setup(hass, POLICY_PREEMPT)
+    p1 = program('p1', ['a'])
+    run(queue.async_submit(p1, False))
+    advance(10)
+    run(queue.async_submit(p1, False))
+    settle()
+    advance(200)
+    assert log == [(0, 'irrigation.p1', 'a')]
+
+
+def test_merge(hass, run, settle, advance):
+    queue, log, program = _setup(hass, POLICY_MERGE)
+    run(queue.async_submit(program('p1', ['a']), False))
+    advance(10)
+    run(queue.async_submit(program('p2', ['a', 'b']), False))
+    settle()
+    assert queue.depth == 0
+    advance(200)
+    assert log == [(0, 'irrigation.p1', 'a'), (60, 'irrigation.p1', 'b')]
+
+
+def test_merge_after_sequence_is_queued(hass, run, settle, advance):
+    """ p1 has run its zones and is closing its last valve """
+    queue, log, program = _setup(hass, POLICY_MERGE)
+    run(queue.async_submit(program('p1', ['a']), False))
+    advance(62)
+    run(queue.async_submit(program('p2', ['b']), False))
+    settle()
+    assert queue.depth == 1
+    advance(200)
+    assert log == [(0, 'irrigation.p1', 'a'), (65, 'irrigation.p2', 'b')]
+
+
+def test_merge_into_packed_program_is_queued(hass, run, settle, advance):
+    queue, log, program = _setup(hass, POLICY_MERGE)
+    run(queue.async_submit(program('p1', ['a'], can_merge=False), False))
+    advance(10)
+    run(queue.async_submit(program('p2', ['b']), False))
+    settle()
+    advance(200)
+    assert log == [(0, 'irrigation.p1', 'a'), (65, 'irrigation.p2', 'b')]
+
+
+def test_drop(hass, run, settle, advance):
+    queue, log, program = _setup(hass, POLICY_DROP)
+    run(queue.async_submit(program('p1', ['a']), False))
+    advance(10)
+    run(queue.async_submit(program('p2', ['b'], priority=5), False))
+    settle()
+    assert queue.depth == 0
+    advance(200)
+    assert log == [(0, 'irrigation.p1', 'a')]
+
+
+def test_preempting_program_waters_overlap(hass, component, switches, run,
+                                           settle, advance):
+    component({
+        'zones': [{'name': name, 'water': 1, 'switch_entity': 'switch.' + name}
+                  for name in ('a', 'b')],
+        'programs': [
+            {'name': 'p1', 'template': '{{ false }}',
+             'zones': [{'zone': 'irrigation_zone.a'},
+                       {'zone': 'irrigation_zone.b'}]},
+            {'name': 'p2', 'template': '{{ false }}', 'priority': 5,
+             'zones': [{'zone': 'irrigation_zone.b'}]}]})
+    for entity_id in ('irrigation.p1', 'irrigation.p2'):
+        run(hass.services.async_call('irrigation', 'run_program',
+                                     {'entity_id': entity_id}))
+        settle()
+        advance(10)
+    advance(300)
+    assert switches.timeline() == [
+        (0, 'switch.a', 'on'), (10, 'switch.a', 'off'),
+        (10, 'switch.b', 'on'), (70, 'switch.b', 'off'),
+        (70, 'switch.a', 'on'), (130, 'switch.a', 'off')]
@@ -0,0 +1,67 @@
+"""Tests driving programs through the virtual clock simulator."""
+from simulator import benchmark_config, simulate
+
+
+def _config(size):
+    """A benchmark program publishing zone state only at phase changes,
+    so every wakeup is a phase boundary."""
+    config = benchmark_config(size)
+    config['publish'] = 'phase'
+    return config
+
+
+def _phases(config):
+    """Water and Eco wait phases of every zone."""
+    return sum(2 * zone.get('repeat', 1) - 1 for zone in config['zones'])
+
+
+def test_switch_timeline():
+    """Zone 0 waters 1 minute 3 times with 2 minute waits, then zones 1
+    and 2 water 2 and 3 minutes."""
+    result = simulate(_config(3))
+    assert result.switch_events == [
+        (0.0, 'switch.solenoid_000', 'on'),
+        (60.0, 'switch.solenoid_000', 'off'),
+        (180.0, 'switch.solenoid_000', 'on'),
+        (240.0, 'switch.solenoid_000', 'off'),
+        (360.0, 'switch.solenoid_000', 'on'),
+        (420.0, 'switch.solenoid_000', 'off'),
+        (420.0, 'switch.solenoid_001', 'on'),
+        (540.0, 'switch.solenoid_001', 'off'),
+        (540.0, 'switch.solenoid_002', 'on'),
+        (720.0, 'switch.solenoid_002', 'off')]
+    assert result.makespan == 720
+    assert result.switch_calls == 10
+
+
+def test_no_gap_between_zones():
+    result = simulate(_config(10))
+    assert len(result.gaps) == 9
+    assert max(result.gaps) == 0
+
+
+def test_gap_is_switch_latency():
+    result = simulate(_config(10), latency=0.05)
+    assert max(result.gaps) <= 0.05 + 1e-6
+
+
+def test_one_wakeup_per_phase():
+    for size in (3, 50):
+        config = _config(size)
+        assert simulate(config).wakeups == _phases(config), size
+
+
+def test_state_writes():
+    """Each zone writes its state as it starts and at each phase change,
+    each switch once per valve operation. The program writes its planned
+    timeline, the zone it starts, each handover from one zone to the next
+    and its end."""
+    for size in (1, 3, 10):
+        config = _config(size)
+        writes = simulate(config).state_writes
+        for index, zone in enumerate(config['zones']):
+            repeat = zone.get('repeat', 1)
+            assert writes['irrigation_zone.zone_{}'.format(index)] == \
+                2 * repeat
+            assert writes[zone['switch_entity']] == 2 * repeat
+        assert writes['irrigation.benchmark'] == 1 + size + (size - 1) + 1
@@ -0,0 +1,173 @@
+"""Tests for switch commands confirmed by the switch state and for the
+controllers that drive the switches."""
+import yaml
+
+from irrigation.switches import Controller, SwitchCommander
+
+A = 'switch.a'
+B = 'switch.b'
+
+
+def _commander(hass, switches, *stuck):
+    """ stuck switches only change state when the test sets it """
+    for entity_id in (A, B):
+        hass.states.async_set(entity_id, 'off')
+    switches.stuck.update(stuck)
+    return SwitchCommander(hass)
+
+
+def _stats(commander, entity_id):
+    return commander.stats_for(entity_id).as_dict()
+
+
+def _counts(sent=0, coalesced=0, retries=0, failures=0):
+    return {'sent': sent, 'coalesced': coalesced, 'retries': retries,
+            'failures': failures}
+
+
+def test_off_supersedes_unconfirmed_on(hass, switches, settle, advance):
+    commander = _commander(hass, switches, A)
+    turn_on = hass.async_create_task(commander.async_turn(A, True))
+    settle()
+    assert not turn_on.done()
+    turn_off = hass.async_create_task(commander.async_turn(A, False))
+    settle()
+    """ the switch is still off, so the off is confirmed and the on fails
+        at once rather than waiting out its timeout and retries """
+    assert turn_on.done() and turn_on.result() is False
+    assert turn_off.done() and turn_off.result() is True
+    advance(30)
+    assert switches.timeline() == [(0, A, 'on'), (0, A, 'off')]
+    assert _stats(commander, A) == _counts(sent=2)
+
+
+def test_waiters_for_same_state_share_confirmation(hass, switches, settle):
+    commander = _commander(hass, switches, A)
+    turn = hass.async_create_task(commander.async_turn(A, True))
+    settle()
+    """ the same command is not sent again while it is in flight """
+    again = hass.async_create_task(commander.async_turn(A, True))
+    batch = hass.async_create_task(commander.async_turn_all([A], True))
+    settle()
+    assert not (turn.done() or again.done() or batch.done())
+    hass.states.async_set(A, 'on')
+    settle()
+    assert (turn.result(), again.result(), batch.result()) == (True, True,
+                                                               True)
+    assert switches.timeline() == [(0, A, 'on'), (0, A, 'on')]
+    assert _stats(commander, A) == _counts(sent=2, coalesced=1)
+    """ the command and the batch each waited for the confirmation """
+    assert sum(commander.stats_for(A).latency) == 2
+
+
+def test_batch_switch_retargeted(hass, switches, settle, advance):
+    commander = _commander(hass, switches, A, B)
+    batch = hass.async_create_task(commander.async_turn_all([A, B], True))
+    settle()
+    hass.states.async_set(A, 'on')
+    settle()
+    assert not batch.done()
+    turn_off = hass.async_create_task(commander.async_turn(B, False))
+    settle()
+    """ switch b was turned back off, the batch reports it without
+        waiting for its timeout or retrying b """
+    assert turn_off.done() and turn_off.result() is True
+    assert batch.done() and batch.result() is False
+    advance(30)
+    assert switches.timeline() == [(0, A, 'on'), (0, B, 'on'),
+                                   (0, B, 'off')]
+    assert _stats(commander, A) == _counts(sent=1)
+    assert _stats(commander, B) == _counts(sent=2)
+
+
+def test_unconfirmed_switch_is_retried(hass, switches, settle, advance):
+    commander = _commander(hass, switches, A)
+    turn = hass.async_create_task(commander.async_turn(A, True))
+    settle()
+    advance(7)
+    hass.states.async_set(A, 'on')
+    settle()
+    assert turn.result() is True
+    assert switches.timeline() == [(0, A, 'on'), (6, A, 'on')]
+    assert _stats(commander, A) == _counts(sent=2, retries=1)
+
+
+def test_controller_available(hass):
+    controller = Controller(hass, 'board')
+    controller.switches = [A, B]
+    assert controller.available
+    hass.states.async_set(B, 'off')
+    hass.states.async_set(A, 'unavailable')
+    assert controller.available
+    hass.states.async_set(B, 'unavailable')
+    assert not controller.available
+    controller.availability_entity = 'binary_sensor.board'
+    hass.states.async_set('binary_sensor.board', 'off')
+    assert not controller.available
+
+
+def test_controller_holds_deferred_zones_by_program(hass):
+    controller = Controller(hass, 'board')
+    controller.defer('irrigation.p', {'zone': 'irrigation_zone.a'})
+    controller.defer('irrigation.q', {'zone': 'irrigation_zone.b'})
+    controller.defer('irrigation.p', {'zone': 'irrigation_zone.c'})
+    assert controller.take_deferred() == [
+        ('irrigation.p', [{'zone': 'irrigation_zone.a'},
+                          {'zone': 'irrigation_zone.c'}]),
+        ('irrigation.q', [{'zone': 'irrigation_zone.b'}])]
+    assert controller.take_deferred() == []
+
+
+BOARD = 'binary_sensor.board'
+
+
+def _board_config(programs):
+    """ zone b is on a controller board whose zones are rescheduled """
+    return {
+        'controllers': [{'name': 'board', 'availability_entity': BOARD,
+                         'unavailable': 'reschedule'}],
+        'zones': [{'name': 'a', 'water': 1, 'switch_entity': A},
+                  {'name': 'b', 'water': 1, 'switch_entity': B,
+                   'controller': 'board'}],
+        'programs': [{'name': name, 'template': '{{ false }}',
+                      'zones': [{'zone': 'irrigation_zone.a'},
+                                {'zone': 'irrigation_zone.b'}]}
+                     for name in programs]}
+
+
+def _board_drops_mid_run(hass, component, run, settle, advance, programs):
+    hass.states.async_set(BOARD, 'on')
+    component(_board_config(programs))
+    run(hass.services.async_call('irrigation', 'run_program',
+                                 {'entity_id': 'irrigation.p'}))
+    settle()
+    advance(30)
+    hass.states.async_set(BOARD, 'off')
+    advance(90)
+    assert hass.states.get('irrigation_controller.board').state == 'off'
+
+
+def test_controller_reschedules_deferred_zone(hass, component, switches, run,
+                                              settle, advance):
+    _board_drops_mid_run(hass, component, run, settle, advance, ['p'])
+    """ zone b was left out of the run when its turn came """
+    assert switches.timeline() == [(0, A, 'on'), (60, A, 'off')]
+    hass.states.async_set(BOARD, 'on')
+    settle()
+    advance(120)
+    assert switches.timeline() == [(0, A, 'on'), (60, A, 'off'),
+                                   (120, B, 'on'), (180, B, 'off')]
+
+
+def test_deferred_zone_of_removed_program_is_dropped(hass, component,
+                                                     switches, run, settle,
+                                                     advance):
+    _board_drops_mid_run(hass, component, run, settle, advance, ['p', 'q'])
+    with open(hass.config.path('configuration.yaml'), 'w') as config_file:
+        yaml.safe_dump({'irrigation': _board_config(['q'])}, config_file)
+    run(hass.services.async_call('irrigation', 'reload', {}, blocking=True))
+    settle()
+    hass.states.async_set(BOARD, 'on')
+    settle()
+    advance(120)
+    assert switches.timeline() == [(0, A, 'on'), (60, A, 'off')]
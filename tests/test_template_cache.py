@@ -0,0 +1,50 @@
+"""Tests for splitting program templates into a trigger and a calendar."""
+from irrigation.template_cache import parse_calendar, parse_time_trigger
+
+
+def test_time_trigger_with_condition():
+    assert parse_time_trigger(
+        "{{ states('sensor.time') == '07:30' and "
+        "is_state('binary_sensor.wet','off') }}") == (
+            7, 30, "is_state('binary_sensor.wet','off')")
+
+
+def test_time_trigger_alone():
+    assert parse_time_trigger(
+        '{{ states("sensor.time") == "6:05" }}') == (6, 5, None)
+
+
+def test_time_trigger_not_parsed():
+    for text in (
+            "{{ states('sensor.time') == '07:30' or is_state('a.b','on') }}",
+            "{{ is_state('binary_sensor.wet','off') }}",
+            "{{ states('sensor.time') == '24:00' }}",
+            "{{ states('sensor.time') == '07:30' }} {{ 1 }}",
+            "states('sensor.time') == '07:30'"):
+        assert parse_time_trigger(text) is None, text
+
+
+def test_calendar_terms():
+    weekdays, days_since, condition = parse_calendar(
+        "now().weekday() in [0,2,4] and "
+        "state_attr('irrigation.morning', 'days_since') > 2 and "
+        "is_state('binary_sensor.wet','off')", 'irrigation.morning')
+    assert weekdays == frozenset([0, 2, 4])
+    assert days_since == ('>', 2)
+    assert condition == "is_state('binary_sensor.wet','off')"
+
+
+def test_calendar_weekdays_intersect():
+    weekdays, _, condition = parse_calendar(
+        "now().strftime('%a') in ['Mon','Wed'] and now().weekday() == 0")
+    assert weekdays == frozenset([0])
+    assert condition is None
+
+
+def test_calendar_keeps_other_programs_days_since():
+    term = "state_attr('irrigation.evening', 'days_since') >= 1"
+    assert parse_calendar(term, 'irrigation.morning') == (None, None, term)
+
+
+def test_calendar_empty():
+    assert parse_calendar(None) == (None, None, None)